@@ -0,0 +1,104 @@
+"""
+Бенчмарк насыщения HTTP-пула: N одновременных запросов к локальному stub-серверу
+через httpx-клиент, собранный так же, как для AsyncOpenAI (build_http_client).
+
+При пуле меньше числа одновременных запросов запросы ждут свободного соединения:
+растет латентность, а при малом pool_timeout появляются PoolTimeout.
+
+Запуск:
+    python benchmarks/bench_http_pool.py
+    python benchmarks/bench_http_pool.py --requests 500 --pool-sizes 1 8 32 128 --latency-ms 100 --pool-timeout 2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_openai import StubOpenAIServer  # noqa: E402
+
+from zadavalnik.ai.openai_client import build_http_client  # noqa: E402
+
+REQUEST_BODY = {
+    "model": "stub",
+    "messages": [{"role": "user", "content": "ping"}],
+}
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def _run_pool(server: StubOpenAIServer, pool_size: int, args) -> dict:
+    client = build_http_client(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=30.0,
+        http2=False,
+        connect_timeout=5.0,
+        read_timeout=60.0,
+        write_timeout=10.0,
+        pool_timeout=args.pool_timeout,
+    )
+    connections_before = server.connections_opened
+    server.max_active_requests = 0
+    latencies, pool_timeouts, errors = [], 0, 0
+
+    async def one_request():
+        nonlocal pool_timeouts, errors
+        started = time.perf_counter()
+        try:
+            response = await client.post(f"{server.base_url}/chat/completions", json=REQUEST_BODY)
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - started) * 1000)
+        except httpx.PoolTimeout:
+            pool_timeouts += 1
+        except httpx.HTTPError:
+            errors += 1
+
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*(one_request() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "pool": pool_size,
+        "ok": len(latencies),
+        "pool_timeouts": pool_timeouts,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "connections": server.connections_opened - connections_before,
+        "server_concurrency": server.max_active_requests,
+    }
+
+
+async def main(args):
+    server = await StubOpenAIServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms).start()
+    print(f"{args.requests} concurrent requests, stub latency {args.latency_ms} ms, pool_timeout {args.pool_timeout}s")
+    print(f"{'pool':>5} {'ok':>6} {'pool_to':>8} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'conns':>6} {'srv_conc':>8}")
+    try:
+        for pool_size in args.pool_sizes:
+            row = await _run_pool(server, pool_size, args)
+            print(f"{row['pool']:>5} {row['ok']:>6} {row['pool_timeouts']:>8} {row['errors']:>5} {row['rps']:>8.1f} "
+                  f"{row['p50']:>8.0f} {row['p95']:>8.0f} {row['p99']:>8.0f} {row['connections']:>6} {row['server_concurrency']:>8}")
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP connection pool saturation benchmark")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--pool-timeout", type=float, default=10.0)
+    asyncio.run(main(parser.parse_args()))
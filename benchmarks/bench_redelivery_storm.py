@@ -0,0 +1,248 @@
+"""
+Шторм повторной доставки: пользователи отправляют сообщения, а Telegram отдает их повторно -
+тот же update_id после падения polling'а, то же сообщение под новым update_id, дубли
+обрабатываются параллельно (как при concurrent_updates). Каждый прошедший апдейт вызывает
+фиктивный запрос к ИИ; без дубликатов запросов столько же, сколько уникальных сообщений.
+
+Сценарии:
+- storm: перемешанный поток с повторами в одном процессе;
+- restart: штатный перезапуск (flush при остановке), новый UpdateDeduplicator читает БД,
+  Telegram отдает заново все апдейты после сохраненного offset и часть старых;
+- crash: падение без flush - повторно обрабатываются только апдейты после последнего
+  периодического сброса (не больше, чем пришло за IDEMPOTENCY_FLUSH_SECONDS);
+- crash mid-handler: процесс падает, пока обработчики ждут ИИ. PTB к этому моменту уже подтвердил
+  апдейты Telegram, поэтому прерванные апдейты приходят только из журнала (replay_pending);
+  проверяется, что ни одно сообщение не потеряно.
+
+Режим --no-dedup показывает, сколько лишних запросов к ИИ было бы без защиты.
+Код возврата 1, если дубликат прошел там, где не должен был, или сообщение потеряно.
+
+Запуск:
+    python benchmarks/bench_redelivery_storm.py
+    python benchmarks/bench_redelivery_storm.py --users 200 --messages 10 --redelivery 0.5
+    python benchmarks/bench_redelivery_storm.py --no-dedup
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import ApplicationHandlerStop
+
+from zadavalnik.bot.idempotency import UpdateDeduplicator
+from zadavalnik.config import load_settings
+from zadavalnik.database.db import init_db
+
+
+class FakeLLM:
+    """Считает запросы к ИИ по сообщениям: повторный запрос по тому же сообщению - лишний."""
+
+    def __init__(self, max_delay: float = 0.002):
+        self.max_delay = max_delay
+        self.calls = 0
+        self.by_message = {}
+        self.answered = set() # Сообщения, на которые ответ получен
+
+    async def call(self, chat_id: int, message_id: int):
+        self.calls += 1
+        key = (chat_id, message_id)
+        self.by_message[key] = self.by_message.get(key, 0) + 1
+        await asyncio.sleep(random.uniform(0, self.max_delay))
+        self.answered.add(key)
+
+    @property
+    def extra_calls(self) -> int:
+        return self.calls - len(self.by_message)
+
+
+def make_update(update_id: int, chat_id: int, message_id: int) -> Update:
+    user = User(id=chat_id, first_name="bench", is_bot=False)
+    message = Message(message_id=message_id, date=datetime.now(timezone.utc), chat=Chat(id=chat_id, type="private"),
+                      from_user=user, text="ответ")
+    return Update(update_id=update_id, message=message)
+
+
+def as_tuple(update: Update) -> tuple:
+    return update.update_id, update.message.chat_id, update.message.message_id
+
+
+def user_messages(args) -> list:
+    """(update_id, chat_id, message_id) в порядке отправки."""
+    sent = []
+    next_message_id = {}
+    for round_number in range(args.messages):
+        for user_id in range(1, args.users + 1):
+            message_id = next_message_id[user_id] = next_message_id.get(user_id, 0) + 1
+            sent.append((len(sent) + 1, user_id, message_id))
+    return sent
+
+
+def with_redelivery(sent: list, args, next_update_id: int) -> list:
+    """Добавляет повторы: тот же update_id или то же сообщение под новым update_id."""
+    stream = list(sent)
+    for update_id, chat_id, message_id in sent:
+        if random.random() < args.redelivery:
+            if random.random() < 0.5:
+                stream.append((update_id, chat_id, message_id))
+            else:
+                next_update_id += 1
+                stream.append((next_update_id, chat_id, message_id))
+    random.shuffle(stream)
+    return stream
+
+
+async def deliver(stream: list, deduplicator, llm: FakeLLM, concurrency: int, started: list = None):
+    """Обработка как в Application: проверка в группе -1, обработчик с запросом к ИИ, завершение в группе 3."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(update_id: int, chat_id: int, message_id: int):
+        async with semaphore:
+            update = make_update(update_id, chat_id, message_id)
+            if deduplicator is not None:
+                try:
+                    await deduplicator.check(update, None)
+                except ApplicationHandlerStop:
+                    return
+            if started is not None:
+                started.append(update_id)
+            await llm.call(chat_id, message_id)
+            if deduplicator is not None:
+                await deduplicator.complete_update(update, None)
+
+    await asyncio.gather(*(process(*update) for update in stream))
+
+
+async def replayed(deduplicator) -> list:
+    """Апдейты из журнала, которые replay_pending() ставит в очередь Application."""
+    application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+    await deduplicator.replay_pending(application)
+    updates = []
+    while not application.update_queue.empty():
+        updates.append(as_tuple(application.update_queue.get_nowait()))
+    return updates
+
+
+def report(name: str, llm: FakeLLM, delivered: int, deduplicator) -> int:
+    stats = deduplicator.stats() if deduplicator is not None else {}
+    print(f"{name:>8}: delivered {delivered:>6}, unique messages {len(llm.by_message):>6}, "
+          f"LLM calls {llm.calls:>6}, extra {llm.extra_calls:>5}  "
+          f"(dropped: {stats.get('duplicate_updates', 0)} by update_id, {stats.get('duplicate_messages', 0)} by message)")
+    return llm.extra_calls
+
+
+async def run(args) -> int:
+    random.seed(args.seed)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="zadavalnik-bench-"), "bench.db")
+    load_settings(BOT_TOKEN="bench", TEST_USER_TGID=0, OPENAI_API_KEY="bench",
+                  DATABASE_URL=f"sqlite+aiosqlite:///{db_path}")
+    await init_db()
+    failed = False
+
+    def new_deduplicator():
+        return None if args.no_dedup else UpdateDeduplicator()
+
+    sent = user_messages(args)
+    half = len(sent) // 2
+    print(f"{args.users} users x {args.messages} messages, redelivery {args.redelivery:.0%}, "
+          f"concurrency {args.concurrency}{', no dedup' if args.no_dedup else ''}")
+
+    # 1. Шторм в одном процессе
+    deduplicator = new_deduplicator()
+    llm = FakeLLM()
+    stream = with_redelivery(sent[:half], args, len(sent) * 10)
+    await deliver(stream, deduplicator, llm, args.concurrency)
+    failed |= report("storm", llm, len(stream), deduplicator) > 0
+
+    # 2. Штатный перезапуск: ключи и offset сохранены при остановке
+    if deduplicator is not None:
+        await deduplicator.flush()
+        deduplicator = new_deduplicator()
+        offset = await deduplicator.load()
+        # getUpdates(offset) не отдаст апдейты до offset, но часть старых сообщений придет под новыми id
+        old = [update for update in sent[:half] if offset is None or update[0] > offset]
+        old += [(len(sent) * 20 + i, chat_id, message_id)
+                for i, (_, chat_id, message_id) in enumerate(random.sample(sent[:half], half // 5))]
+    else:
+        old = list(sent[:half])
+    stream = with_redelivery(old + sent[half:], args, len(sent) * 30)
+    await deliver(stream, deduplicator, llm, args.concurrency)
+    failed |= report("restart", llm, len(stream), deduplicator) > 0
+
+    # 3. Падение: последний периодический сброс прошел до части апдейтов
+    if deduplicator is not None:
+        await deduplicator.flush()
+    extra_calls_before = llm.extra_calls
+    crash_sent = [(len(sent) * 40 + i, chat_id, message_id + args.messages)
+                  for i, (_, chat_id, message_id) in enumerate(sent[:half], start=1)]
+    flushed_part = crash_sent[:len(crash_sent) // 2]
+    await deliver(flushed_part, deduplicator, llm, args.concurrency)
+    if deduplicator is not None:
+        await deduplicator.flush()
+    unflushed = crash_sent[len(crash_sent) // 2:]
+    await deliver(unflushed, deduplicator, llm, args.concurrency)
+    # Процесс упал: unflushed не сохранены (и остались в журнале), Telegram отдает весь шторм заново
+    deduplicator = new_deduplicator()
+    journal = []
+    if deduplicator is not None:
+        await deduplicator.load()
+        journal = await replayed(deduplicator)
+    stream = journal + with_redelivery(crash_sent, args, len(sent) * 50)
+    await deliver(stream, deduplicator, llm, args.concurrency)
+    crash_extra = report("crash", llm, len(stream), deduplicator) - extra_calls_before
+    print(f"          after crash {crash_extra} messages processed again, "
+          f"{len(unflushed)} were not flushed yet")
+    failed |= crash_extra > len(unflushed)
+
+    # 4. Падение посреди обработки: часть ответов ИИ не получена
+    lost = 0
+    if deduplicator is not None:
+        await deduplicator.flush()
+        slow_llm = FakeLLM(max_delay=1.0)
+        mid_sent = [(len(sent) * 60 + i, chat_id, message_id + 2 * args.messages)
+                    for i, (_, chat_id, message_id) in enumerate(sent[:half], start=1)]
+        started = []
+        # Все апдейты сразу приняты и записаны в журнал, как после getUpdates
+        handling = asyncio.ensure_future(deliver(mid_sent, deduplicator, slow_llm, len(mid_sent), started))
+        while len(started) < len(mid_sent):
+            await asyncio.sleep(0.005)
+        await deduplicator.flush() # Периодический сброс успел пройти до падения
+        while len(slow_llm.answered) < len(mid_sent) // 2:
+            await asyncio.sleep(0.005)
+        handling.cancel()
+        await asyncio.gather(handling, return_exceptions=True)
+        interrupted = len(mid_sent) - len(slow_llm.answered)
+
+        # Рестарт: PTB уже подтвердил все апдейты, Telegram отдает только случайные повторы старых
+        deduplicator = new_deduplicator()
+        offset = await deduplicator.load()
+        journal = await replayed(deduplicator)
+        redelivered = [update for update in mid_sent if update[0] > offset and random.random() < args.redelivery]
+        stream = journal + with_redelivery(redelivered, args, len(sent) * 70)
+        await deliver(stream, deduplicator, slow_llm, args.concurrency)
+        await deduplicator.flush()
+        lost = len({(chat_id, message_id) for _, chat_id, message_id in mid_sent} - slow_llm.answered)
+        print(f"{'mid':>8}: {interrupted} of {len(mid_sent)} handlers interrupted, {len(journal)} replayed "
+              f"from the journal, {slow_llm.extra_calls} answered again, {lost} lost")
+        failed |= lost > 0
+
+    if args.no_dedup:
+        return 0
+    print("FAILED: duplicate updates reached the LLM or messages were lost" if failed
+          else "OK: duplicates reached the LLM only for updates not yet flushed before the crash, nothing lost")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duplicate update delivery benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=8, help="сообщений от каждого пользователя")
+    parser.add_argument("--redelivery", type=float, default=0.3, help="доля апдейтов, доставленных повторно")
+    parser.add_argument("--concurrency", type=int, default=64, help="апдейтов одновременно")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-dedup", action="store_true", help="без UpdateDeduplicator: все апдейты доходят до ИИ")
+    sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,130 @@
+"""
+Soak-бенчмарк хранилища сессий: много пользователей начинают тесты по изображениям и документам,
+отвечают на несколько вопросов, часть завершает тест, часть бросает на середине.
+Время ускорено (фиктивные часы), sweep() вызывается каждый раунд, как job JobQueue.
+
+Со SessionStore RSS выходит на плато: завершенные тесты освобождают историю,
+брошенные вытесняются по простою или бюджету памяти. В режиме --no-store история
+хранится списком словарей, как раньше, и RSS растет с каждым раундом.
+
+Запуск:
+    python benchmarks/bench_session_soak.py
+    python benchmarks/bench_session_soak.py --rounds 40 --users-per-round 50 --image-kb 400 --budget-mb 64
+    python benchmarks/bench_session_soak.py --no-store
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import os
+import random
+import resource
+from types import SimpleNamespace
+
+from zadavalnik.ai import prompts
+from zadavalnik.bot.session_store import SessionStore
+from zadavalnik.bot.states import UserState
+from zadavalnik.config import load_settings
+
+
+class FakeApplication:
+    """Минимум Application, который использует SessionStore: user_data, chat_data и их удаление."""
+
+    def __init__(self):
+        self.user_data = {}
+        self.chat_data = {}
+
+    def drop_user_data(self, user_id: int):
+        self.user_data.pop(user_id, None)
+
+    def drop_chat_data(self, chat_id: int):
+        self.chat_data.pop(chat_id, None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Пиковый RSS (macOS и др.)
+
+
+def first_turn(args) -> list:
+    if random.random() < 0.5:
+        image_base64 = base64.b64encode(os.urandom(args.image_kb * 1024)).decode()  # JPEG почти не сжимается
+        history = prompts.image_test_messages(image_base64)
+    else:
+        words = ["фотосинтез", "хлорофилл", "клетка", "энергия", "свет", "углекислый", "газ", "кислород"]
+        history = prompts.text_test_messages(" ".join(random.choices(words, k=args.document_words)))
+    history.append({"role": "assistant", "content": '{"message_to_user": "Вопрос 1: ...", "current_question_number": 1}'})
+    return history
+
+
+async def run(args):
+    load_settings(BOT_TOKEN="bench", TEST_USER_TGID=0, OPENAI_API_KEY="bench")
+    clock = FakeClock()
+    store = SessionStore(memory_budget_bytes=args.budget_mb * 1024 * 1024, idle_ttl=args.idle_ttl, clock=clock)
+    application = FakeApplication()
+    context = SimpleNamespace(application=application)
+    next_user_id = 1
+
+    mode = "legacy lists (no store)" if args.no_store else "SessionStore"
+    print(f"Mode: {mode}; {args.users_per_round} users/round, image {args.image_kb} KB, budget {args.budget_mb} MB")
+    print(f"{'round':>5} {'sessions':>8} {'history MB':>10} {'raw MB':>8} {'evicted':>8} {'RSS MB':>8}")
+    for round_number in range(1, args.rounds + 1):
+        for _ in range(args.users_per_round):
+            user_id, next_user_id = next_user_id, next_user_id + 1
+            store.touch(user_id)
+            user_data = application.user_data.setdefault(user_id, {'current_state': UserState.IN_TEST})
+            history = first_turn(args)
+            completes = random.random() < args.complete_rate
+            turns = args.turns if completes else random.randint(0, args.turns - 1)
+
+            if args.no_store:
+                for turn in range(turns):
+                    history = history + [prompts.user_message(f"ответ {turn}"),
+                                         {"role": "assistant", "content": '{"message_to_user": "..."}'}]
+                user_data['gpt_chat_history'] = history
+                continue
+
+            await store.save_history(user_data, history)
+            for turn in range(turns):
+                history = await store.load_history(user_data)
+                history += [prompts.user_message(f"ответ {turn}"), {"role": "assistant", "content": '{"message_to_user": "..."}'}]
+                await store.save_history(user_data, history)
+            del history
+            if completes:
+                user_data['current_state'] = UserState.TEST_COMPLETED
+                store.release(user_data)
+
+        clock.now += args.round_seconds
+        if not args.no_store:
+            await store.sweep(context)
+        gc.collect()
+        stats = store.stats(application)
+        print(f"{round_number:>5} {stats['sessions']:>8} {stats['history_bytes'] / 1024 / 1024:>10.1f} "
+              f"{stats['history_raw_bytes'] / 1024 / 1024:>8.1f} {stats['evicted_idle'] + stats['evicted_budget']:>8} "
+              f"{rss_mb():>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Session store memory soak benchmark")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--users-per-round", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=5, help="вопросов в тесте")
+    parser.add_argument("--complete-rate", type=float, default=0.7, help="доля пользователей, завершающих тест")
+    parser.add_argument("--image-kb", type=int, default=300)
+    parser.add_argument("--document-words", type=int, default=5000)
+    parser.add_argument("--budget-mb", type=int, default=32)
+    parser.add_argument("--idle-ttl", type=float, default=1800.0, help="простой до вытеснения, с (фиктивное время)")
+    parser.add_argument("--round-seconds", type=float, default=300.0, help="фиктивное время одного раунда, с")
+    parser.add_argument("--no-store", action="store_true", help="старое поведение: история списком, без вытеснения")
+    asyncio.run(run(parser.parse_args()))
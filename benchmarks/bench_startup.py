@@ -0,0 +1,114 @@
+"""
+Бенчмарк холодного старта: время импорта каждого модуля бота в отдельном процессе.
+
+Запуск (из корня проекта, в окружении с установленным пакетом):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --baseline benchmarks/startup_baseline.json
+    python benchmarks/bench_startup.py --save-baseline benchmarks/startup_baseline.json
+
+С --baseline скрипт завершается с кодом 1, если медиана импорта какого-либо модуля
+выросла больше чем на --tolerance относительно сохраненных значений.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+MODULES = [
+    "zadavalnik.config",
+    "zadavalnik.config.settings",
+    "zadavalnik.database.models",
+    "zadavalnik.database.db",
+    "zadavalnik.ai.openai_client",
+    "zadavalnik.bot.handlers",
+    "zadavalnik.bot.bot",
+]
+
+# Тяжелые пакеты, которые не должны подтягиваться импортом модулей бота
+HEAVY_PACKAGES = ["openai", "telegram.ext", "sqlalchemy.ext.asyncio", "pydantic_settings"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps([elapsed, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+
+def _run_once(module: str) -> Tuple[float, List[str]]:
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_PACKAGES)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        error = (result.stderr.strip().splitlines() or ["unknown error"])[-1]
+        raise RuntimeError(f"import {module} failed: {error}")
+    elapsed, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return elapsed, loaded
+
+
+def _top_imports(module: str, limit: int) -> List[Tuple[int, str]]:
+    """Самые дорогие по cumulative-времени импорты по данным -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line or line.count("|") != 2:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time benchmark for zadavalnik modules")
+    parser.add_argument("--repeat", type=int, default=5, help="сколько раз импортировать каждый модуль")
+    parser.add_argument("--top", type=int, default=0, help="показать N самых дорогих вложенных импортов")
+    parser.add_argument("--baseline", help="JSON с медианами для проверки регрессий")
+    parser.add_argument("--save-baseline", help="сохранить текущие медианы в JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимый рост относительно baseline")
+    args = parser.parse_args()
+
+    medians: Dict[str, float] = {}
+    print(f"{'module':32} {'median ms':>10} {'min ms':>8} {'max ms':>8}  heavy imports")
+    for module in MODULES:
+        samples = []
+        loaded: List[str] = []
+        try:
+            for _ in range(args.repeat):
+                elapsed, loaded = _run_once(module)
+                samples.append(elapsed)
+        except RuntimeError as e:
+            print(f"{module:32} {'ERROR':>10}  {e}")
+            continue
+        medians[module] = statistics.median(samples)
+        print(f"{module:32} {medians[module]:10.1f} {min(samples):8.1f} {max(samples):8.1f}  {', '.join(loaded) or '-'}")
+        if args.top:
+            for cumulative_us, name in _top_imports(module, args.top):
+                print(f"{'':34}{cumulative_us / 1000:8.1f} ms  {name}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(medians, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            (module, baseline[module], value) for module, value in medians.items()
+            if module in baseline and value > baseline[module] * (1 + args.tolerance)
+        ]
+        for module, before, after in regressions:
+            print(f"REGRESSION {module}: {before:.1f} ms -> {after:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Локальный stub OpenAI-совместимого API (только POST .../chat/completions) для бенчмарков.
+
+Отвечает корректным JSON-ответом теста после искусственной задержки, поддерживает
+keep-alive и считает открытые соединения. Без внешних зависимостей.
+
+Запуск отдельно:
+    python benchmarks/stub_openai.py --port 8089 --latency-ms 300
+затем, например:
+    OPENAI_API_URL=http://127.0.0.1:8089/v1 ...
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Optional
+
+STUB_TURN = {
+    "message_to_user": "Сейчас мы проведем интерактивный тест по теме. Вопрос 1: Что такое stub?",
+    "current_question_number": 1,
+    "total_questions_in_test": 3,
+    "is_final_summary": 0,
+    "previous_answer_correct": -1,
+    "detected_topic": "Stub",
+}
+
+
+class StubOpenAIServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 200.0,
+                 jitter_ms: float = 0.0, invalid_json_rate: float = 0.0, truncated_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.invalid_json_rate = invalid_json_rate
+        self.truncated_rate = truncated_rate
+        self.connections_opened = 0
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.requests_served = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections_opened += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                payload = await self._respond(body)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode("ascii")
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, body: bytes) -> bytes:
+        self.active_requests += 1
+        self.max_active_requests = max(self.max_active_requests, self.active_requests)
+        try:
+            delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+            await asyncio.sleep(delay / 1000)
+        finally:
+            self.active_requests -= 1
+        self.requests_served += 1
+
+        try:
+            request = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            request = {}
+        prompt_chars = len(json.dumps(request.get("messages", []), ensure_ascii=False))
+
+        content = json.dumps(STUB_TURN, ensure_ascii=False)
+        finish_reason = "stop"
+        roll = random.random()
+        if roll < self.truncated_rate:
+            content, finish_reason = content[: len(content) // 2], "length"
+        elif roll < self.truncated_rate + self.invalid_json_rate:
+            content = "Вот ваш тест: " + content.replace('"is_final_summary": 0', '"is_final_summary": 0,')
+
+        response = {
+            "id": f"stub-{self.requests_served}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (prompt_chars + len(content)) // 4,
+            },
+        }
+        return json.dumps(response, ensure_ascii=False).encode("utf-8")
+
+
+async def _serve_forever(args):
+    server = await StubOpenAIServer(
+        port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        invalid_json_rate=args.invalid_json_rate, truncated_rate=args.truncated_rate
+    ).start()
+    print(f"Stub OpenAI API listening on {server.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0)
+    parser.add_argument("--truncated-rate", type=float, default=0.0)
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,112 @@
+"""
+Запись запросов к LLM в JSONL-корпус для последующего сравнения моделей (см. zadavalnik.replay).
+
+Перед записью из сообщений удаляются персональные данные: email, телефоны, ссылки,
+@упоминания и длинные числовые последовательности; изображения заменяются заглушкой.
+Системный промпт пишется как есть - он статичен.
+
+Вместе с сообщениями пишутся kind, max_tokens и response_format запроса, чтобы replay повторял
+его с теми же параметрами. Очистка и запись идут в отдельном потоке, а не в цикле событий.
+"""
+import json
+import logging
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PLACEHOLDER = "[изображение удалено при записи]"
+
+_REDACTIONS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "[email]"),
+    (re.compile(r"https?://\S+|www\.\S+"), "[url]"),
+    (re.compile(r"(?<!\w)@\w{3,}"), "[username]"),
+    (re.compile(r"\+?\d[\d\s()-]{8,}\d"), "[phone]"),
+    (re.compile(r"\d{6,}"), "[number]"),
+]
+
+
+def redact_text(text: str) -> str:
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_messages(messages: List[Dict]) -> List[Dict]:
+    """Копия сообщений без персональных данных. Исходные словари не изменяются."""
+    redacted = []
+    for message in messages:
+        content = message.get("content")
+        if message.get("role") == "system" or content is None:
+            redacted.append(dict(message))
+            continue
+        if isinstance(content, str):
+            redacted.append({**message, "content": redact_text(content)})
+            continue
+        parts = []
+        for part in content:
+            if part.get("type") == "text":
+                parts.append({"type": "text", "text": redact_text(part.get("text", ""))})
+            else:
+                parts.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+        redacted.append({**message, "content": parts})
+    return redacted
+
+
+class ConversationRecorder:
+    """Дописывает в JSONL-файл по строке на каждый запрос к LLM (в одном фоновом потоке, по порядку)."""
+
+    def __init__(self, path: str, sample_rate: float = 1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-capture")
+
+    def record(self, model: str, messages: List[Dict], kind: Optional[str] = None,
+               max_tokens: Optional[int] = None, response_format: Optional[Dict] = None):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        entry = {
+            "ts": time.time(),
+            "model": model,
+            "kind": kind,
+            "max_tokens": max_tokens,
+            "response_format": response_format,
+        }
+        # Копия списка: история дополняется после запроса, а сами сообщения не изменяются
+        self._executor.submit(self._write, entry, list(messages))
+
+    def _write(self, entry: Dict, messages: List[Dict]):
+        entry["messages"] = redact_messages(messages)
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to write LLM capture record to {self.path}: {e}")
+
+    def close(self):
+        """Дожидается записи всех поставленных в очередь строк."""
+        self._executor.shutdown(wait=True)
+
+
+def load_corpus(path: str, limit: Optional[int] = None) -> List[Dict]:
+    """Читает записанный корпус; битые строки пропускаются."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed corpus line in {path}")
+                continue
+            if limit and len(records) >= limit:
+                break
+    return records
@@ -0,0 +1,197 @@
+"""
+Конспект большого документа в стиле map-reduce: документ делится на разделы, факты из разделов
+извлекаются параллельно (не больше DOCUMENT_DIGEST_CONCURRENCY запросов на документ),
+а тест создается по объединенному конспекту.
+
+Границы разделов определяются содержимым (content-defined chunking): раздел заканчивается на абзаце,
+хеш которого попал в "маску", поэтому правка в начале документа меняет только соседние разделы,
+а не сдвигает все последующие. Факты каждого раздела кэшируются в БД по хешу его текста
+(вместе с моделью и промптом), и повторная загрузка или правленый документ обрабатывают только
+изменившиеся разделы.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from typing import TYPE_CHECKING, List, Optional
+
+from zadavalnik.ai import prompts
+from zadavalnik.config import get_settings
+from zadavalnik.database.db import get_db_session, get_cached_chunk_facts, save_chunk_facts
+from zadavalnik.tracing import span
+
+if TYPE_CHECKING:
+    from zadavalnik.ai.openai_client import OpenAIClient
+
+logger = logging.getLogger(__name__)
+
+# Абзац завершает раздел, если младшие биты его хеша нулевые: в среднем каждый CUT_DIVISOR-й абзац
+CUT_DIVISOR = 4
+MAX_REDUCE_LEVELS = 3
+
+_PARAGRAPH_SPLIT = re.compile(r"\n\s*\n")
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?…])\s+")
+_PROMPT_FINGERPRINT = hashlib.sha256(prompts.FACTS_SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+
+def _word_count(text: str) -> int:
+    return len(text.split())
+
+
+def _split_long_paragraph(paragraph: str, max_words: int) -> List[str]:
+    """Слишком длинный абзац режется по предложениям, а без знаков препинания - по словам."""
+    pieces, current, current_words = [], [], 0
+    for sentence in _SENTENCE_SPLIT.split(paragraph):
+        words = sentence.split()
+        while len(words) > max_words:
+            if current:
+                pieces.append(" ".join(current))
+                current, current_words = [], 0
+            pieces.append(" ".join(words[:max_words]))
+            words = words[max_words:]
+        if current_words + len(words) > max_words and current:
+            pieces.append(" ".join(current))
+            current, current_words = [], 0
+        if words:
+            current.append(" ".join(words))
+            current_words += len(words)
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def _is_cut_point(paragraph: str) -> bool:
+    digest = hashlib.blake2b(" ".join(paragraph.split()).encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % CUT_DIVISOR == 0
+
+
+def split_into_sections(text: str, min_words: int, max_words: int) -> List[str]:
+    """Делит документ на разделы от min_words до max_words слов по границам абзацев."""
+    paragraphs = []
+    for paragraph in _PARAGRAPH_SPLIT.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if _word_count(paragraph) > max_words:
+            paragraphs.extend(_split_long_paragraph(paragraph, max_words))
+        else:
+            paragraphs.append(paragraph)
+
+    sections, current, current_words = [], [], 0
+    for paragraph in paragraphs:
+        words = _word_count(paragraph)
+        if current and current_words + words > max_words:
+            sections.append("\n\n".join(current))
+            current, current_words = [], 0
+        current.append(paragraph)
+        current_words += words
+        if current_words >= min_words and _is_cut_point(paragraph):
+            sections.append("\n\n".join(current))
+            current, current_words = [], 0
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+def chunk_hash(section_text: str, model: str) -> str:
+    """Ключ кэша: текст раздела (без учета пробелов), модель и версия промпта извлечения фактов."""
+    normalized = " ".join(section_text.split())
+    return hashlib.sha256(f"{model}\0{_PROMPT_FINGERPRINT}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def _format_fact_sheet(section_facts: List[List[str]]) -> str:
+    blocks = []
+    for index, facts in enumerate(section_facts, start=1):
+        if facts:
+            blocks.append(f"Раздел {index}:\n" + "\n".join(f"- {fact}" for fact in facts))
+    return "\n\n".join(blocks)
+
+
+class DocumentDigester:
+    """Строит конспект (fact sheet) большого документа через OpenAIClient."""
+
+    def __init__(self, openai_client: OpenAIClient):
+        settings = get_settings()
+        self.openai_client = openai_client
+        self.min_words = settings.DOCUMENT_SECTION_MIN_WORDS
+        self.max_words = settings.DOCUMENT_SECTION_MAX_WORDS
+        self.concurrency = settings.DOCUMENT_DIGEST_CONCURRENCY
+        self.fact_sheet_max_words = settings.DOCUMENT_FACT_SHEET_MAX_WORDS
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def sections(self, text: str) -> List[str]:
+        return split_into_sections(text, self.min_words, self.max_words)
+
+    async def digest(self, text: str) -> Optional[str]:
+        """Конспект документа или None, если не удалось обработать большую часть разделов."""
+        sections = self.sections(text)
+        hashes = [chunk_hash(section, self.openai_client.model) for section in sections]
+        async for db in get_db_session():
+            cached = await get_cached_chunk_facts(db, hashes)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        total = len(sections)
+
+        async def extract(index: int, section: str) -> Optional[List[str]]:
+            async with semaphore:
+                with span("digest.section", index=index, words=_word_count(section)):
+                    return await self.openai_client.extract_section_facts(section, index, total)
+
+        missing = [i for i, h in enumerate(hashes) if h not in cached]
+        self.cache_hits += total - len(missing)
+        self.cache_misses += len(missing)
+        logger.info(f"Digesting document: {total} sections, {total - len(missing)} cached, {len(missing)} to extract")
+
+        extracted = await asyncio.gather(*(extract(i + 1, sections[i]) for i in missing))
+
+        section_facts: List[List[str]] = [json.loads(cached[h]) if h in cached else [] for h in hashes]
+        new_rows, failed = [], 0
+        for i, facts in zip(missing, extracted):
+            if facts is None:
+                failed += 1
+                continue
+            section_facts[i] = facts
+            new_rows.append({"chunk_hash": hashes[i], "facts": json.dumps(facts, ensure_ascii=False),
+                             "words": _word_count(sections[i])})
+        if new_rows:
+            async for db in get_db_session():
+                await save_chunk_facts(db, new_rows)
+        if failed:
+            logger.warning(f"Failed to extract facts from {failed} of {total} document sections")
+        if failed * 2 > total:
+            return None
+
+        fact_sheet = _format_fact_sheet(section_facts)
+        return await self._reduce(fact_sheet, section_facts)
+
+    async def _reduce(self, fact_sheet: str, section_facts: List[List[str]]) -> str:
+        """Если конспект сам не помещается в запрос - сжимает его группами разделов, до MAX_REDUCE_LEVELS раз."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        for level in range(MAX_REDUCE_LEVELS):
+            if _word_count(fact_sheet) <= self.fact_sheet_max_words:
+                return fact_sheet
+            groups, current, current_words = [], [], 0
+            for facts in section_facts:
+                words = sum(_word_count(fact) for fact in facts)
+                if current and current_words + words > self.fact_sheet_max_words:
+                    groups.append(current)
+                    current, current_words = [], 0
+                current.extend(facts)
+                current_words += words
+            if current:
+                groups.append(current)
+
+            async def merge(facts: List[str]) -> List[str]:
+                async with semaphore:
+                    merged = await self.openai_client.merge_facts("\n".join(f"- {fact}" for fact in facts))
+                return merged or facts
+
+            with span("digest.reduce", level=level + 1, groups=len(groups)):
+                section_facts = list(await asyncio.gather(*(merge(group) for group in groups)))
+            fact_sheet = _format_fact_sheet(section_facts)
+            logger.info(f"Reduced fact sheet to {_word_count(fact_sheet)} words ({len(groups)} groups, level {level + 1})")
+        return fact_sheet
@@ -1,160 +1,311 @@
+import asyncio
 import json
 import logging
-from typing import List, Dict, Optional, Tuple
-from openai import AsyncOpenAI
+import time
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 
-from zadavalnik.config.settings import settings # Убедитесь, что импорт settings корректен
+from zadavalnik.ai import prompts
+from zadavalnik.ai.capture import ConversationRecorder
+from zadavalnik.ai.schema import TEST_TURN_RESPONSE_FORMAT, repair_json, validate_turn
+from zadavalnik.config import get_settings
+from zadavalnik.tracing import span, traced
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
 
 logger = logging.getLogger(__name__)
 
-class OpenAIClient:
-    def __init__(self, api_key: str, model_name: str = settings.OPENAI_MODEL):
-        self.client = AsyncOpenAI(api_key=api_key, base_url=settings.OPENAI_API_URL)
-        self.model = model_name
-
-    def _get_system_prompt_for_test(self, topic: str, history: Optional[List[Dict]] = None) -> str:
-        return f"""
-        Ты — бот Zadavalnik помощник для повторения материала.
-        Проводящишь интерактивное тестирование по теме: "{topic}".
-
-        Твоя задача — задавать вопросы пользователю один за другим.
-        Тест должен состоять из нескольких вопросов (например, 3-5, определи это сам в первом сообщении).
-
-        В начале первого вопроса сообщи "Сейчас мы проведем интерактивный тест по [тема теста]" и количество вопросов.
-
-        Когда ты получил ответ пользователя на вопрос, ты должен:
-        ## 1
-        Если ответ пользователя хоть как-то связан с вопросом: 
-            Дать на него краткий комментарий: (правильно/неправильно, дай короткое пояснение при необходимости).
-        Если же пользователь отвечает не по теме вопроса или говорит, что не знает, забыл, простит сказать ответ.
-            Просто дать ответ ответ на вопрос без комментариев.
-        ## 2
-        В этом же сообщении (через строку) пиши текст СЛЕДУЮЩЕГО вопроса.
-        
-        ВАЖНО: Ты ДОЛЖЕН форматировать КАЖДОЕ свое сообщение пользователю как JSON объект.
-        Этот JSON объект должен содержать следующие поля:
-        - "message_to_user": (string) Текст сообщения для пользователя. Это то, что увидит пользователь.
-        - "current_question_number": (integer) Текущий порядковый номер ЗАДАВАЕМОГО вопроса. Начинается с 1 для первого вопроса, 2 для второго и т.д. Если ты комментируешь ответ на вопрос N и затем задаешь вопрос N+1, current_question_number должен быть N+1.
-        - "total_questions_in_test": (integer) Общее количество вопросов, которое ты планируешь задать в этом тесте. Должно быть установлено в первом вызове и не меняться.
-        - "is_final_summary": (integer) Установи в 1, если это финальное сообщение с подведением итогов теста. В остальных случаях 0.
-
-        Пример твоего ответа:
-        {{
-            "message_to_user": "Верно! Молодец.\\n\\nСледующий вопрос: Как называется столица Франции?",
-            "current_question_number": 2,
-            "total_questions_in_test": 3,
-            "is_final_summary": 0
-        }}
-
-        Еще пример (финальное резюме):
-        {{
-            "message_to_user": "Тест завершен. Вы ответили правильно на 2 из 3 вопросов. Стоит повторить тему X.",
-            "current_question_number": 3, 
-            "total_questions_in_test": 3,
-            "is_final_summary": 1
-        }}
-                
-        - Поле 'total_questions_in_test' должно быть заполнено с первого же сообщения и оставаться консистентным.
-        - Поле 'current_question_number' должно корректно инкрементироваться для каждого НОВОГО вопроса. 
-        - Поле 'is_final_summary' должно быть 1 ТОЛЬКО для самого последнего сообщения, завершающего тест.
-        
-        Если это был последний вопрос: 
-        - предоставь краткое резюме в 'message_to_user': На какие вопросы пользователь ответил верно, а какие темы стоит повторить.
-        - Если были неточности в формулировках ответов пользователя, укажи на них.
+def build_http_client(max_connections: int, max_keepalive_connections: int, keepalive_expiry: float,
+                      http2: bool, connect_timeout: float, read_timeout: float,
+                      write_timeout: float, pool_timeout: float) -> "httpx.AsyncClient":
+    """httpx-клиент с явно заданным пулом соединений и таймаутами для AsyncOpenAI."""
+    import httpx
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout
+        ),
+        http2=http2,
+    )
+
+def parse_assistant_json(content_to_parse: str) -> Optional[Dict]:
+    """Разбирает JSON из ответа модели; испорченный или обрезанный JSON чинится локально (schema.repair_json)."""
+    parsed_data, repaired = repair_json(content_to_parse)
+    if parsed_data is None:
+        logger.error(f"OpenAIClient: Could not parse or repair JSON in content (len={len(content_to_parse)}): >>>{content_to_parse}<<<")
+    elif repaired:
+        logger.warning(f"OpenAIClient: Repaired malformed JSON in content (len={len(content_to_parse)})")
+    return parsed_data
+
+def _facts_from_response(parsed_data: Optional[Dict]) -> Optional[List[str]]:
+    """Список фактов из ответа {"facts": [...]}; None, если поле отсутствует или пусто."""
+    facts = parsed_data.get("facts") if parsed_data else None
+    if not isinstance(facts, list):
+        return None
+    facts = [str(fact).strip() for fact in facts if str(fact).strip()]
+    return facts or None
+
+def _plan_from_response(parsed_data: Optional[Dict], fallback_topic: str) -> Optional[Dict]:
+    """План теста {"topic", "questions": [{"question", "answer"}]}; None, если вопросов нет."""
+    if not parsed_data or not isinstance(parsed_data.get("questions"), list):
+        return None
+    questions = [
+        {"question": str(item["question"]).strip(), "answer": str(item.get("answer", "")).strip()}
+        for item in parsed_data["questions"]
+        if isinstance(item, dict) and str(item.get("question", "")).strip()
+    ]
+    if not questions:
+        return None
+    return {"topic": str(parsed_data.get("topic") or fallback_topic)[:60], "questions": questions}
+
+class PromptCacheStats:
+    """Статистика автоматического кэширования промптов по response.usage."""
+
+    LOG_EVERY_CALLS = 50
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.hit_calls = 0
+        self.hit_latency_total = 0.0
+        self.miss_latency_total = 0.0
+
+    def record(self, usage, latency: float):
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        if cached_tokens:
+            self.hit_calls += 1
+            self.hit_latency_total += latency
+        else:
+            self.miss_latency_total += latency
+
+        logger.debug("OpenAIClient: prompt_tokens=%s, cached_tokens=%s, latency=%.2fs", prompt_tokens, cached_tokens, latency)
+        if self.calls % self.LOG_EVERY_CALLS == 0:
+            logger.info(f"Prompt cache stats: {self.snapshot()}")
+
+    def snapshot(self) -> Dict:
+        miss_calls = self.calls - self.hit_calls
+        return {
+            "calls": self.calls,
+            "cache_hit_calls": self.hit_calls,
+            "cached_token_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            "avg_latency_hit_s": round(self.hit_latency_total / self.hit_calls, 3) if self.hit_calls else None,
+            "avg_latency_miss_s": round(self.miss_latency_total / miss_calls, 3) if miss_calls else None,
+        }
+
+class StructuredOutputStats:
+    """Статистика разбора ответов: сколько пришлось чинить, повторять и сколько ходов сохранено."""
+
+    LOG_EVERY_CALLS = 50
+
+    def __init__(self):
+        self.calls = 0
+        self.parse_failures = 0 # Ответ не разобрался как JSON (или не прошел схему) с первого раза
+        self.repaired = 0 # ...но был починен локально, без запроса
+        self.retries = 0 # ...не починен: дешевый повторный запрос
+        self.retry_successes = 0
+        self.failed = 0 # Пользователю пришлось отвечать заново
+        self.empty_responses = 0
+
+    def record(self, outcome: str):
+        self.calls += 1
+        if outcome == "empty":
+            self.empty_responses += 1
+            self.failed += 1
+        elif outcome != "ok":
+            self.parse_failures += 1
+            if outcome == "repaired":
+                self.repaired += 1
+            elif outcome in ("retried", "failed_after_retry"):
+                self.retries += 1
+                if outcome == "retried":
+                    self.retry_successes += 1
+                else:
+                    self.failed += 1
+            else:
+                self.failed += 1
+        if self.calls % self.LOG_EVERY_CALLS == 0:
+            logger.info(f"Structured output stats: {self.snapshot()}")
+
+    def snapshot(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "parse_failures": self.parse_failures,
+            "parse_failure_rate": round(self.parse_failures / self.calls, 3) if self.calls else 0.0,
+            "repaired": self.repaired,
+            "repair_rate": round(self.repaired / self.parse_failures, 3) if self.parse_failures else None,
+            "retries": self.retries,
+            "retry_successes": self.retry_successes,
+            "failed": self.failed,
+            "empty_responses": self.empty_responses,
+            # Раньше каждый такой ответ стоил пользователю повторного хода (полного запроса с историей)
+            "round_trips_saved": self.repaired + self.retry_successes,
+        }
 
-        Веди диалог последовательно. Твой ответ должен быть ТОЛЬКО JSON объектом, без какого-либо другого текста до или после него.
+class OpenAIClient:
+    def __init__(self, api_key: str, model_name: Optional[str] = None, base_url: Optional[str] = None):
+        settings = get_settings()
+        self.api_key = api_key
+        self.model = model_name or settings.OPENAI_MODEL
+        self.base_url = base_url or settings.OPENAI_API_URL
+        self._client: Optional["AsyncOpenAI"] = None
+        self.cache_stats = PromptCacheStats()
+        self.output_stats = StructuredOutputStats()
+        # Отключается при первом отказе провайдера принять response_format с JSON Schema
+        self.structured_outputs = settings.OPENAI_STRUCTURED_OUTPUTS
+        self.log_payloads = settings.LLM_LOG_PAYLOADS
+        # Запись запросов для сравнения моделей (python -m zadavalnik.replay)
+        self.recorder: Optional[ConversationRecorder] = None
+        if settings.LLM_CAPTURE_PATH:
+            self.recorder = ConversationRecorder(settings.LLM_CAPTURE_PATH, settings.LLM_CAPTURE_SAMPLE_RATE)
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """HTTP-клиент OpenAI создается (и пакет openai импортируется) при первом запросе."""
+        if self._client is None:
+            from openai import AsyncOpenAI
+            settings = get_settings()
+            http_client = build_http_client(
+                max_connections=settings.OPENAI_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=settings.OPENAI_HTTP_KEEPALIVE_EXPIRY,
+                http2=settings.OPENAI_HTTP2,
+                connect_timeout=settings.OPENAI_CONNECT_TIMEOUT,
+                read_timeout=settings.OPENAI_READ_TIMEOUT,
+                write_timeout=settings.OPENAI_WRITE_TIMEOUT,
+                pool_timeout=settings.OPENAI_POOL_TIMEOUT,
+            )
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client)
+        return self._client
+
+    async def close(self):
+        """Закрывает HTTP-пул, если клиент успел создаться, и дописывает корпус записи."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self.recorder:
+            await asyncio.to_thread(self.recorder.close)
+
+    async def _create_completion(self, messages: List[Dict], max_tokens: int, test_turn: bool, kind: str):
+        """Запрос к API; для хода теста - structured outputs по схеме TestTurn, если модель их поддерживает."""
+        use_schema = test_turn and self.structured_outputs
+        response_format = TEST_TURN_RESPONSE_FORMAT if use_schema else {"type": "json_object"}
+        try:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                response_format=response_format,
+                max_tokens=max_tokens,
+            )
+        except Exception as e:
+            from openai import BadRequestError
+            if use_schema and isinstance(e, BadRequestError) and "response_format" in str(e):
+                self.structured_outputs = False
+                logger.warning(f"Model {self.model} does not support json_schema response_format, falling back to json_object: {e}")
+                return await self._create_completion(messages, max_tokens, test_turn, kind)
+            self._capture(messages, max_tokens, response_format, kind)
+            raise
+        self._capture(messages, max_tokens, response_format, kind)
+        return response
+
+    def _capture(self, messages: List[Dict], max_tokens: int, response_format: Dict, kind: str):
+        """Запись запроса с параметрами, с которыми он фактически отправлен (для replay)."""
+        if self.recorder:
+            self.recorder.record(self.model, messages, kind=kind, max_tokens=max_tokens, response_format=response_format)
+
+    async def _retry_turn_format(self, broken_content: str) -> Optional[Dict]:
+        """Один дешевый повтор: модель переписывает испорченный ответ в JSON по схеме, без истории теста."""
+        with span("llm.retry_format", chars=len(broken_content)):
+            try:
+                response = await self._create_completion(prompts.turn_fix_messages(broken_content), 1500,
+                                                         test_turn=True, kind="turn_fix")
+            except Exception:
+                logger.error("Exception in _retry_turn_format during API request", exc_info=True)
+                return None
+            content = response.choices[0].message.content
+            if not content:
+                return None
+            if response.choices[0].finish_reason == "length":
+                return None
+            return validate_turn(repair_json(content, allow_truncated=False)[0])
+
+    @traced("llm.call")
+    async def _make_openai_call(self, current_messages_for_api: List[Dict], max_tokens: int = 3000,
+                                test_turn: bool = False) -> Tuple[Optional[Dict], List[Dict]]:
         """
-
-
-    async def _make_openai_call(self, current_messages_for_api: List[Dict]) -> Tuple[Optional[Dict], List[Dict]]:
-        logger.debug(f"OpenAIClient: Sending messages to API: {json.dumps(current_messages_for_api, indent=2, ensure_ascii=False)}")
+        Запрос к модели и разбор JSON из ответа. test_turn - ответ является ходом теста: он проверяется
+        по схеме TestTurn, а если не разобрался даже после локального ремонта - повторяется один раз
+        дешевым запросом без истории.
+        """
+        if self.log_payloads and logger.isEnabledFor(logging.DEBUG):
+            # Сериализация всей истории (с изображениями) дорогая - только по явному LLM_LOG_PAYLOADS
+            logger.debug("OpenAIClient: Sending messages to API: %s", json.dumps(current_messages_for_api, ensure_ascii=False))
         
         final_history_after_call = list(current_messages_for_api)
         parsed_data: Optional[Dict] = None
 
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=current_messages_for_api,
-                response_format={"type": "json_object"}, 
-                max_tokens=3000,
-            )
+            started_at = time.perf_counter()
+            with span("llm.request", model=self.model, structured=test_turn and self.structured_outputs) as request_span:
+                response = await self._create_completion(current_messages_for_api, max_tokens, test_turn,
+                                                         kind="test_turn" if test_turn else "json")
+            self.cache_stats.record(response.usage, time.perf_counter() - started_at)
             
             response_message = response.choices[0].message
             finish_reason = response.choices[0].finish_reason
+            request_span.set(finish_reason=finish_reason)
+            if response.usage:
+                request_span.set(
+                    prompt_tokens=response.usage.prompt_tokens,
+                    completion_tokens=response.usage.completion_tokens,
+                )
             assistant_response_content = response_message.content
             
             # Проверяем, был ли ответ обрезан
             if finish_reason == "length":
                 logger.warning(f"OpenAI response was truncated due to token limit. Consider increasing max_tokens or reducing context.")
             
-            assistant_message_dict_for_history = {"role": "assistant", "content": assistant_response_content}
-            final_history_after_call.append(assistant_message_dict_for_history)
-
-            if assistant_response_content:
-                logger.debug(f"OpenAIClient: Raw assistant_response_content before parsing (len={len(assistant_response_content)}): >>>{assistant_response_content}<<<")
-                
-                content_to_parse = assistant_response_content.strip()
-
-                try:
-                    parsed_data = json.loads(content_to_parse)
-                    logger.debug(f"OpenAIClient: Successfully parsed directly (after strip): {parsed_data}")
-                except json.JSONDecodeError as e_direct:
-                    logger.warning(
-                        f"OpenAIClient: Direct JSON parsing failed for content (len={len(content_to_parse)}): "
-                        f">>>{content_to_parse}<<< Error: {e_direct}. Will attempt to extract JSON block."
-                    )
-                    
-                    json_start = content_to_parse.find('{')
-                    json_end = content_to_parse.rfind('}') + 1
-                    
-                    if json_start != -1 and json_end > json_start:
-                        json_str_extracted = content_to_parse[json_start:json_end]
-                        logger.debug(
-                            f"OpenAIClient: Extracted JSON string for parsing (len={len(json_str_extracted)}): "
-                            f">>>{json_str_extracted}<<<"
-                        )
-                        try:
-                            parsed_data = json.loads(json_str_extracted)
-                            logger.debug(f"OpenAIClient: Successfully parsed after extraction: {parsed_data}")
-                        except json.JSONDecodeError as e_extracted:
-                            logger.error(
-                                f"OpenAIClient: Failed to parse extracted JSON string: >>>{json_str_extracted}<<<", 
-                                exc_info=True
-                            )
-                            logger.error(f"JSONDecodeError details: msg='{e_extracted.msg}', doc_len={len(e_extracted.doc)}, pos={e_extracted.pos}")
-                            
-                            context_window = 20
-                            start_idx = max(0, e_extracted.pos - context_window)
-                            end_idx = min(len(e_extracted.doc), e_extracted.pos + context_window + 5)
-                            
-                            error_context_raw = e_extracted.doc[start_idx:end_idx]
-                            error_context_repr = repr(error_context_raw)
-                            error_context_bytes = error_context_raw.encode('utf-8', errors='surrogatepass')
-
-                            logger.error(f"Context around error position ({e_extracted.pos}) (raw): >>>{error_context_raw}<<<")
-                            logger.error(f"Context around error position ({e_extracted.pos}) (repr): >>>{error_context_repr}<<<")
-                            logger.error(f"Context around error position ({e_extracted.pos}) (bytes): >>>{error_context_bytes}<<<")
-
-                            if e_extracted.pos < len(e_extracted.doc):
-                                char_at_error = e_extracted.doc[e_extracted.pos]
-                                byte_at_error_char = char_at_error.encode('utf-8', errors='surrogatepass')
-                                logger.error(f"Character at error position ({e_extracted.pos}): '{char_at_error}' (ASCII/Unicode: {ord(char_at_error)}), Bytes: {byte_at_error_char}")
-                            else:
-                                logger.error(f"Error position ({e_extracted.pos}) is at or beyond the end of the document (len: {len(e_extracted.doc)}).")
-                    else:
-                        logger.error(f"OpenAIClient: Could not find JSON block ({{...}}) in content: >>>{content_to_parse}<<<")
-            else:
+            if not assistant_response_content:
+                # Раньше здесь подставлялось фиктивное "итоговое" сообщение, завершавшее тест
                 logger.warning(f"OpenAIClient: AI response had no content. Finish reason: {finish_reason}")
-                # Если ответ был обрезан, возвращаем специальное сообщение
-                if finish_reason == "length":
-                    parsed_data = {
-                        "message_to_user": "Извините, произошла ошибка при генерации ответа. Попробуйте переформулировать ваш вопрос более кратко.",
-                        "current_question_number": 1,
-                        "total_questions_in_test": 1,
-                        "is_final_summary": 1
-                    }
-            
+                self.output_stats.record("empty")
+                return None, current_messages_for_api
+
+            logger.debug("OpenAIClient: Raw assistant_response_content before parsing (len=%d): >>>%s<<<",
+                         len(assistant_response_content), assistant_response_content)
+            with span("llm.parse_json", chars=len(assistant_response_content)) as parse_span:
+                # Обрезанный ход теста не дописывается локально: вопрос оборвался бы на полуслове
+                parsed_data, repaired = repair_json(assistant_response_content, allow_truncated=not test_turn)
+                if test_turn:
+                    parsed_data = validate_turn(parsed_data) if finish_reason != "length" else None
+                parse_span.set(ok=parsed_data is not None, repaired=repaired)
+
+            if parsed_data is None:
+                logger.warning(f"OpenAIClient: Could not parse or repair JSON in content (len={len(assistant_response_content)}): >>>{assistant_response_content}<<<")
+                if test_turn:
+                    parsed_data = await self._retry_turn_format(assistant_response_content)
+                    outcome = "retried" if parsed_data is not None else "failed_after_retry"
+                else:
+                    outcome = "failed"
+            else:
+                outcome = "repaired" if repaired else "ok"
+            self.output_stats.record(outcome)
+
+            if outcome in ("repaired", "retried"):
+                # В историю идет исправленный JSON, чтобы модель не продолжала испорченный формат
+                assistant_response_content = json.dumps(parsed_data, ensure_ascii=False)
+            final_history_after_call.append({"role": "assistant", "content": assistant_response_content})
             return parsed_data, final_history_after_call
 
         except Exception as e:
@@ -163,179 +314,88 @@ class OpenAIClient:
 
 
     async def start_test_session(self, topic: str) -> Tuple[Optional[Dict], List[Dict]]:
-        system_message_content = self._get_system_prompt_for_test(topic)
-        messages_for_api_call = [{"role": "system", "content": system_message_content}]
+        messages_for_api_call = prompts.topic_test_messages(topic)
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
 
 
     async def continue_test_session(self, history: List[Dict], user_message_text: str) -> Tuple[Optional[Dict], List[Dict]]:
         messages_for_api_call = list(history)
-        messages_for_api_call.append({"role": "user", "content": user_message_text})
+        messages_for_api_call.append(prompts.user_message(user_message_text))
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
 
-    def _get_system_prompt_for_image_analysis(self) -> str:
-        return """
-        Ты — бот Zadavalnik помощник для повторения материала.
-        Проводящишь интерактивное тестирование по теме: "{Тема, связанная с тем, что ты увидел на изображении}".
-
-        Твоя задача — задавать вопросы пользователю один за другим.
-        Тест должен состоять из нескольких вопросов (например, 3-5, определи это сам в первом сообщении).
-
-        В начале первого вопроса сообщи "Сейчас мы проведем интерактивный тест по [тема теста]" и количество вопросов.
-
-        Когда ты получил ответ пользователя на вопрос, ты должен:
-        ## 1
-        Если ответ пользователя хоть как-то связан с вопросом: 
-            Дать на него краткий комментарий: (правильно/неправильно, дай короткое пояснение при необходимости).
-        Если же пользователь отвечает не по теме вопроса или говорит, что не знает, забыл, простит сказать ответ.
-            Просто дать ответ ответ на вопрос без комментариев.
-        ## 2
-        В этом же сообщении (через строку) пиши текст СЛЕДУЮЩЕГО вопроса.
-        
-        ВАЖНО: Ты ДОЛЖЕН форматировать КАЖДОЕ свое сообщение пользователю как JSON объект.
-        Этот JSON объект должен содержать следующие поля:
-        - "message_to_user": (string) Текст сообщения для пользователя. Это то, что увидит пользователь.
-        - "current_question_number": (integer) Текущий порядковый номер ЗАДАВАЕМОГО вопроса. Начинается с 1 для первого вопроса, 2 для второго и т.д. Если ты комментируешь ответ на вопрос N и затем задаешь вопрос N+1, current_question_number должен быть N+1.
-        - "total_questions_in_test": (integer) Общее количество вопросов, которое ты планируешь задать в этом тесте. Должно быть установлено в первом вызове и не меняться.
-        - "is_final_summary": (integer) Установи в 1, если это финальное сообщение с подведением итогов теста. В остальных случаях 0.
-
-        Пример твоего ответа:
-        {{
-            "message_to_user": "Верно! Молодец.\\n\\nСледующий вопрос: Как называется столица Франции?",
-            "current_question_number": 2,
-            "total_questions_in_test": 3,
-            "is_final_summary": 0
-        }}
-
-        Еще пример (финальное резюме):
-        {{
-            "message_to_user": "Тест завершен. Вы ответили правильно на 2 из 3 вопросов. Стоит повторить тему X.",
-            "current_question_number": 3, 
-            "total_questions_in_test": 3,
-            "is_final_summary": 1
-        }}
-                
-        - Поле 'total_questions_in_test' должно быть заполнено с первого же сообщения и оставаться консистентным.
-        - Поле 'current_question_number' должно корректно инкрементироваться для каждого НОВОГО вопроса. 
-        - Поле 'is_final_summary' должно быть 1 ТОЛЬКО для самого последнего сообщения, завершающего тест.
-        
-        Если это был последний вопрос: 
-        - предоставь краткое резюме в 'message_to_user': На какие вопросы пользователь ответил верно, а какие темы стоит повторить.
-        - Если были неточности в формулировках ответов пользователя, укажи на них.
-
-        Веди диалог последовательно. Твой ответ должен быть ТОЛЬКО JSON объектом, без какого-либо другого текста до или после него.
-        """
-
     async def analyze_image_and_start_test(self, image_base64: str, image_format: str = "jpeg") -> Tuple[Optional[Dict], List[Dict]]:
         """Анализ изображения и создание теста на основе его содержимого"""
-        system_message_content = self._get_system_prompt_for_image_analysis()
+        messages_for_api_call = prompts.image_test_messages(image_base64, image_format)
         
-        messages_for_api_call = [
-            {"role": "system", "content": system_message_content},
-            {
-                "role": "user", 
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Проанализируй это изображение и создай тест на основе его содержимого."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{image_format};base64,{image_base64}"
-                        }
-                    }
-                ]
-            }
-        ]
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
+        return parsed_data, updated_history
+
+    async def analyze_images_and_start_test(self, images: List[Tuple[str, str]]) -> Tuple[Optional[Dict], List[Dict]]:
+        """Один тест по нескольким изображениям (альбому): images - список (base64, формат)"""
+        messages_for_api_call = prompts.images_test_messages(images)
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
 
     async def continue_image_test_session(self, history: List[Dict], user_message_text: str) -> Tuple[Optional[Dict], List[Dict]]:
         """Продолжение теста, начатого с изображения"""
         messages_for_api_call = list(history)
-        messages_for_api_call.append({"role": "user", "content": user_message_text})
+        messages_for_api_call.append(prompts.user_message(user_message_text))
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
 
-    def _get_system_prompt_for_text_analysis(self) -> str:
-        return """
-        Ты — бот Zadavalnik помощник для повторения материала.
-        Проводящишь интерактивное тестирование по теме: "{Тема, связанная с содержанием текстового документа}".
-
-        Твоя задача — задавать вопросы пользователю один за другим.
-        Тест должен состоять из нескольких вопросов (например, 3-5, определи это сам в первом сообщении).
-
-        В начале первого вопроса сообщи "Сейчас мы проведем интерактивный тест по [тема теста]" и количество вопросов.
-
-        Когда ты получил ответ пользователя на вопрос, ты должен:
-        ## 1
-        Если ответ пользователя хоть как-то связан с вопросом: 
-            Дать на него краткий комментарий: (правильно/неправильно, дай короткое пояснение при необходимости).
-        Если же пользователь отвечает не по теме вопроса или говорит, что не знает, забыл, простит сказать ответ.
-            Просто дать ответ ответ на вопрос без комментариев.
-        ## 2
-        В этом же сообщении (через строку) пиши текст СЛЕДУЮЩЕГО вопроса.
-        
-        ВАЖНО: Ты ДОЛЖЕН форматировать КАЖДОЕ свое сообщение пользователю как JSON объект.
-        Этот JSON объект должен содержать следующие поля:
-        - "message_to_user": (string) Текст сообщения для пользователя. Это то, что увидит пользователь.
-        - "current_question_number": (integer) Текущий порядковый номер ЗАДАВАЕМОГО вопроса. Начинается с 1 для первого вопроса, 2 для второго и т.д. Если ты комментируешь ответ на вопрос N и затем задаешь вопрос N+1, current_question_number должен быть N+1.
-        - "total_questions_in_test": (integer) Общее количество вопросов, которое ты планируешь задать в этом тесте. Должно быть установлено в первом вызове и не меняться.
-        - "is_final_summary": (integer) Установи в 1, если это финальное сообщение с подведением итогов теста. В остальных случаях 0.
-
-        Пример твоего ответа:
-        {{
-            "message_to_user": "Верно! Молодец.\\n\\nСледующий вопрос: Как называется столица Франции?",
-            "current_question_number": 2,
-            "total_questions_in_test": 3,
-            "is_final_summary": 0
-        }}
-
-        Еще пример (финальное резюме):
-        {{
-            "message_to_user": "Тест завершен. Вы ответили правильно на 2 из 3 вопросов. Стоит повторить тему X.",
-            "current_question_number": 3, 
-            "total_questions_in_test": 3,
-            "is_final_summary": 1
-        }}
-                
-        - Поле 'total_questions_in_test' должно быть заполнено с первого же сообщения и оставаться консистентным.
-        - Поле 'current_question_number' должно корректно инкрементироваться для каждого НОВОГО вопроса. 
-        - Поле 'is_final_summary' должно быть 1 ТОЛЬКО для самого последнего сообщения, завершающего тест.
-        
-        Если это был последний вопрос: 
-        - предоставь краткое резюме в 'message_to_user': На какие вопросы пользователь ответил верно, а какие темы стоит повторить.
-        - Если были неточности в формулировках ответов пользователя, укажи на них.
-
-        Веди диалог последовательно. Твой ответ должен быть ТОЛЬКО JSON объектом, без какого-либо другого текста до или после него.
-        """
-
     async def analyze_text_and_start_test(self, text_content: str) -> Tuple[Optional[Dict], List[Dict]]:
         """Анализ текстового документа и создание теста на основе его содержимого"""
-        system_message_content = self._get_system_prompt_for_text_analysis()
+        messages_for_api_call = prompts.text_test_messages(text_content)
         
-        messages_for_api_call = [
-            {"role": "system", "content": system_message_content},
-            {
-                "role": "user", 
-                "content": f"Проанализируй этот текст и создай тест на основе его содержимого:\n\n{text_content}"
-            }
-        ]
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
+        return parsed_data, updated_history
+
+    async def analyze_fact_sheet_and_start_test(self, fact_sheet: str) -> Tuple[Optional[Dict], List[Dict]]:
+        """Создание теста по конспекту большого документа (см. zadavalnik.ai.document_digest)"""
+        messages_for_api_call = prompts.fact_sheet_test_messages(fact_sheet)
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
 
+    async def extract_section_facts(self, section_text: str, index: int, total: int) -> Optional[List[str]]:
+        """Ключевые факты одного раздела большого документа; None - ответ не удалось разобрать"""
+        parsed_data, _ = await self._make_openai_call(prompts.section_facts_messages(section_text, index, total))
+        return _facts_from_response(parsed_data)
+
+    async def merge_facts(self, facts_text: str) -> Optional[List[str]]:
+        """Сжатие конспекта, который не помещается в один запрос"""
+        parsed_data, _ = await self._make_openai_call(prompts.merge_facts_messages(facts_text))
+        return _facts_from_response(parsed_data)
+
+    async def generate_question_plan(self, topic: str, question_count: int) -> Optional[Dict]:
+        """План теста для класса: {"topic": ..., "questions": [{"question": ..., "answer": ...}]}"""
+        parsed_data, _ = await self._make_openai_call(prompts.question_plan_messages(topic, question_count))
+        return _plan_from_response(parsed_data, topic)
+
+    async def generate_material_plan(self, material: str, question_count: int, title_hint: str) -> Optional[Dict]:
+        """План теста по учебному материалу (python -m zadavalnik.ingest), формат как у generate_question_plan"""
+        parsed_data, _ = await self._make_openai_call(prompts.material_plan_messages(material, question_count, title_hint))
+        return _plan_from_response(parsed_data, title_hint)
+
+    async def grade_answer(self, question: str, reference_answer: str, user_answer: str) -> Optional[Dict]:
+        """Оценка одного ответа по эталону: {"correct": 0/1, "comment": ...}; короткий дешевый запрос"""
+        parsed_data, _ = await self._make_openai_call(
+            prompts.grade_answer_messages(question, reference_answer, user_answer), max_tokens=1000
+        )
+        if not parsed_data or parsed_data.get("correct") not in (0, 1, True, False):
+            return None
+        return {"correct": int(parsed_data["correct"]), "comment": str(parsed_data.get("comment") or "").strip()}
+
     async def continue_text_test_session(self, history: List[Dict], user_message_text: str) -> Tuple[Optional[Dict], List[Dict]]:
         """Продолжение теста, начатого с текстового документа"""
         messages_for_api_call = list(history)
-        messages_for_api_call.append({"role": "user", "content": user_message_text})
+        messages_for_api_call.append(prompts.user_message(user_message_text))
         
-        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call)
+        parsed_data, updated_history = await self._make_openai_call(messages_for_api_call, test_turn=True)
         return parsed_data, updated_history
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""
+Шаблоны промптов для OpenAI.
+
+Провайдер автоматически кэширует совпадающий ПРЕФИКС запроса, поэтому:
+- системный промпт один для всех режимов (тема, изображение, документ) и не содержит
+  переменных частей - он собирается один раз при импорте и побайтно одинаков во всех запросах;
+- все, что зависит от пользователя (тема, изображение, текст документа), добавляется
+  отдельным сообщением в конец.
+"""
+from textwrap import dedent
+from typing import Dict, List, Tuple
+
+SYSTEM_PROMPT = dedent("""
+    Ты — бот Zadavalnik помощник для повторения материала.
+    Ты проводишь интерактивное тестирование по теме, которую пользователь укажет в своем первом сообщении:
+    это может быть название темы, изображение или текст учебного документа.
+
+    Твоя задача — задавать вопросы пользователю один за другим.
+    Тест должен состоять из нескольких вопросов (например, 3-5, определи это сам в первом сообщении).
+
+    В начале первого вопроса сообщи "Сейчас мы проведем интерактивный тест по [тема теста]" и количество вопросов.
+
+    Когда ты получил ответ пользователя на вопрос, ты должен:
+    ## 1
+    Если ответ пользователя хоть как-то связан с вопросом:
+        Дать на него краткий комментарий: (правильно/неправильно, дай короткое пояснение при необходимости).
+    Если же пользователь отвечает не по теме вопроса или говорит, что не знает, забыл, просит сказать ответ.
+        Просто дать ответ на вопрос без комментариев.
+    ## 2
+    В этом же сообщении (через строку) пиши текст СЛЕДУЮЩЕГО вопроса.
+
+    ВАЖНО: Ты ДОЛЖЕН форматировать КАЖДОЕ свое сообщение пользователю как JSON объект.
+    Этот JSON объект должен содержать следующие поля:
+    - "message_to_user": (string) Текст сообщения для пользователя. Это то, что увидит пользователь.
+    - "current_question_number": (integer) Текущий порядковый номер ЗАДАВАЕМОГО вопроса. Начинается с 1 для первого вопроса, 2 для второго и т.д. Если ты комментируешь ответ на вопрос N и затем задаешь вопрос N+1, current_question_number должен быть N+1.
+    - "total_questions_in_test": (integer) Общее количество вопросов, которое ты планируешь задать в этом тесте. Должно быть установлено в первом вызове и не меняться.
+    - "is_final_summary": (integer) Установи в 1, если это финальное сообщение с подведением итогов теста. В остальных случаях 0.
+    - "previous_answer_correct": (integer) 1, если ответ пользователя на предыдущий вопрос верный, 0 — если неверный или пользователь не знает ответа, -1 — если в этом сообщении ответ не оценивается (например, это первый вопрос).
+    - "detected_topic": (string или null) Краткое название темы теста (до 60 символов). Для изображения или документа — тема, которую ты определил по содержимому; null, если тему определить не удалось.
+
+    Пример твоего ответа:
+    {
+        "message_to_user": "Верно! Молодец.\\n\\nСледующий вопрос: Как называется столица Франции?",
+        "current_question_number": 2,
+        "total_questions_in_test": 3,
+        "is_final_summary": 0,
+        "previous_answer_correct": 1,
+        "detected_topic": "География Европы"
+    }
+
+    Еще пример (финальное резюме):
+    {
+        "message_to_user": "Тест завершен. Вы ответили правильно на 2 из 3 вопросов. Стоит повторить тему X.",
+        "current_question_number": 3,
+        "total_questions_in_test": 3,
+        "is_final_summary": 1,
+        "previous_answer_correct": 0,
+        "detected_topic": "География Европы"
+    }
+
+    - Поле 'total_questions_in_test' должно быть заполнено с первого же сообщения и оставаться консистентным.
+    - Поле 'current_question_number' должно корректно инкрементироваться для каждого НОВОГО вопроса.
+    - Поле 'is_final_summary' должно быть 1 ТОЛЬКО для самого последнего сообщения, завершающего тест.
+
+    Если это был последний вопрос:
+    - предоставь краткое резюме в 'message_to_user': На какие вопросы пользователь ответил верно, а какие темы стоит повторить.
+    - Если были неточности в формулировках ответов пользователя, укажи на них.
+
+    Веди диалог последовательно. Твой ответ должен быть ТОЛЬКО JSON объектом, без какого-либо другого текста до или после него.
+""").strip()
+
+# Сообщение собирается один раз: словарь не изменяется, в историю попадает один и тот же объект
+SYSTEM_MESSAGE: Dict = {"role": "system", "content": SYSTEM_PROMPT}
+
+TOPIC_REQUEST_PREFIX = "Проведи тест по теме: "
+IMAGE_REQUEST_TEXT = "Проанализируй это изображение и создай тест на основе его содержимого."
+IMAGES_REQUEST_TEXT = (
+    "Проанализируй эти изображения ({count} шт.) — это страницы одного учебного материала — "
+    "и создай один тест на основе их общего содержимого."
+)
+TEXT_REQUEST_PREFIX = "Проанализируй этот текст и создай тест на основе его содержимого:\n\n"
+
+
+def user_message(text: str) -> Dict:
+    return {"role": "user", "content": text}
+
+
+def topic_test_messages(topic: str) -> List[Dict]:
+    """Начало теста по теме, введенной пользователем."""
+    return [SYSTEM_MESSAGE, user_message(f"{TOPIC_REQUEST_PREFIX}\"{topic}\"")]
+
+
+def images_test_messages(images: List[Tuple[str, str]]) -> List[Dict]:
+    """Начало теста по одному или нескольким изображениям: images - список (base64, формат)."""
+    request_text = IMAGE_REQUEST_TEXT if len(images) == 1 else IMAGES_REQUEST_TEXT.format(count=len(images))
+    content: List[Dict] = [{"type": "text", "text": request_text}]
+    for image_base64, image_format in images:
+        content.append(
+            {"type": "image_url", "image_url": {"url": f"data:image/{image_format};base64,{image_base64}"}}
+        )
+    return [SYSTEM_MESSAGE, {"role": "user", "content": content}]
+
+
+def image_test_messages(image_base64: str, image_format: str = "jpeg") -> List[Dict]:
+    """Начало теста по изображению."""
+    return images_test_messages([(image_base64, image_format)])
+
+
+def text_test_messages(text_content: str) -> List[Dict]:
+    """Начало теста по тексту документа."""
+    return [SYSTEM_MESSAGE, user_message(TEXT_REQUEST_PREFIX + text_content)]
+
+
+# --- Большие документы: конспект по разделам (map) и сжатие конспекта (reduce) ---
+# Отдельный статичный системный промпт: запросы по разделам тоже попадают в кэш префикса
+
+FACTS_SYSTEM_PROMPT = dedent("""
+    Ты помогаешь готовить тест по большому учебному документу. Тебе присылают один раздел документа.
+    Выпиши из раздела ключевые факты, определения, даты, формулы и причинно-следственные связи,
+    по которым можно задавать проверочные вопросы. Каждый факт — одно короткое самостоятельное
+    предложение, понятное без остального текста. Не добавляй того, чего нет в разделе.
+
+    Ответ — ТОЛЬКО JSON объект вида:
+    {
+        "facts": ["Факт 1.", "Факт 2."]
+    }
+""").strip()
+
+FACTS_SYSTEM_MESSAGE: Dict = {"role": "system", "content": FACTS_SYSTEM_PROMPT}
+
+SECTION_FACTS_REQUEST_PREFIX = "Раздел {index} из {total}:\n\n"
+MERGE_FACTS_REQUEST_PREFIX = (
+    "Ниже ключевые факты из нескольких разделов одного документа. Объедини повторы и оставь "
+    "самые важные факты для проверочного теста, сохранив их формулировки:\n\n"
+)
+FACT_SHEET_REQUEST_PREFIX = (
+    "Документ слишком большой, поэтому вместо полного текста тебе дан его конспект — ключевые факты "
+    "по разделам в порядке изложения. Создай тест на основе этого содержимого:\n\n"
+)
+
+
+def section_facts_messages(section_text: str, index: int, total: int) -> List[Dict]:
+    """Извлечение фактов из одного раздела большого документа."""
+    return [FACTS_SYSTEM_MESSAGE, user_message(SECTION_FACTS_REQUEST_PREFIX.format(index=index, total=total) + section_text)]
+
+
+def merge_facts_messages(facts_text: str) -> List[Dict]:
+    """Сжатие конспекта, если он сам не помещается в запрос."""
+    return [FACTS_SYSTEM_MESSAGE, user_message(MERGE_FACTS_REQUEST_PREFIX + facts_text)]
+
+
+def fact_sheet_test_messages(fact_sheet: str) -> List[Dict]:
+    """Начало теста по конспекту большого документа."""
+    return [SYSTEM_MESSAGE, user_message(FACT_SHEET_REQUEST_PREFIX + fact_sheet)]
+
+
+# --- План теста (класс): вопросы генерируются один раз, ответы каждого ученика оцениваются отдельно ---
+
+PLAN_SYSTEM_PROMPT = dedent("""
+    Ты составляешь проверочный тест для класса учеников. Тебе присылают тему (или учебный материал) и число вопросов.
+    Составь вопросы, на которые можно ответить коротко (одним-двумя предложениями), от простых к сложным,
+    и для каждого вопроса — краткий эталонный ответ, по которому учитель проверит ответы учеников.
+
+    Ответ — ТОЛЬКО JSON объект вида:
+    {
+        "topic": "Краткое название темы (до 60 символов)",
+        "questions": [
+            {"question": "Текст вопроса?", "answer": "Эталонный ответ."}
+        ]
+    }
+""").strip()
+
+PLAN_SYSTEM_MESSAGE: Dict = {"role": "system", "content": PLAN_SYSTEM_PROMPT}
+
+GRADE_SYSTEM_PROMPT = dedent("""
+    Ты проверяешь ответ ученика на вопрос теста. Тебе присылают вопрос, эталонный ответ и ответ ученика.
+    Ответ засчитывается, если по смыслу совпадает с эталоном, даже если сформулирован иначе или неполно.
+    Если ученик не знает ответа или отвечает не по теме — ответ неверный.
+
+    Ответ — ТОЛЬКО JSON объект вида:
+    {
+        "correct": 1,
+        "comment": "Краткий комментарий для ученика: верно/неверно и, при необходимости, правильный ответ."
+    }
+    где "correct" — 1, если ответ верный, и 0, если неверный.
+""").strip()
+
+GRADE_SYSTEM_MESSAGE: Dict = {"role": "system", "content": GRADE_SYSTEM_PROMPT}
+
+
+def question_plan_messages(topic: str, question_count: int) -> List[Dict]:
+    """Генерация плана теста по теме."""
+    return [PLAN_SYSTEM_MESSAGE, user_message(f"Тема: \"{topic}\"\nЧисло вопросов: {question_count}")]
+
+
+def material_plan_messages(material: str, question_count: int, title_hint: str) -> List[Dict]:
+    """Генерация плана теста по учебному материалу (офлайн-загрузка курса); title_hint - имя файла."""
+    return [PLAN_SYSTEM_MESSAGE, user_message(
+        f"Учебный материал (файл «{title_hint}»). Вопросы составь только по этому материалу, "
+        f"тему назови по его содержанию.\nЧисло вопросов: {question_count}\n\n{material}"
+    )]
+
+
+def grade_answer_messages(question: str, reference_answer: str, user_answer: str) -> List[Dict]:
+    """Оценка ответа ученика по эталону."""
+    return [GRADE_SYSTEM_MESSAGE, user_message(
+        f"Вопрос: {question}\nЭталонный ответ: {reference_answer}\nОтвет ученика: {user_answer}"
+    )]
+
+
+# --- Повтор хода, если ответ модели не удалось разобрать даже после локального ремонта ---
+# Дешевый запрос: без истории теста, только испорченный ответ
+
+TURN_FIX_SYSTEM_PROMPT = dedent("""
+    Тебе присылают ответ бота-экзаменатора, который должен был быть JSON объектом, но оказался
+    некорректным или обрезанным. Восстанови из него JSON объект с полями:
+    "message_to_user" (string), "current_question_number" (integer), "total_questions_in_test" (integer),
+    "is_final_summary" (integer, 0 или 1), "previous_answer_correct" (integer, -1, 0 или 1),
+    "detected_topic" (string). Текст "message_to_user" сохрани как есть, ничего не добавляй от себя;
+    только если он оборван на полуслове, допиши оборванное предложение (вопрос) коротко и по смыслу.
+    Если значение поля неизвестно, используй 0 для чисел (-1 для "previous_answer_correct") и "" для строк.
+
+    Ответ — ТОЛЬКО JSON объект.
+""").strip()
+
+TURN_FIX_SYSTEM_MESSAGE: Dict = {"role": "system", "content": TURN_FIX_SYSTEM_PROMPT}
+
+
+def turn_fix_messages(broken_content: str) -> List[Dict]:
+    """Восстановление хода теста из ответа, который не удалось разобрать."""
+    return [TURN_FIX_SYSTEM_MESSAGE, user_message(broken_content)]
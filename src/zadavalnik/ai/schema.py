@@ -0,0 +1,171 @@
+"""
+Схема ответа модели в ходе теста и разбор ответов, которые не совсем JSON.
+
+- TestTurn - типизированный ход теста; TEST_TURN_RESPONSE_FORMAT - тот же формат для
+  structured outputs (response_format с JSON Schema), если модель их поддерживает.
+- repair_json() разбирает ответ локально, без повторного запроса: вырезает JSON из
+  markdown-блока и лишнего текста, убирает висячие запятые (вне строк), дописывает кавычки
+  и скобки обрезанного (finish_reason == "length") ответа. Для хода теста обрезанный ответ
+  не чинится (allow_truncated=False): недописанный вопрос нельзя показывать пользователю.
+"""
+import json
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+logger = logging.getLogger(__name__)
+
+MAX_REPAIR_CUTS = 5 # Сколько раз отступать к предыдущей запятой у обрезанного ответа
+
+_CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+
+class TestTurn(BaseModel):
+    """Ход теста: сообщение пользователю и состояние теста (поля описаны в prompts.SYSTEM_PROMPT)."""
+
+    model_config = ConfigDict(extra="ignore")
+
+    message_to_user: str = Field(min_length=1)
+    current_question_number: Optional[int] = None
+    total_questions_in_test: Optional[int] = None
+    is_final_summary: int = Field(default=0, ge=0, le=1)
+    previous_answer_correct: int = Field(default=-1, ge=-1, le=1)
+    detected_topic: Optional[str] = None
+
+    @field_validator("detected_topic")
+    @classmethod
+    def _empty_topic_is_none(cls, value: Optional[str]) -> Optional[str]:
+        # В строгом режиме поле обязательно, и модель часто возвращает "" вместо null
+        value = value.strip() if value else None
+        return value or None
+
+
+# Строгий режим structured outputs требует все поля в required и additionalProperties: false
+TEST_TURN_RESPONSE_FORMAT: Dict = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "test_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "message_to_user": {"type": "string"},
+                "current_question_number": {"type": "integer"},
+                "total_questions_in_test": {"type": "integer"},
+                "is_final_summary": {"type": "integer", "enum": [0, 1]},
+                "previous_answer_correct": {"type": "integer", "enum": [-1, 0, 1]},
+                "detected_topic": {"type": ["string", "null"]},
+            },
+            "required": [
+                "message_to_user", "current_question_number", "total_questions_in_test",
+                "is_final_summary", "previous_answer_correct", "detected_topic",
+            ],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def validate_turn(data: Optional[Dict]) -> Optional[Dict]:
+    """Ход теста, приведенный к схеме (числа из строк, true/false в 1/0); None - не подходит под схему."""
+    if not isinstance(data, dict):
+        return None
+    try:
+        return TestTurn.model_validate(data).model_dump(exclude_none=True)
+    except ValidationError as e:
+        logger.warning(f"Assistant response does not match TestTurn schema: {e.errors(include_url=False)}")
+        return None
+
+
+def _scan(text: str) -> Tuple[List[str], bool, bool, List[int]]:
+    """Незакрытые скобки, открыта ли строка, висит ли "\\" в конце и позиции запятых вне строк."""
+    closers, commas = [], []
+    in_string = escape = False
+    for position, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if closers:
+                closers.pop()
+        elif char == ",":
+            commas.append(position)
+    return closers, in_string, escape, commas
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Убирает запятые перед } и ] вне строк (запятые внутри текста сообщения не трогаются)."""
+    drop = set()
+    for position in _scan(text)[3]:
+        following = text[position + 1:].lstrip()
+        if following[:1] in ("}", "]"):
+            drop.add(position)
+    if not drop:
+        return text
+    return "".join(char for position, char in enumerate(text) if position not in drop)
+
+
+def _close(text: str) -> str:
+    closers, in_string, escape, _ = _scan(text)
+    if in_string:
+        text = (text[:-1] if escape else text) + '"'
+    return _strip_trailing_commas(text.rstrip().rstrip(",") + "".join(reversed(closers)))
+
+
+def _loads_object(text: str) -> Optional[Dict]:
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def repair_json(content: str, allow_truncated: bool = True) -> Tuple[Optional[Dict], bool]:
+    """
+    Разбирает JSON-объект из ответа модели. Возвращает (данные, был_ли_ремонт);
+    (None, False) - ответ не удалось восстановить. allow_truncated=False - обрезанный ответ
+    (незакрытые строки и скобки) не дописывается, а считается неразобранным.
+    """
+    data = _loads_object(content)
+    if data is not None:
+        return data, False
+
+    text = content.strip()
+    fenced = _CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+    start = text.find("{")
+    if start == -1:
+        return None, False
+    text = text[start:]
+    end = text.rfind("}")
+
+    # Лишний текст после объекта и висячие запятые
+    if end != -1:
+        data = _loads_object(_strip_trailing_commas(text[:end + 1]))
+        if data is not None:
+            return data, True
+
+    if not allow_truncated:
+        return None, False
+
+    # Обрезанный ответ: закрываем строку и скобки, при неудаче отступаем к предыдущей запятой
+    data = _loads_object(_close(text))
+    if data is not None:
+        return data, True
+    commas = _scan(text)[3]
+    for position in reversed(commas[-MAX_REPAIR_CUTS:]):
+        data = _loads_object(_close(text[:position]))
+        if data is not None:
+            return data, True
+    return None, False
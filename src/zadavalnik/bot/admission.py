@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, Optional
+
+from zadavalnik.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+WAIT_WINDOW = 1000 # Сколько последних ожиданий в очереди учитывать в перцентилях
+
+
+class Priority(Enum):
+    ANSWER = "answer" # Ход в уже идущем тесте
+    START = "start" # Создание нового теста
+
+
+class AdmissionRejected(Exception):
+    """Очередь новых тестов переполнена: запрос отклонен без обращения к ИИ."""
+
+
+class AdmissionController:
+    """
+    Контроль допуска операций с ИИ (создание теста или ход теста) при перегрузке провайдера:
+    - одновременно выполняется не больше LLM_MAX_IN_FLIGHT операций;
+    - последние LLM_ANSWER_RESERVED_SLOTS слотов доступны только ходам идущих тестов,
+      а освободившийся слот сначала получает ожидающий ход и лишь потом новый тест;
+    - новые тесты ждут в очереди FIFO, о позиции в ней сообщает on_queued;
+    - если в очереди уже LLM_START_QUEUE_SIZE тестов, новый отклоняется (AdmissionRejected).
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None, answer_reserved: Optional[int] = None,
+                 start_queue_size: Optional[int] = None):
+        settings = get_settings()
+        self.max_in_flight = max_in_flight or settings.LLM_MAX_IN_FLIGHT
+        reserved = answer_reserved if answer_reserved is not None else settings.LLM_ANSWER_RESERVED_SLOTS
+        # Хотя бы один слот должен оставаться новым тестам, иначе они не начнутся никогда
+        self.start_limit = max(1, self.max_in_flight - reserved)
+        self.start_queue_size = start_queue_size if start_queue_size is not None else settings.LLM_START_QUEUE_SIZE
+        self.in_flight = 0
+        self._answer_waiters: Deque[asyncio.Future] = deque()
+        self._start_waiters: Deque[asyncio.Future] = deque()
+        self._waits: Deque[float] = deque(maxlen=WAIT_WINDOW)
+        self.admitted = {priority: 0 for priority in Priority}
+        self.queued = {priority: 0 for priority in Priority}
+        self.rejected_starts = 0
+        self.max_start_queue = 0
+
+    def _limit(self, priority: Priority) -> int:
+        return self.max_in_flight if priority is Priority.ANSWER else self.start_limit
+
+    def _can_admit(self, priority: Priority) -> bool:
+        if self._answer_waiters or self.in_flight >= self._limit(priority):
+            return False
+        return priority is Priority.ANSWER or not self._start_waiters
+
+    def _wake(self):
+        """Отдает свободные слоты ожидающим: сначала ходам, затем новым тестам по порядку очереди."""
+        for priority, waiters in ((Priority.ANSWER, self._answer_waiters), (Priority.START, self._start_waiters)):
+            while waiters and self.in_flight < self._limit(priority):
+                if priority is Priority.START and self._answer_waiters:
+                    return
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue # Ожидание отменено
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, priority: Priority, on_queued: Optional[Callable[[int], Any]] = None):
+        """Ждет слот. on_queued(позиция) вызывается, если новый тест встал в очередь."""
+        if self._can_admit(priority):
+            self.in_flight += 1
+            self.admitted[priority] += 1
+            return
+
+        if priority is Priority.START and len(self._start_waiters) >= self.start_queue_size:
+            self.rejected_starts += 1
+            logger.warning(f"LLM start queue is full, rejecting new test. Stats: {self.stats()}")
+            raise AdmissionRejected()
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters = self._answer_waiters if priority is Priority.ANSWER else self._start_waiters
+        waiters.append(waiter)
+        self.queued[priority] += 1
+        if priority is Priority.START:
+            self.max_start_queue = max(self.max_start_queue, len(self._start_waiters))
+            if on_queued is not None:
+                on_queued(len(self._start_waiters))
+        queued_at = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # Слот уже выдан, но ждавший отменен - возвращаем слот
+            else:
+                waiter.cancel()
+                if waiter in waiters:
+                    waiters.remove(waiter)
+            raise
+        self._waits.append(time.monotonic() - queued_at)
+        self.admitted[priority] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority, on_queued: Optional[Callable[[int], Any]] = None):
+        await self.acquire(priority, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict:
+        waits = sorted(self._waits)
+
+        def percentile(fraction: float) -> Optional[float]:
+            if not waits:
+                return None
+            return round(waits[min(len(waits) - 1, int(len(waits) * fraction))], 3)
+
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued_answers": len(self._answer_waiters),
+            "queued_starts": len(self._start_waiters),
+            "max_start_queue": self.max_start_queue,
+            "admitted_answers": self.admitted[Priority.ANSWER],
+            "admitted_starts": self.admitted[Priority.START],
+            "waited_answers": self.queued[Priority.ANSWER],
+            "waited_starts": self.queued[Priority.START],
+            "rejected_starts": self.rejected_starts,
+            "wait_p50_s": percentile(0.5),
+            "wait_p95_s": percentile(0.95),
+        }
@@ -0,0 +1,29 @@
+from typing import Any
+
+from telegram.ext import Application
+
+from zadavalnik.bot.chat_lock import ChatLocks
+from zadavalnik.config import get_settings
+
+
+class ChatSerializedApplication(Application):
+    """
+    Application, в котором апдейты одного чата не обрабатываются одновременно.
+
+    PTB вызывает process_update, уже заняв слот concurrent_updates, поэтому его пул должен вмещать
+    и апдейты, ждущие очереди своего чата (TELEGRAM_WAITING_UPDATES). Сколько апдейтов реально
+    обрабатывается одновременно, ограничивают слоты ChatLocks (TELEGRAM_CONCURRENT_UPDATES).
+    """
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.chat_locks = ChatLocks(get_settings().TELEGRAM_CONCURRENT_UPDATES)
+
+    async def process_update(self, update: object) -> None:
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            async with self.chat_locks.slots:
+                await super().process_update(update)
+            return
+        async with self.chat_locks.hold(chat.id):
+            await super().process_update(update)
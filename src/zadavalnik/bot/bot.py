@@ -2,10 +2,20 @@ import asyncio
 import logging
 from telegram.ext import Application
 
-from zadavalnik.config.settings import settings
+from zadavalnik import tracing
+from zadavalnik.config import load_settings
 from zadavalnik.database.db import init_db
 from zadavalnik.ai.openai_client import OpenAIClient
+from zadavalnik.ai.document_digest import DocumentDigester
 from zadavalnik.bot.handlers import setup_handlers
+from zadavalnik.bot.review_scheduler import ReviewScheduler
+from zadavalnik.bot.request import build_telegram_requests
+from zadavalnik.bot.request_controller import LLMRequestController
+from zadavalnik.bot.session_store import SessionStore
+from zadavalnik.bot.outbox import Outbox
+from zadavalnik.bot.loop_monitor import LoopMonitor
+from zadavalnik.bot.idempotency import UpdateDeduplicator
+from zadavalnik.bot.application import ChatSerializedApplication
 
 # Настройка базового логирования
 logging.basicConfig(
@@ -16,6 +26,19 @@ logger = logging.getLogger(__name__)
 async def main():
     logger.info("Starting bot...")
 
+    # 0. Явная загрузка настроек: ошибка конфигурации видна сразу, а не при импорте модулей
+    try:
+        settings = load_settings()
+    except Exception as e:
+        logger.error(f"Failed to load settings from environment or .env file: {e}")
+        return
+
+    if settings.TRACE_PATH:
+        tracing.configure(
+            settings.TRACE_PATH, sample_rate=settings.TRACE_SAMPLE_RATE, slow_ms=settings.TRACE_SLOW_MS,
+            max_bytes=settings.TRACE_MAX_BYTES, backup_count=settings.TRACE_BACKUP_COUNT
+        )
+
     # 1. Инициализация базы данных
     try:
         await init_db()
@@ -36,12 +59,60 @@ async def main():
         logger.error("BOT_TOKEN not set in environment variables or .env file.")
         return
         
-    application = Application.builder().token(settings.BOT_TOKEN).build()
+    request, get_updates_request = build_telegram_requests(settings)
+    application = (
+        Application.builder()
+        .application_class(ChatSerializedApplication) # Апдейты одного чата - по очереди
+        .token(settings.BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        # Пул PTB включает ждущих очереди своего чата; обработку ограничивает ChatSerializedApplication
+        .concurrent_updates(settings.TELEGRAM_CONCURRENT_UPDATES + settings.TELEGRAM_WAITING_UPDATES)
+        .build()
+    )
 
     # 4. Сохраняем клиент OpenAI в bot_data для доступа из хендлеров
     application.bot_data['openai_client'] = openai_client
+    application.bot_data['llm_controller'] = LLMRequestController()
+    application.bot_data['document_digester'] = DocumentDigester(openai_client)
+    # Все исходящие сообщения идут через очередь с учетом лимитов Telegram
+    outbox = Outbox(application.bot)
+    application.bot_data['outbox'] = outbox
     # Сессии БД будут получаться через get_db_session() в хендлерах
 
+    # 4.1. Хранилище сессий: история в сжатом виде, вытеснение простаивающих сессий по JobQueue
+    session_store = SessionStore()
+    application.bot_data['session_store'] = session_store
+
+    # 4.2. Защита от повторной доставки: обработанные апдейты и offset polling'а из прошлого запуска
+    deduplicator = UpdateDeduplicator()
+    await deduplicator.load()
+    application.bot_data['update_deduplicator'] = deduplicator
+
+    # 4.3. Очередь интервальных повторений: восстанавливаем из БД и тикаем через JobQueue
+    review_scheduler = ReviewScheduler()
+    await review_scheduler.load()
+    application.bot_data['review_scheduler'] = review_scheduler
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            review_scheduler.tick, interval=settings.REVIEW_TICK_SECONDS, first=settings.REVIEW_TICK_SECONDS
+        )
+        application.job_queue.run_repeating(
+            session_store.sweep, interval=settings.SESSION_SWEEP_SECONDS, first=settings.SESSION_SWEEP_SECONDS
+        )
+        application.job_queue.run_repeating(
+            deduplicator.flush, interval=settings.IDEMPOTENCY_FLUSH_SECONDS, first=settings.IDEMPOTENCY_FLUSH_SECONDS
+        )
+    else:
+        logger.warning("JobQueue is not available (install python-telegram-bot[job-queue]). Review reminders, idle session eviction and periodic saving of processed updates are disabled.")
+
+    # 4.4. Монитор задержки цикла событий (и профилирование по /profile)
+    loop_monitor = None
+    if settings.LOOP_MONITOR_ENABLED:
+        loop_monitor = LoopMonitor()
+        loop_monitor.start()
+        application.bot_data['loop_monitor'] = loop_monitor
+
     # 5. Регистрация обработчиков
     setup_handlers(application)
     logger.info("Handlers are set up.")
@@ -50,8 +121,12 @@ async def main():
     try:
         logger.info("Initializing application...")
         await application.initialize()
+        # Апдейты, обработанные до рестарта, подтверждаются до начала polling'а
+        await deduplicator.acknowledge_offset(application.bot)
         logger.info("Starting polling...")
         await application.start()
+        # Апдейты, обработка которых прервалась падением: Telegram их уже не отдаст
+        await deduplicator.replay_pending(application)
         await application.updater.start_polling()
         logger.info("Bot has started successfully. Press Ctrl-C to stop.")
         
@@ -66,8 +141,17 @@ async def main():
         logger.info("Stopping bot...")
         if application.updater and application.updater.running: # Проверка, запущен ли updater
             await application.updater.stop()
+        await outbox.close()
+        if loop_monitor:
+            await loop_monitor.stop()
         await application.stop()
+        try:
+            await deduplicator.flush()
+        except Exception as e:
+            logger.error(f"Failed to save processed updates on shutdown: {e}")
         await application.shutdown()
+        await openai_client.close()
+        tracing.shutdown()
         logger.info("Bot stopped.")
 
 
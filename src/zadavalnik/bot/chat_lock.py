@@ -0,0 +1,116 @@
+"""
+Апдейты одного чата обрабатываются по очереди, разные чаты - параллельно (TELEGRAM_CONCURRENT_UPDATES).
+
+Обработчики читают и меняют user_data (current_state, история, active_test_attempt_id) между await,
+поэтому /newtest, пришедший во время ответа, мог бы испортить сессию. ChatSerializedApplication
+(bot/application.py) держит блокировку чата на время всей обработки апдейта. Модуль не импортирует
+PTB: его используют handlers и request_controller, импорт которых должен оставаться легким.
+
+Исключение - ожидание ИИ: LLMRequestController отпускает блокировку через released(), чтобы
+следующий ответ мог присоединиться к ходу, а /newtest - отменить запрос. После ожидания
+блокировка берется снова, а устаревший результат отбрасывается по поколению (generation).
+
+Слоты обработки (TELEGRAM_CONCURRENT_UPDATES) берутся уже под блокировкой чата и отпускаются
+вместе с ней: апдейты, ждущие своей очереди в чате, слотов не занимают, а обработчик, ждущий
+блокировку обратно после ИИ, не держит слот (иначе он ждал бы апдейт, который ждет слот).
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Dict, Optional
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+class _Hold:
+    """Блокировка чата и слот обработки текущего обработчика (held = False, пока они отпущены)."""
+
+    def __init__(self, lock: asyncio.Lock, slots: Optional[asyncio.Semaphore]):
+        self.lock = lock
+        self.slots = slots
+        self.held = False
+
+    async def acquire(self):
+        # Сначала очередь своего чата, потом слот: ждущий апдейт не занимает слоты других чатов
+        await self.lock.acquire()
+        if self.slots is not None:
+            try:
+                await self.slots.acquire()
+            except BaseException:
+                self.lock.release()
+                raise
+        self.held = True
+
+    def release(self):
+        self.held = False
+        if self.slots is not None:
+            self.slots.release()
+        self.lock.release()
+
+
+_current_hold: ContextVar[Optional[_Hold]] = ContextVar("chat_lock_hold", default=None)
+
+
+class ChatLocks:
+    """
+    Блокировки по chat_id; запись удаляется, когда ее никто не держит и не ждет.
+    slots ограничивает число обработчиков, которые держат блокировку и работают (не ждут ИИ).
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self._locks: Dict[int, list] = {} # chat_id -> [lock, число держащих и ждущих]
+        self.slots: Optional[asyncio.Semaphore] = asyncio.Semaphore(limit) if limit else None
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def is_busy(self, chat_id: int) -> bool:
+        return chat_id in self._locks
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        hold = _Hold(entry[0], self.slots)
+        try:
+            await hold.acquire()
+            token = _current_hold.set(hold)
+            try:
+                yield
+            finally:
+                _current_hold.reset(token)
+        finally:
+            if hold.held: # False, если обработчик отменили, пока он ждал блокировку обратно
+                hold.release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat_id]
+
+
+@asynccontextmanager
+async def released():
+    """Отпускает блокировку чата и слот обработки текущего обработчика на время блока (ожидание ИИ)."""
+    hold = _current_hold.get()
+    if hold is None or not hold.held:
+        yield
+        return
+    hold.release()
+    try:
+        yield
+    finally:
+        await hold.acquire()
+
+
+def hold_chat(application: "Application", chat_id: Optional[int]):
+    """Блокировка чата для кода вне обработки апдейта (job JobQueue)."""
+    locks: Optional[ChatLocks] = getattr(application, 'chat_locks', None)
+    if locks is None or chat_id is None:
+        return nullcontext()
+    return locks.hold(chat_id)
+
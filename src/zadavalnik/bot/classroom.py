@@ -0,0 +1,68 @@
+from typing import Dict, List
+
+from zadavalnik.database.models import TestStatus
+
+MAX_STUDENTS_IN_REPORT = 50 # Чтобы отчет поместился в одно сообщение Telegram
+
+
+def aggregate_classroom_results(rows: List[tuple], question_count: int) -> Dict:
+    """
+    Сводка по строкам get_classroom_results: результаты учеников и доля верных ответов по каждому вопросу.
+    Учитываются только завершенные попытки - ответы в процессе теста еще не сохранены.
+    """
+    students: Dict[int, Dict] = {}
+    question_correct = [0] * question_count
+    question_graded = [0] * question_count
+    for user_id, username, first_name, status, question_number, is_correct in rows:
+        student = students.setdefault(user_id, {
+            "name": f"@{username}" if username else (first_name or str(user_id)),
+            "completed": status == TestStatus.COMPLETED,
+            "aborted": status == TestStatus.ABORTED,
+            "correct": 0,
+            "graded": 0,
+        })
+        if question_number is None or is_correct is None:
+            continue
+        student["graded"] += 1
+        student["correct"] += int(is_correct)
+        if 1 <= question_number <= question_count:
+            question_graded[question_number - 1] += 1
+            question_correct[question_number - 1] += int(is_correct)
+
+    completed = [student for student in students.values() if student["completed"]]
+    return {
+        "students": list(students.values()),
+        "joined": len(students),
+        "completed": len(completed),
+        "average_correct": sum(s["correct"] for s in completed) / len(completed) if completed else None,
+        "question_rates": [
+            correct / graded if graded else None for correct, graded in zip(question_correct, question_graded)
+        ],
+    }
+
+
+def format_classroom_results(code: str, topic: str, questions: List[Dict], rows: List[tuple]) -> str:
+    summary = aggregate_classroom_results(rows, len(questions))
+    lines = [f"Класс {code} — «{topic}»", f"Присоединились: {summary['joined']}, завершили: {summary['completed']}"]
+    if summary["average_correct"] is not None:
+        lines.append(f"Средний результат: {summary['average_correct']:.1f} из {len(questions)}")
+
+    lines.append("\nПо вопросам:")
+    for number, (question, rate) in enumerate(zip(questions, summary["question_rates"]), start=1):
+        rate_text = f"{rate:.0%} верно" if rate is not None else "нет ответов"
+        question_text = question["question"] if len(question["question"]) <= 60 else question["question"][:57] + "..."
+        lines.append(f"{number}. {rate_text} — {question_text}")
+
+    if summary["students"]:
+        lines.append("\nУченики:")
+        students = sorted(summary["students"], key=lambda s: (not s["completed"], -s["correct"]))
+        for student in students[:MAX_STUDENTS_IN_REPORT]:
+            if student["completed"]:
+                lines.append(f"{student['name']} — {student['correct']}/{len(questions)}")
+            elif student["aborted"]:
+                lines.append(f"{student['name']} — не завершил тест")
+            else:
+                lines.append(f"{student['name']} — проходит тест")
+        if len(students) > MAX_STUDENTS_IN_REPORT:
+            lines.append(f"...и еще {len(students) - MAX_STUDENTS_IN_REPORT}")
+    return "\n".join(lines)
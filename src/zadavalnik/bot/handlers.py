@@ -1,9 +1,11 @@
+from __future__ import annotations
+
+import asyncio
 import logging
-import json # Для json.dumps в tool message - БОЛЬШЕ НЕ НУЖЕН ДЛЯ ЭТОЙ ЦЕЛИ
 import base64
 import io
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+import json
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 from zadavalnik.database.db import (
     get_db_session, 
@@ -11,86 +13,351 @@ from zadavalnik.database.db import (
     log_test_attempt_start,
     update_test_attempt_status,
     count_user_daily_tests,
-    log_rate_limit_attempt
+    log_rate_limit_attempt,
+    save_question_results,
+    create_test_plan,
+    create_classroom,
+    get_classroom_by_code,
+    get_classroom_member,
+    add_classroom_member,
+    get_classroom_results,
+    get_test_plan,
+    find_test_plan_by_topic,
+    list_test_plans,
+    get_review_schedule_by_id
 )
 from zadavalnik.database.models import TestStatus
-from zadavalnik.ai.openai_client import OpenAIClient
 from zadavalnik.bot.states import UserState
-from zadavalnik.config.settings import settings
+from zadavalnik.bot.request_controller import LLMRequestController, estimate_prompt_tokens
+from zadavalnik.bot.admission import AdmissionRejected, Priority
+from zadavalnik.bot.session_store import SessionStore
+from zadavalnik.bot.outbox import Outbox, MAX_MESSAGE_LENGTH
+from zadavalnik.bot.loop_monitor import LoopMonitor
+from zadavalnik.bot.idempotency import UpdateDeduplicator
+from zadavalnik.bot.chat_lock import hold_chat
+from zadavalnik.bot.classroom import format_classroom_results
+from zadavalnik.bot.review_scheduler import DOCUMENT_TOPIC_PREFIX, IMAGE_FALLBACK_TOPIC, is_material_topic
+from zadavalnik.ai.document_digest import DocumentDigester
+from zadavalnik.config import get_settings
+from zadavalnik.tracing import span, trace_handler, traced
+
+if TYPE_CHECKING:
+    # Только для аннотаций: telegram.ext и openai не импортируются при импорте модуля
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+    from zadavalnik.ai.openai_client import OpenAIClient
 
 logger = logging.getLogger(__name__)
 
 def setup_handlers(app: Application):
+    from telegram import Update
+    from telegram.ext import CommandHandler, MessageHandler, TypeHandler, filters
+
+    # Группа -1: повторно доставленный апдейт останавливается до любой работы с БД и ИИ
+    app.add_handler(TypeHandler(Update, _check_duplicate_update), group=-1)
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("newtest", new_test_command))
+    app.add_handler(CommandHandler("classroom", classroom_command))
+    app.add_handler(CommandHandler("join", join_command))
+    app.add_handler(CommandHandler("results", results_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("topics", topics_command))
+    # /take_<id> из списка /topics: такую команду можно нажать в сообщении, поэтому id - часть команды
+    app.add_handler(MessageHandler(filters.Regex(r"^/take_\d+(@\w+)?$"), take_plan_command))
+    # /review_<id> из напоминания о повторении
+    app.add_handler(MessageHandler(filters.Regex(r"^/review_\d+(@\w+)?$"), review_command))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo_message))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document_message))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    # Отдельная группа: отметка активности для вытеснения простаивающих сессий видит каждый апдейт
+    app.add_handler(TypeHandler(Update, _touch_session), group=1)
+    # Апдейт уже обработан, /profile считает обработанные апдейты
+    app.add_handler(TypeHandler(Update, _count_profiled_update), group=2)
+    # Последняя группа: только теперь ключи апдейта сохраняются, а offset продвигается
+    app.add_handler(TypeHandler(Update, _complete_update), group=3)
+
+def _get_llm_controller(context: ContextTypes.DEFAULT_TYPE) -> LLMRequestController:
+    """Контроллер LLM-запросов по чатам (создается в bot.py, здесь - запасной вариант)"""
+    controller = context.application.bot_data.get('llm_controller')
+    if controller is None:
+        controller = context.application.bot_data['llm_controller'] = LLMRequestController()
+    return controller
+
+def _queued_notifier(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщает пользователю позицию в очереди новых тестов"""
+    def notify(position: int):
+        _reply(update, context,
+            f"Сейчас много желающих пройти тест. Вы в очереди: {position}. "
+            "Тест начнется автоматически, ничего отправлять не нужно."
+        )
+    return notify
+
+def _reply_overloaded(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reply(update, context, "Сейчас слишком много запросов. Пожалуйста, попробуйте начать тест через несколько минут.")
+
+async def _run_test_start(update: Update, context: ContextTypes.DEFAULT_TYPE, call, estimated_tokens: int = 0):
+    """Запрос на создание теста: при перегрузке ждет в очереди; None - отменен или отклонен"""
+    try:
+        return await _get_llm_controller(context).run(
+            context.chat_data, call, estimated_tokens=estimated_tokens,
+            priority=Priority.START, on_queued=_queued_notifier(update, context)
+        )
+    except AdmissionRejected:
+        _reply_overloaded(update, context)
+        return None
+
+def _get_outbox(context: ContextTypes.DEFAULT_TYPE) -> Outbox:
+    """Очередь исходящих сообщений (создается в bot.py, здесь - запасной вариант)"""
+    outbox = context.application.bot_data.get('outbox')
+    if outbox is None:
+        outbox = context.application.bot_data['outbox'] = Outbox(context.bot)
+    return outbox
+
+def _reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> asyncio.Future:
+    """Ответ в чат через очередь: не ждет отправки, подряд идущие ответы уходят одним сообщением"""
+    return _get_outbox(context).send(update.effective_chat.id, text)
+
+def _typing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> asyncio.Future:
+    return _get_outbox(context).send_chat_action(update.effective_chat.id, "typing")
+
+def _get_document_digester(context: ContextTypes.DEFAULT_TYPE, openai_client: OpenAIClient) -> DocumentDigester:
+    """Конспектирование больших документов (создается в bot.py, здесь - запасной вариант)"""
+    digester = context.application.bot_data.get('document_digester')
+    if digester is None:
+        digester = context.application.bot_data['document_digester'] = DocumentDigester(openai_client)
+    return digester
+
+def _get_session_store(context: ContextTypes.DEFAULT_TYPE) -> SessionStore:
+    """Хранилище сессий (создается в bot.py, здесь - запасной вариант)"""
+    store = context.application.bot_data.get('session_store')
+    if store is None:
+        store = context.application.bot_data['session_store'] = SessionStore()
+    return store
+
+def _get_update_deduplicator(context: ContextTypes.DEFAULT_TYPE) -> UpdateDeduplicator:
+    """Защита от повторных апдейтов (создается в bot.py, здесь - запасной вариант без истории из БД)"""
+    deduplicator = context.application.bot_data.get('update_deduplicator')
+    if deduplicator is None:
+        deduplicator = context.application.bot_data['update_deduplicator'] = UpdateDeduplicator()
+    return deduplicator
+
+async def _check_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _get_update_deduplicator(context).check(update, context)
+
+async def _complete_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _get_update_deduplicator(context).complete_update(update, context)
+
+def _get_loop_monitor(context: ContextTypes.DEFAULT_TYPE) -> LoopMonitor:
+    """Монитор цикла событий (создается и запускается в bot.py, здесь - запасной вариант)"""
+    monitor = context.application.bot_data.get('loop_monitor')
+    if monitor is None:
+        monitor = context.application.bot_data['loop_monitor'] = LoopMonitor()
+        monitor.start()
+    return monitor
+
+async def _count_profiled_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    monitor = context.application.bot_data.get('loop_monitor')
+    if monitor is not None:
+        await monitor.count_update(update, context)
+
+async def _touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _get_session_store(context).touch_update(update, context)
 
 def _clear_user_test_state(context: ContextTypes.DEFAULT_TYPE):
+    # Запрос к ИИ по сбрасываемому тесту больше не нужен: отменяем его, а поздний ответ будет отброшен
+    _get_llm_controller(context).cancel(context.chat_data)
     keys_to_clear = [
         'current_state', 'current_topic', 'gpt_chat_history', 
         'current_question_num', 'total_questions', 'active_test_attempt_id',
-        'test_from_image', 'test_from_document'
+        'test_from_image', 'test_from_document', 'question_results', 'last_question_text', 'test_plan'
     ]
     for key in keys_to_clear:
         if key in context.user_data:
             del context.user_data[key]
 
-async def _process_image_to_base64(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает изображение: скачивает и конвертирует в base64"""
+def _record_question_result(context: ContextTypes.DEFAULT_TYPE, user_answer: str, gpt_response_data: dict):
+    """Запоминает ответ на предыдущий вопрос; в БД результаты пишутся пачкой по завершении теста"""
+    correct_flag = gpt_response_data.get("previous_answer_correct")
+    context.user_data.setdefault('question_results', []).append({
+        "question_number": context.user_data.get('current_question_num'),
+        "question_text": context.user_data.get('last_question_text'),
+        "user_answer": user_answer,
+        "is_correct": bool(correct_flag) if correct_flag in (0, 1) else None,
+    })
+
+async def _complete_test(update: Update, context: ContextTypes.DEFAULT_TYPE, attempt_id: int):
+    """Завершает тест: статус попытки, результаты вопросов и планирование повторения"""
     user_id = update.effective_user.id
+    results = context.user_data.get('question_results', [])
+    async for db in get_db_session():
+        await update_test_attempt_status(db, attempt_id, TestStatus.COMPLETED, end_time=True)
+        await save_question_results(db, attempt_id, user_id, results)
+    context.user_data['current_state'] = UserState.TEST_COMPLETED
+    # История с исходными изображениями/документом больше не нужна
+    _get_session_store(context).release(context.user_data)
+
+    review_scheduler = context.application.bot_data.get('review_scheduler')
+    graded = [result for result in results if result["is_correct"] is not None]
+    if review_scheduler and graded:
+        correct = sum(1 for result in graded if result["is_correct"])
+        await review_scheduler.record_test_result(user_id, context.user_data.get('current_topic'), correct, len(graded))
+
+@traced("tg.image_to_base64")
+async def _process_image_to_base64(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> Tuple[str, str]:
+    """Обрабатывает изображение: скачивает и конвертирует в base64"""
+    with span("tg.download_file") as download_span:
+        # Скачиваем файл
+        file = await context.bot.get_file(file_id)
+        
+        # Скачиваем изображение в память
+        image_bytes = io.BytesIO()
+        await file.download_to_memory(image_bytes)
+        download_span.set(bytes=image_bytes.getbuffer().nbytes)
     
-    # Получаем самое большое изображение из отправленного
-    photo = update.message.photo[-1]  # Берем самое большое разрешение
-    
-    # Скачиваем файл
-    file = await context.bot.get_file(photo.file_id)
-    
-    # Скачиваем изображение в память
-    image_bytes = io.BytesIO()
-    await file.download_to_memory(image_bytes)
-    image_bytes.seek(0)
-    
-    # Конвертируем в base64
-    image_base64 = base64.b64encode(image_bytes.getvalue()).decode('utf-8')
+    # Конвертируем в base64 в пуле потоков, чтобы не блокировать цикл событий на больших изображениях
+    with span("image.b64encode"):
+        image_base64 = await asyncio.to_thread(lambda: base64.b64encode(image_bytes.getvalue()).decode('utf-8'))
     
-    logger.info(f"Successfully converted image to base64 for user {user_id}. Size: {len(image_base64)} chars")
+    logger.info(f"Successfully converted image {file_id} to base64. Size: {len(image_base64)} chars")
     
     # Определяем формат изображения
-    image_format = "jpeg"  # По умолчанию JPEG, можно улучшить определение формата
+    image_format = "jpeg"  # Telegram пережимает фото (не документы) в JPEG
     
     return image_base64, image_format
 
-async def _initialize_new_test_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _start_test_from_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, file_ids: List[str]):
+    """Скачивает все фото параллельно и создает по ним один тест одним запросом к ИИ"""
+    user_id = update.effective_user.id
+    openai_client = await _get_openai_client(update, context)
+    if not openai_client:
+        return
+
+    if len(file_ids) == 1:
+        _reply(update, context, "Анализирую изображение и создаю тест...")
+    else:
+        _reply(update, context, f"Анализирую изображения ({len(file_ids)} шт.) и создаю тест...")
+    _typing(update, context)
+
+    images = await asyncio.gather(*(_process_image_to_base64(context, file_id) for file_id in file_ids))
+
+    # Анализируем изображения через OpenAI и создаем тест
+    result = await _run_test_start(
+        update, context,
+        lambda: openai_client.analyze_images_and_start_test(list(images)),
+        estimated_tokens=len(images) * 1000
+    )
+    if result is None:
+        return  # Пользователь начал другой тест, пока шел анализ, или бот перегружен
+    gpt_response_data, gpt_history = result
+
+    # Получаем определенную тему из ответа ИИ и начинаем тест
+    # Пустая тема объединила бы все тесты по изображениям в одно повторение
+    detected_topic = (gpt_response_data.get("detected_topic") or IMAGE_FALLBACK_TOPIC) if gpt_response_data else None
+
+    success = await _process_test_start_from_response(
+        update, context, gpt_response_data, gpt_history,
+        detected_topic, is_image_test=True
+    )
+
+    if not success:
+        logger.warning(f"Failed to analyze {len(file_ids)} image(s) and start test for user {user_id}. Response data: {gpt_response_data}")
+        _reply(update, context,
+            "Не удалось проанализировать изображение или создать тест. "
+            "Попробуйте другое изображение или начните обычный тест командой /newtest."
+        )
+
+def _buffer_media_group_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Копит фото одного альбома: Telegram присылает каждое фото альбома отдельным апдейтом.
+    Первое фото планирует сборку альбома через MEDIA_GROUP_WINDOW_SECONDS, остальные только добавляются.
+    """
+    settings = get_settings()
+    message = update.message
+    media_group_id = message.media_group_id
+
+    if media_group_id in context.chat_data.get('flushed_media_groups', []):
+        logger.info(f"Late photo for already processed media group {media_group_id} ignored")
+        return
+
+    media_groups = context.chat_data.setdefault('media_groups', {})
+    group = media_groups.get(media_group_id)
+    if group is None:
+        group = media_groups[media_group_id] = {'update': update, 'photos': []}
+        context.job_queue.run_once(
+            _flush_media_group, settings.MEDIA_GROUP_WINDOW_SECONDS, data=media_group_id,
+            chat_id=update.effective_chat.id, user_id=update.effective_user.id,
+            name=f"media_group:{media_group_id}"
+        )
+    group['photos'].append((message.message_id, message.photo[-1].file_id))  # Берем самое большое разрешение
+
+@trace_handler
+async def _flush_media_group(context: ContextTypes.DEFAULT_TYPE):
+    """Job: альбом собран - создаем один тест по всем его фото"""
+    # Job выполняется вне обработки апдейтов, поэтому блокировку чата берет сам
+    async with hold_chat(context.application, context.job.chat_id):
+        await _start_media_group_test(context)
+
+async def _start_media_group_test(context: ContextTypes.DEFAULT_TYPE):
+    settings = get_settings()
+    media_group_id = context.job.data
+    group = context.chat_data.get('media_groups', {}).pop(media_group_id, None)
+    if not group:
+        return
+    flushed = context.chat_data.setdefault('flushed_media_groups', [])
+    flushed.append(media_group_id)
+    del flushed[:-20]  # Помним только последние альбомы, чтобы отсекать опоздавшие фото
+
+    update = group['update']
+    photos = sorted(group['photos'])[:settings.MEDIA_GROUP_MAX_IMAGES]  # В порядке отправки
+    if context.user_data.get('current_state') != UserState.AWAITING_TOPIC:
+        return  # Пока копили альбом, пользователь начал другой тест
+    try:
+        await _start_test_from_photos(update, context, [file_id for _, file_id in photos])
+    except Exception as e:
+        logger.error(f"Error processing media group {media_group_id} for user {update.effective_user.id}: {e}", exc_info=True)
+        _reply(update, context,
+            "Произошла ошибка при обработке изображений. Попробуйте еще раз."
+        )
+
+async def _check_daily_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """False (и сообщение пользователю), если дневной лимит тестов исчерпан"""
+    settings = get_settings()
     user_tg = update.effective_user
     user_id = user_tg.id
+    if settings.TEST_USER_TGID == int(user_id):
+        return True
+    async for db in get_db_session():
+        await get_or_create_telegram_user_in_db(db, user_tg)
+        tests_today = await count_user_daily_tests(db, user_id)
+        logger.info(f"User {user_id} has {tests_today} tests today. Limit: {settings.MAX_TESTS_PER_DAY}")
+        if tests_today >= settings.MAX_TESTS_PER_DAY:
+            await log_rate_limit_attempt(db, user_id)
+            _reply(update, context,
+                f"Вы уже прошли максимальное количество тестов на сегодня ({settings.MAX_TESTS_PER_DAY}). "
+                "Пожалуйста, возвращайтесь завтра!"
+            )
+            return False
+    return True
+
+async def _initialize_new_test_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _clear_user_test_state(context)
 
-    if settings.TEST_USER_TGID != int(user_id):
-        async for db in get_db_session():
-            await get_or_create_telegram_user_in_db(db, user_tg)
-            tests_today = await count_user_daily_tests(db, user_id)
-            logger.info(f"User {user_id} has {tests_today} tests today. Limit: {settings.MAX_TESTS_PER_DAY}")
-            if tests_today >= settings.MAX_TESTS_PER_DAY:
-                await log_rate_limit_attempt(db, user_id)
-                await update.message.reply_text(
-                    f"Вы уже прошли максимальное количество тестов на сегодня ({settings.MAX_TESTS_PER_DAY}). "
-                    "Пожалуйста, возвращайтесь завтра!"
-                )
-                return False
+    if not await _check_daily_limit(update, context):
+        return False
 
     context.user_data['current_state'] = UserState.AWAITING_TOPIC
-    await update.message.reply_text(
+    _reply(update, context,
         "Добро пожаловать в Задавальник!\n"
         "Введите тему, по которой вы хотите пройти тест."
     )
     return True
 
+@trace_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"User {update.effective_user.id} used /start")
     await _initialize_new_test_session(update, context)
 
+@trace_handler
 async def new_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"User {update.effective_user.id} used /newtest")
     await _initialize_new_test_session(update, context)
@@ -112,35 +379,268 @@ async def _process_test_start_from_response(update: Update, context: ContextType
         context.user_data['active_test_attempt_id'] = attempt.id
     
     # Обновляем состояние пользователя
+    await _get_session_store(context).save_history(context.user_data, gpt_history)
     context.user_data.update({
         'current_topic': topic,
         'current_state': UserState.IN_TEST,
-        'gpt_chat_history': gpt_history,
         'current_question_num': gpt_response_data.get("current_question_number"),
         'total_questions': gpt_response_data.get("total_questions_in_test"),
         'test_from_image': is_image_test  # Флаг, что тест создан из изображения
     })
     
-    await update.message.reply_text(gpt_response_data["message_to_user"])
+    _reply(update, context, gpt_response_data["message_to_user"])
+    context.user_data['last_question_text'] = gpt_response_data["message_to_user"]
     
     # Проверяем, не завершился ли тест сразу
     if gpt_response_data.get("is_final_summary"):
-        async for db in get_db_session():
-            await update_test_attempt_status(db, context.user_data['active_test_attempt_id'], TestStatus.COMPLETED, end_time=True)
-        context.user_data['current_state'] = UserState.TEST_COMPLETED
-        await update.message.reply_text("Тест завершен! Для нового теста используйте /newtest.")
+        await _complete_test(update, context, context.user_data['active_test_attempt_id'])
+        _reply(update, context, "Тест завершен! Для нового теста используйте /newtest.")
     
     return True
 
+def _plan_question_text(plan: Dict, number: int) -> str:
+    return f"Вопрос {number} из {len(plan['questions'])}: {plan['questions'][number - 1]['question']}"
+
+async def _start_plan_test(update: Update, context: ContextTypes.DEFAULT_TYPE, plan: Dict, attempt_id: int):
+    """Начинает тест по готовому плану: первый вопрос отправляется без запроса к ИИ"""
+    _clear_user_test_state(context)
+    context.user_data.update({
+        'current_topic': plan['topic'],
+        'current_state': UserState.IN_TEST,
+        'active_test_attempt_id': attempt_id,
+        'test_plan': plan,
+        'current_question_num': 1,
+        'total_questions': len(plan['questions']),
+    })
+    question_text = _plan_question_text(plan, 1)
+    context.user_data['last_question_text'] = question_text
+    _reply(update, context,
+        f"Сейчас мы проведем тест по теме «{plan['topic']}». Вопросов: {len(plan['questions'])}.\n\n{question_text}"
+    )
+
+async def _continue_plan_test(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: OpenAIClient, answer_text: str):
+    """Ход теста по плану: оценка ответа по эталону и следующий вопрос из плана"""
+    plan = context.user_data['test_plan']
+    number = context.user_data.get('current_question_num') or 1
+    item = plan['questions'][number - 1]
+
+    async def grade():
+        # Кортеж, чтобы отличать неудачную оценку (None внутри) от отмененного запроса (None от run)
+        return (await openai_client.grade_answer(item['question'], item['answer'], answer_text),)
+
+    result = await _get_llm_controller(context).run(context.chat_data, grade, priority=Priority.ANSWER)
+    if result is None:
+        return  # Тест сброшен, пока шла оценка
+    grade_data = result[0]
+    if grade_data is None:
+        logger.warning(f"Failed to grade plan answer for user {update.effective_user.id}, question {number}")
+        _reply(update, context, "Не удалось проверить ответ. Попробуйте ответить еще раз.")
+        return
+
+    _record_question_result(context, answer_text, {"previous_answer_correct": grade_data["correct"]})
+    comment = grade_data["comment"] or ("Верно!" if grade_data["correct"] else f"Неверно. Правильный ответ: {item['answer']}")
+    if number < len(plan['questions']):
+        question_text = _plan_question_text(plan, number + 1)
+        context.user_data['current_question_num'] = number + 1
+        context.user_data['last_question_text'] = question_text
+        _reply(update, context, f"{comment}\n\n{question_text}")
+        return
+
+    correct = sum(1 for question_result in context.user_data.get("question_results", []) if question_result["is_correct"])
+    _reply(update, context, f"{comment}\n\nТест завершен. Правильных ответов: {correct} из {len(plan['questions'])}.")
+    await _complete_test(update, context, context.user_data['active_test_attempt_id'])
+    _reply(update, context, "Чтобы начать новый тест, используйте команду /newtest.")
+
+@trace_handler
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [N] - (только администратор) профиль цикла событий на следующих N апдейтах"""
+    settings = get_settings()
+    user_id = update.effective_user.id
+    if settings.TEST_USER_TGID != int(user_id):
+        return  # Команда администратора: остальным не отвечаем
+    args = context.args or []
+    if args and not args[0].isdigit():
+        _reply(update, context, "Использование: /profile N - профилировать следующие N апдейтов (по умолчанию 50)")
+        return
+    updates = max(1, int(args[0])) if args else 50
+
+    monitor = _get_loop_monitor(context)
+    outbox = _get_outbox(context)
+    chat_id = update.effective_chat.id
+
+    def send_report(report: str):
+        outbox.send(chat_id, f"{report}\n\nЗадержка цикла: {monitor.stats()}"[:MAX_MESSAGE_LENGTH])
+
+    if not monitor.start_profile(updates, update.update_id, send_report):
+        _reply(update, context, "Профилирование уже идет. Отчет придет, когда оно завершится.")
+        return
+    logger.info(f"Admin {user_id} started profiling for {updates} updates")
+    _reply(update, context, f"Профилирую следующие {updates} апдейтов. Отчет придет сюда.")
+
+async def _start_ingested_plan_test(update: Update, context: ContextTypes.DEFAULT_TYPE, test_plan):
+    """Тест по плану, заранее созданному из материалов курса (python -m zadavalnik.ingest)"""
+    user_id = update.effective_user.id
+    async for db in get_db_session():
+        attempt = await log_test_attempt_start(db, user_id, test_plan.topic)
+    logger.info(f"User {user_id} started pre-generated plan {test_plan.id} ('{test_plan.topic}')")
+    plan = {"plan_id": test_plan.id, "topic": test_plan.topic, "questions": json.loads(test_plan.questions)}
+    await _start_plan_test(update, context, plan, attempt.id)
+
+@trace_handler
+async def topics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/topics - готовые тесты по материалам курса"""
+    logger.info(f"User {update.effective_user.id} used /topics")
+    async for db in get_db_session():
+        plans = await list_test_plans(db, source="ingest")
+    if not plans:
+        _reply(update, context, "Готовых тестов по материалам курса пока нет. Начните тест по любой теме: /newtest")
+        return
+    lines = [f"• {topic} — /take_{plan_id}" for plan_id, topic in plans]
+    _reply(update, context,
+        "Готовые тесты по материалам курса (нажмите команду или введите название темы после /newtest):\n\n"
+        + "\n".join(lines)
+    )
+
+@trace_handler
+async def take_plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/take_<id> - начать готовый тест из списка /topics"""
+    plan_id = int(update.message.text.split("@")[0][len("/take_"):])
+    async for db in get_db_session():
+        test_plan = await get_test_plan(db, plan_id, source="ingest")
+    if test_plan is None:
+        _reply(update, context, "Такого теста нет. Список доступных тестов: /topics")
+        return
+    _clear_user_test_state(context)
+    if not await _check_daily_limit(update, context):
+        return
+    await _start_ingested_plan_test(update, context, test_plan)
+
+@trace_handler
+async def review_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/review_<id> - повторить тему из напоминания"""
+    user_id = update.effective_user.id
+    schedule_id = int(update.message.text.split("@")[0][len("/review_"):])
+    async for db in get_db_session():
+        schedule = await get_review_schedule_by_id(db, schedule_id)
+    if schedule is None or schedule.user_id != user_id:
+        _reply(update, context, "Такого повторения нет. Начните новый тест: /newtest")
+        return
+    logger.info(f"User {user_id} started review {schedule_id} ('{schedule.topic}')")
+    if is_material_topic(schedule.topic):
+        _reply(update, context, "Материал этого теста не сохранился. Отправьте /newtest и пришлите его снова.")
+        return
+    openai_client = await _get_openai_client(update, context)
+    if not openai_client:
+        return
+    _clear_user_test_state(context)
+    if not await _check_daily_limit(update, context):
+        return
+    # Если тест не начнется, пользователь может ввести другую тему
+    context.user_data['current_state'] = UserState.AWAITING_TOPIC
+    await _start_topic_test(update, context, openai_client, schedule.topic)
+
+@trace_handler
+async def classroom_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/classroom <тема> - учитель создает один тест для всего класса и получает код"""
+    settings = get_settings()
+    user_tg = update.effective_user
+    topic = " ".join(context.args or []).strip()
+    logger.info(f"User {user_tg.id} used /classroom with topic '{topic}'")
+    if len(topic) < 3:
+        _reply(update, context, "Укажите тему теста для класса, например: /classroom Фотосинтез")
+        return
+
+    openai_client = await _get_openai_client(update, context)
+    if not openai_client:
+        return
+    _reply(update, context, f"Составляю тест для класса по теме: \"{topic}\"...")
+    _typing(update, context)
+
+    # План генерируется один раз: стоимость не зависит от числа учеников.
+    # Идущий тест учителя не отменяется, поэтому слот берется напрямую, без run()
+    try:
+        async with _get_llm_controller(context).admission.slot(Priority.START, _queued_notifier(update, context)):
+            plan = await openai_client.generate_question_plan(topic, settings.CLASSROOM_QUESTIONS)
+    except AdmissionRejected:
+        _reply_overloaded(update, context)
+        return
+    if not plan:
+        logger.warning(f"Failed to generate classroom plan for user {user_tg.id}, topic: {topic}")
+        _reply(update, context, "Не удалось составить тест. Попробуйте другую тему или повторите позже.")
+        return
+
+    async for db in get_db_session():
+        await get_or_create_telegram_user_in_db(db, user_tg)
+        test_plan = await create_test_plan(db, plan["topic"], plan["questions"], source="classroom", model=openai_client.model)
+        classroom = await create_classroom(db, user_tg.id, test_plan.id)
+    logger.info(f"Classroom {classroom.code} created by user {user_tg.id} with plan {test_plan.id}")
+    _reply(update, context,
+        f"Тест «{plan['topic']}» готов ({len(plan['questions'])} вопросов).\n\n"
+        f"Код класса: {classroom.code}\n"
+        f"Ученики присоединяются командой /join {classroom.code}\n"
+        f"Результаты класса: /results {classroom.code}"
+    )
+
+@trace_handler
+async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/join <код> - ученик начинает тест класса"""
+    user_tg = update.effective_user
+    code = " ".join(context.args or []).strip()
+    logger.info(f"User {user_tg.id} used /join {code}")
+    if not code:
+        _reply(update, context, "Укажите код класса, например: /join ABC123")
+        return
+
+    async for db in get_db_session():
+        classroom = await get_classroom_by_code(db, code)
+        if classroom is None:
+            _reply(update, context, "Класс с таким кодом не найден. Проверьте код у учителя.")
+            return
+        if await get_classroom_member(db, classroom.id, user_tg.id):
+            _reply(update, context, "Вы уже проходили тест этого класса.")
+            return
+        await get_or_create_telegram_user_in_db(db, user_tg)
+        attempt = await log_test_attempt_start(db, user_tg.id, classroom.plan.topic)
+        if not await add_classroom_member(db, classroom.id, user_tg.id, attempt.id):
+            await update_test_attempt_status(db, attempt.id, TestStatus.ABORTED, end_time=True)
+            _reply(update, context, "Вы уже проходили тест этого класса.")
+            return
+        plan = {
+            "plan_id": classroom.plan.id,
+            "topic": classroom.plan.topic,
+            "questions": json.loads(classroom.plan.questions),
+        }
+    await _start_plan_test(update, context, plan, attempt.id)
+
+@trace_handler
+async def results_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/results <код> - сводка результатов класса для учителя"""
+    user_id = update.effective_user.id
+    code = " ".join(context.args or []).strip()
+    logger.info(f"User {user_id} used /results {code}")
+    if not code:
+        _reply(update, context, "Укажите код класса, например: /results ABC123")
+        return
+
+    async for db in get_db_session():
+        classroom = await get_classroom_by_code(db, code)
+        if classroom is None or classroom.teacher_id != user_id:
+            _reply(update, context, "Класс с таким кодом не найден среди созданных вами.")
+            return
+        rows = await get_classroom_results(db, classroom.id)
+        questions = json.loads(classroom.plan.questions)
+    _reply(update, context, format_classroom_results(classroom.code, classroom.plan.topic, questions, rows))
+
 async def _get_openai_client(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение клиента OpenAI из контекста бота"""
     openai_client: OpenAIClient = context.application.bot_data.get('openai_client')
     if not openai_client:
         logger.error("OpenAI client not found in bot_data.")
-        await update.message.reply_text("Ошибка конфигурации бота. Обратитесь к администратору.")
+        _reply(update, context, "Ошибка конфигурации бота. Обратитесь к администратору.")
         return None
     return openai_client
 
+@trace_handler
 async def handle_photo_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик фотографий - анализ изображения и создание теста"""
     user_id = update.effective_user.id
@@ -154,73 +654,46 @@ async def handle_photo_message(update: Update, context: ContextTypes.DEFAULT_TYP
     
     try:
         if current_state == UserState.AWAITING_TOPIC:
-            # Уведомляем пользователя о начале обработки
-            await update.message.reply_text("Анализирую изображение и создаю тест...")
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            
-            # Обрабатываем изображение
-            image_base64, image_format = await _process_image_to_base64(update, context)
-            
-            # Анализируем изображение через OpenAI и создаем тест
-            gpt_response_data, gpt_history = await openai_client.analyze_image_and_start_test(
-                image_base64=image_base64,
-                image_format=image_format
-            )
-            
-            # Получаем определенную тему из ответа ИИ и начинаем тест
-            detected_topic = gpt_response_data.get("detected_topic", "Тест по изображению") if gpt_response_data else None
-            
-            success = await _process_test_start_from_response(
-                update, context, gpt_response_data, gpt_history, 
-                detected_topic, is_image_test=True
-            )
-            
-            if not success:
-                logger.warning(f"Failed to analyze image and start test for user {user_id}. Response data: {gpt_response_data}")
-                await update.message.reply_text(
-                    "Не удалось проанализировать изображение или создать тест. "
-                    "Попробуйте другое изображение или начните обычный тест командой /newtest."
-                )
+            if update.message.media_group_id and context.job_queue:
+                # Фото из альбома: собираем весь альбом в один тест
+                _buffer_media_group_photo(update, context)
+            else:
+                await _start_test_from_photos(update, context, [update.message.photo[-1].file_id])
         
         elif current_state == UserState.IN_TEST:
-            # Обработка фото во время теста
-            await update.message.reply_text("Обрабатываю ваше изображение в рамках текущего теста...")
-            
-            # Обрабатываем изображение
-            image_base64, image_format = await _process_image_to_base64(update, context)
-            
-            # Тут должна быть логика обработки фото в контексте текущего теста
-            # Это может потребовать создания отдельного метода в OpenAIClient
-            # Пока используем текстовый вариант продолжения теста с уведомлением
-            await update.message.reply_text(
+            # Фото во время теста пока не оцениваются, поэтому и не скачиваются
+            if update.message.media_group_id and update.message.media_group_id in context.chat_data.get('flushed_media_groups', []):
+                return  # Опоздавшее фото альбома, по которому уже создан тест
+            _reply(update, context,
                 "Я вижу, что вы отправили изображение. Пожалуйста, опишите ваш ответ словами."
             )
             
         elif current_state == UserState.TEST_COMPLETED:
-            await update.message.reply_text(
+            _reply(update, context,
                 "Тест уже завершен. Если хотите создать новый тест из изображения, используйте сначала команду /newtest."
             )
         
         elif current_state == UserState.START or not current_state:
             # Помогаем пользователю начать
-            await update.message.reply_text(
+            _reply(update, context,
                 "Для начала работы, пожалуйста, используйте команду /start или /newtest, затем отправьте изображение."
             )
             _clear_user_test_state(context)
         
         else:
             logger.error(f"User {user_id} is in an unknown state: {current_state}")
-            await update.message.reply_text("Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
+            _reply(update, context, "Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
             _clear_user_test_state(context)
             context.user_data['current_state'] = UserState.START
         
     except Exception as e:
         logger.error(f"Error processing photo for user {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(
+        _reply(update, context,
             "Произошла ошибка при обработке изображения. Попробуйте еще раз."
         )
 
 
+@trace_handler
 async def handle_document_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик документов - анализ текстового файла и создание теста"""
     user_id = update.effective_user.id
@@ -240,7 +713,7 @@ async def handle_document_message(update: Update, context: ContextTypes.DEFAULT_
             # Проверяем, что это текстовый файл
             if not document.mime_type or not document.mime_type.startswith('text/'):
                 if not document.file_name or not document.file_name.lower().endswith('.txt'):
-                    await update.message.reply_text(
+                    _reply(update, context,
                         "Пожалуйста, отправьте текстовый файл в формате .txt"
                     )
                     return
@@ -248,35 +721,39 @@ async def handle_document_message(update: Update, context: ContextTypes.DEFAULT_
             # Проверяем размер файла (примерно 50,000 слов = ~300KB для среднего текста)
             max_file_size = 500 * 1024  # 500KB для безопасности
             if document.file_size > max_file_size:
-                await update.message.reply_text(
+                _reply(update, context,
                     f"Файл слишком большой. Максимальный размер: {max_file_size // 1024}KB"
                 )
                 return
             
-            await update.message.reply_text("Загружаю и анализирую документ...")
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            
-            # Скачиваем файл
-            file = await context.bot.get_file(document.file_id)
+            _reply(update, context, "Загружаю и анализирую документ...")
+            _typing(update, context)
             
-            # Скачиваем документ в память
-            document_bytes = io.BytesIO()
-            await file.download_to_memory(document_bytes)
-            document_bytes.seek(0)
+            with span("tg.download_document", bytes=document.file_size):
+                # Скачиваем файл
+                file = await context.bot.get_file(document.file_id)
+                
+                # Скачиваем документ в память
+                document_bytes = io.BytesIO()
+                await file.download_to_memory(document_bytes)
+                document_bytes.seek(0)
             
-            # Читаем текст
+            # Читаем текст и считаем слова: для документа в сотни килобайт - вне цикла событий
+            def decode_and_count():
+                text = document_bytes.getvalue().decode('utf-8')
+                return text, len(text.split())
+
             try:
-                text_content = document_bytes.read().decode('utf-8')
+                text_content, word_count = await asyncio.to_thread(decode_and_count)
             except UnicodeDecodeError:
-                await update.message.reply_text(
+                _reply(update, context,
                     "Не удалось прочитать файл. Убедитесь, что это текстовый файл в кодировке UTF-8."
                 )
                 return
             
             # Проверяем количество слов
-            word_count = len(text_content.split())
             if word_count > 50000:
-                await update.message.reply_text(
+                _reply(update, context,
                     f"Документ содержит {word_count} слов, что превышает лимит в 50,000 слов. "
                     "Пожалуйста, отправьте более короткий документ."
                 )
@@ -284,12 +761,32 @@ async def handle_document_message(update: Update, context: ContextTypes.DEFAULT_
             
             logger.info(f"Document processed for user {user_id}. Word count: {word_count}")
             
+            if word_count > get_settings().DOCUMENT_DIGEST_THRESHOLD_WORDS:
+                # Большой документ целиком не помещается в запрос: тест создается по конспекту разделов
+                _reply(update, context, "Документ большой, поэтому сначала составлю по нему конспект. Это займет немного больше времени...")
+                _typing(update, context)
+                digester = _get_document_digester(context, openai_client)
+
+                async def start_test():
+                    fact_sheet = await digester.digest(text_content)
+                    if not fact_sheet:
+                        return None, []
+                    return await openai_client.analyze_fact_sheet_and_start_test(fact_sheet)
+            else:
+                def start_test():
+                    return openai_client.analyze_text_and_start_test(text_content)
+
             # Получаем структурированные данные и обновленную историю от OpenAI
-            gpt_response_data, gpt_history = await openai_client.analyze_text_and_start_test(text_content)
+            # Конспект большого документа выполняется в одном слоте допуска (внутри него своя параллельность)
+            result = await _run_test_start(update, context, start_test, estimated_tokens=len(text_content) // 4)
+            if result is None:
+                return  # Пользователь начал другой тест, пока шел анализ, или бот перегружен
+            gpt_response_data, gpt_history = result
             
             if gpt_response_data:
                 # Определяем тему на основе документа (первые 100 символов как краткое описание)
-                topic = f"Документ: {document.file_name or 'text_document.txt'}"
+                # Тема, определенная ИИ, позволяет потом повторить ее без документа (/review_<id>)
+                topic = gpt_response_data.get("detected_topic") or f"{DOCUMENT_TOPIC_PREFIX}{document.file_name or 'text_document.txt'}"
                 
                 # Используем общую функцию для обработки начала теста
                 success = await _process_test_start_from_response(
@@ -299,43 +796,90 @@ async def handle_document_message(update: Update, context: ContextTypes.DEFAULT_
                 # Помечаем, что тест создан из документа
                 if success:
                     context.user_data['test_from_document'] = True
-                    await update.message.reply_text(f"✅ Документ обработан ({word_count} слов)")
+                    _reply(update, context, f"✅ Документ обработан ({word_count} слов)")
                 
             else:
                 logger.warning(f"Failed to start AI test session from document for user {user_id}")
-                await update.message.reply_text(
+                _reply(update, context,
                     "Не удалось создать тест на основе документа. Попробуйте другой файл или повторите позже."
                 )
         
         elif current_state == UserState.IN_TEST:
-            await update.message.reply_text(
+            _reply(update, context,
                 "Вы находитесь в процессе прохождения теста. Пожалуйста, ответьте на текущий вопрос текстом."
             )
             
         elif current_state == UserState.TEST_COMPLETED:
-            await update.message.reply_text(
+            _reply(update, context,
                 "Тест уже завершен. Если хотите создать новый тест из документа, используйте команду /newtest."
             )
         
         elif current_state == UserState.START or not current_state:
-            await update.message.reply_text(
+            _reply(update, context,
                 "Для начала работы используйте команду /start или /newtest, затем отправьте текстовый документ."
             )
             _clear_user_test_state(context)
         
         else:
             logger.error(f"User {user_id} is in an unknown state: {current_state}")
-            await update.message.reply_text("Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
+            _reply(update, context, "Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
             _clear_user_test_state(context)
             context.user_data['current_state'] = UserState.START
         
     except Exception as e:
         logger.error(f"Error processing document for user {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(
+        _reply(update, context,
             "Произошла ошибка при обработке документа. Попробуйте еще раз."
         )
 
 
+async def _start_topic_test(update: Update, context: ContextTypes.DEFAULT_TYPE, openai_client: OpenAIClient, topic: str):
+    """Тест по названию темы: готовый план из материалов курса или новый тест от ИИ"""
+    user_id = update.effective_user.id
+    async for db in get_db_session():
+        test_plan = await find_test_plan_by_topic(db, topic, source="ingest")
+    if test_plan is not None:
+        # Тема из материалов курса: тест уже сгенерирован, запрос к ИИ не нужен
+        await _start_ingested_plan_test(update, context, test_plan)
+        return
+
+    _reply(update, context, f"Подготавливаю вопросы по теме: \"{topic}\".")
+    _typing(update, context)
+
+    # Получаем структурированные данные и обновленную историю
+    result = await _run_test_start(update, context, lambda: openai_client.start_test_session(topic=topic))
+    if result is None:
+        return  # Запрос отменен (пользователь уже начал другой тест) или отклонен из-за перегрузки
+    gpt_response_data, gpt_history = result
+
+    # gpt_response_data - это уже распарсенный JSON, если модель его вернула корректно
+    if gpt_response_data:
+        # Логика добавления tool_message больше не нужна, gpt_history уже содержит ответ ассистента.
+
+        async for db in get_db_session():
+            attempt = await log_test_attempt_start(db, user_id, topic)
+            context.user_data['active_test_attempt_id'] = attempt.id
+
+        # Сохраняем историю, включающую ответ ассистента с JSON
+        await _get_session_store(context).save_history(context.user_data, gpt_history)
+        context.user_data.update({
+            'current_topic': topic,
+            'current_state': UserState.IN_TEST,
+            'current_question_num': gpt_response_data.get("current_question_number"),
+            'total_questions': gpt_response_data.get("total_questions_in_test")
+        })
+        _reply(update, context, gpt_response_data["message_to_user"])
+        context.user_data['last_question_text'] = gpt_response_data["message_to_user"]
+
+        if gpt_response_data.get("is_final_summary"):
+            await _complete_test(update, context, context.user_data['active_test_attempt_id'])
+            _reply(update, context, "Тест завершен! Для нового теста используйте /newtest.")
+    else:
+        logger.warning(f"Failed to start AI test session for user {user_id}, topic: {topic}. Raw AI response might be in logs if parsing failed. Response data: {gpt_response_data}")
+        _reply(update, context, "Не удалось начать тест. Попробуйте другую тему или повторите позже. Возможно, ИИ вернул некорректный формат данных.")
+        # Не меняем состояние, пользователь может попробовать ввести другую тему
+
+@trace_handler
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text_received = update.message.text
@@ -346,59 +890,41 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     openai_client: OpenAIClient = context.application.bot_data.get('openai_client')
     if not openai_client:
         logger.error("OpenAI client not found in bot_data.")
-        await update.message.reply_text("Ошибка конфигурации бота. Обратитесь к администратору.")
+        _reply(update, context, "Ошибка конфигурации бота. Обратитесь к администратору.")
         return
 
     if current_state == UserState.AWAITING_TOPIC:
         if len(text_received) < 3:
-            await update.message.reply_text("Тема не задана. Попробуйте снова.")
+            _reply(update, context, "Тема не задана. Попробуйте снова.")
             return
 
-        await update.message.reply_text(f"Подготавливаю вопросы по теме: \"{text_received}\".")
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        await _start_topic_test(update, context, openai_client, text_received)
 
-        # Получаем структурированные данные и обновленную историю
-        gpt_response_data, gpt_history = await openai_client.start_test_session(topic=text_received)
-        
-        # gpt_response_data - это уже распарсенный JSON, если модель его вернула корректно
-        if gpt_response_data:
-            # Логика добавления tool_message больше не нужна, gpt_history уже содержит ответ ассистента.
-            
-            async for db in get_db_session():
-                attempt = await log_test_attempt_start(db, user_id, text_received)
-                context.user_data['active_test_attempt_id'] = attempt.id
-            
-            context.user_data.update({
-                'current_topic': text_received,
-                'current_state': UserState.IN_TEST,
-                'gpt_chat_history': gpt_history, # Сохраняем историю, включающую ответ ассистента с JSON
-                'current_question_num': gpt_response_data.get("current_question_number"),
-                'total_questions': gpt_response_data.get("total_questions_in_test")
-            })
-            await update.message.reply_text(gpt_response_data["message_to_user"])
-            
-            if gpt_response_data.get("is_final_summary"):
-                async for db in get_db_session():
-                    await update_test_attempt_status(db, context.user_data['active_test_attempt_id'], TestStatus.COMPLETED, end_time=True)
-                context.user_data['current_state'] = UserState.TEST_COMPLETED
-                await update.message.reply_text("Тест завершен! Для нового теста используйте /newtest.")
-        else:
-            logger.warning(f"Failed to start AI test session for user {user_id}, topic: {text_received}. Raw AI response might be in logs if parsing failed. Response data: {gpt_response_data}")
-            await update.message.reply_text("Не удалось начать тест. Попробуйте другую тему или повторите позже. Возможно, ИИ вернул некорректный формат данных.")
-            # Не меняем состояние, пользователь может попробовать ввести другую тему
-    
     elif current_state == UserState.IN_TEST:
         active_test_id = context.user_data.get('active_test_attempt_id')
         if not active_test_id:
             logger.error(f"User {user_id} in IN_TEST state but no active_test_attempt_id found.")
-            await update.message.reply_text("Произошла ошибка сессии. Пожалуйста, начните новый тест: /newtest")
+            _reply(update, context, "Произошла ошибка сессии. Пожалуйста, начните новый тест: /newtest")
             _clear_user_test_state(context)
             context.user_data['current_state'] = UserState.AWAITING_TOPIC # или START
             return
 
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        controller = _get_llm_controller(context)
+        # Ответ, пришедший во время хода, отправляется в ИИ вместе с ним одним новым ходом
+        with span("llm.coalesce_wait"):
+            answer_text = await controller.collect_answer(context.chat_data, text_received)
+        if answer_text is None:
+            return  # Сообщение присоединено к ходу, который отправит другой обработчик
+
+        _typing(update, context)
+
+        if context.user_data.get('test_plan'):
+            # Тест по готовому плану (класс): ИИ только оценивает ответ, вопросы уже известны
+            await _continue_plan_test(update, context, openai_client, answer_text)
+            return
 
-        current_gpt_history = context.user_data.get('gpt_chat_history', [])
+        # История читается после сбора ответов: предыдущий ход мог успеть ее обновить
+        current_gpt_history = await _get_session_store(context).load_history(context.user_data)
         
         # Проверяем, был ли тест создан из изображения или документа
         test_from_image = context.user_data.get('test_from_image', False)
@@ -406,52 +932,53 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         if test_from_image:
             # Используем метод для продолжения теста из изображения
-            gpt_response_data, gpt_history = await openai_client.continue_image_test_session(
-                history=current_gpt_history,
-                user_message_text=text_received
-            )
+            continue_session = openai_client.continue_image_test_session
         elif test_from_document:
             # Используем метод для продолжения теста из документа
-            gpt_response_data, gpt_history = await openai_client.continue_text_test_session(
-                history=current_gpt_history,
-                user_message_text=text_received
-            )
+            continue_session = openai_client.continue_text_test_session
         else:
             # Используем обычный метод для продолжения теста
-            gpt_response_data, gpt_history = await openai_client.continue_test_session(
-                history=current_gpt_history,
-                user_message_text=text_received
-            )
+            continue_session = openai_client.continue_test_session
+
+        result = await controller.run(
+            context.chat_data,
+            lambda: continue_session(history=current_gpt_history, user_message_text=answer_text),
+            estimated_tokens=estimate_prompt_tokens(current_gpt_history),
+            priority=Priority.ANSWER
+        )
+        if result is None:
+            return  # Ход отменен: тест сброшен или ответы склеены с более поздним сообщением
+        gpt_response_data, gpt_history = result
 
         if gpt_response_data:
+            _record_question_result(context, answer_text, gpt_response_data)
             # Логика добавления tool_message больше не нужна
+            await _get_session_store(context).save_history(context.user_data, gpt_history)
             context.user_data.update({
-                'gpt_chat_history': gpt_history,
                 'current_question_num': gpt_response_data.get("current_question_number"),
                 # total_questions не должен меняться
             })
 
-            await update.message.reply_text(gpt_response_data["message_to_user"])
+            _reply(update, context, gpt_response_data["message_to_user"])
+            context.user_data['last_question_text'] = gpt_response_data["message_to_user"]
 
             if gpt_response_data.get("is_final_summary"):
-                async for db in get_db_session():
-                    await update_test_attempt_status(db, active_test_id, TestStatus.COMPLETED, end_time=True)
-                context.user_data['current_state'] = UserState.TEST_COMPLETED
+                await _complete_test(update, context, active_test_id)
                 logger.info(f"Test {active_test_id} completed for user {user_id}")
-                await update.message.reply_text("Тест завершен! Чтобы начать новый, используйте команду /newtest.")
+                _reply(update, context, "Тест завершен! Чтобы начать новый, используйте команду /newtest.")
         else:
             logger.warning(f"Failed to continue AI test session for user {user_id}, test_id {active_test_id}. Raw AI response might be in logs. Response data: {gpt_response_data}")
-            await update.message.reply_text("Произошла ошибка при общении с ИИ. Попробуйте ответить еще раз. Если ошибка повторится, начните новый тест: /newtest. Возможно, ИИ вернул некорректный формат данных.")
+            _reply(update, context, "Произошла ошибка при общении с ИИ. Попробуйте ответить еще раз. Если ошибка повторится, начните новый тест: /newtest. Возможно, ИИ вернул некорректный формат данных.")
 
     elif current_state == UserState.TEST_COMPLETED:
-        await update.message.reply_text("Тест уже завершен. Чтобы начать новый, используйте команду /newtest.")
+        _reply(update, context, "Тест уже завершен. Чтобы начать новый, используйте команду /newtest.")
     
     elif current_state == UserState.START or not current_state:
-         await update.message.reply_text("Пожалуйста, используйте команду /start или /newtest, чтобы начать.")
+         _reply(update, context, "Пожалуйста, используйте команду /start или /newtest, чтобы начать.")
          _clear_user_test_state(context)
 
     else:
         logger.error(f"User {user_id} is in an unknown state: {current_state}")
-        await update.message.reply_text("Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
+        _reply(update, context, "Произошла внутренняя ошибка состояния. Пожалуйста, перезапустите бота командой /start.")
         _clear_user_test_state(context)
         context.user_data['current_state'] = UserState.START
\ No newline at end of file
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from zadavalnik.config import get_settings
+from zadavalnik.database.db import (
+    get_db_session, get_bot_meta, load_processed_keys, save_processed_keys, prune_processed_keys,
+    load_pending_updates, prune_pending_updates
+)
+
+if TYPE_CHECKING:
+    from telegram import Bot, Update
+    from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+POLLING_OFFSET_KEY = "polling_offset"
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+def update_key(update_id: int) -> str:
+    return f"u:{update_id}"
+
+
+def message_key(chat_id: int, message_id: int) -> str:
+    return f"m:{chat_id}:{message_id}"
+
+
+class UpdateDeduplicator:
+    """
+    Защита от повторной обработки апдейтов: после падения polling отдает апдейты заново,
+    а одно и то же сообщение может прийти повторно под другим update_id.
+
+    - check() (TypeHandler в группе -1) отмечает апдейт как обрабатываемый до любой работы с БД и ИИ;
+      повтор обрабатываемого или обработанного апдейта останавливается через ApplicationHandlerStop;
+    - complete() (TypeHandler в последней группе) переводит апдейт в обработанные: только их ключи
+      сохраняются в БД и только по ним продвигается offset polling'а. Ключи хранятся в памяти
+      (последние IDEMPOTENCY_MEMORY_KEYS), в БД сбрасываются пачкой раз в IDEMPOTENCY_FLUSH_SECONDS
+      и удаляются через IDEMPOTENCY_TTL_HOURS;
+    - PTB подтверждает Telegram полученные апдейты следующим getUpdates, еще до их обработки,
+      поэтому апдейт, обработка которого прервалась падением, Telegram не пришлет. Апдейты, которые
+      к сбросу еще обрабатываются, тем же сбросом пишутся в журнал (pending_updates), а после
+      рестарта replay_pending() обрабатывает их заново. Как и для ключей, окно - последние
+      IDEMPOTENCY_FLUSH_SECONDS до падения: в нем апдейт может обработаться повторно или,
+      если он был принят и прерван внутри окна, потеряться;
+    - acknowledge_offset() перед стартом polling'а подтверждает Telegram уже обработанные апдейты.
+    """
+
+    def __init__(self, max_keys: Optional[int] = None, ttl_hours: Optional[int] = None):
+        settings = get_settings()
+        self.max_keys = max_keys or settings.IDEMPOTENCY_MEMORY_KEYS
+        self.ttl = timedelta(hours=ttl_hours or settings.IDEMPOTENCY_TTL_HOURS)
+        self._seen: "OrderedDict[str, None]" = OrderedDict() # Обработанные
+        self._in_flight: Dict[int, List[str]] = {} # update_id -> ключи обрабатываемого апдейта
+        self._in_flight_keys: Dict[str, int] = {}
+        self._pending: List[str] = []
+        self._done_update_ids: List[int] = [] # Удалить из журнала
+        self._unjournaled: Dict[int, str] = {} # update_id -> JSON обрабатываемого апдейта до записи в журнал
+        self._journaled: set = set() # update_id, которые есть (или пишутся) в журнале
+        self._max_completed: Optional[int] = None
+        self._pending_updates: List[tuple] = [] # Из журнала при load(), для replay_pending()
+        self.offset: Optional[int] = None # Все апдейты до него включительно обработаны
+        self._flushed_offset: Optional[int] = None
+        self._last_prune = 0.0
+        self.accepted = 0
+        self.completed = 0
+        self.replayed = 0
+        self.duplicate_updates = 0
+        self.duplicate_messages = 0
+        self.flushed_keys = 0
+
+    def _remember(self, key: str):
+        self._seen[key] = None
+        if len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+
+    async def load(self) -> Optional[int]:
+        """Восстанавливает ключи, offset и журнал необработанных апдейтов из БД; возвращает offset."""
+        async for db in get_db_session():
+            keys = await load_processed_keys(db, datetime.now().astimezone() - self.ttl, self.max_keys)
+            stored_offset = await get_bot_meta(db, POLLING_OFFSET_KEY)
+            self._pending_updates = await load_pending_updates(db, datetime.now().astimezone() - self.ttl)
+        for key in keys:
+            self._remember(key)
+        self._journaled.update(update_id for update_id, _ in self._pending_updates)
+        if stored_offset is not None:
+            self.offset = self._flushed_offset = self._max_completed = int(stored_offset)
+        logger.info(f"Loaded {len(keys)} processed update keys, {len(self._pending_updates)} unfinished updates, "
+                    f"polling offset {self.offset}")
+        return self.offset
+
+    async def acknowledge_offset(self, bot: Bot):
+        """getUpdates с offset подтверждает все апдейты до него: polling не получит их повторно."""
+        if self.offset is None:
+            return
+        await bot.get_updates(offset=self.offset + 1, limit=1, timeout=0)
+        logger.info(f"Acknowledged updates up to {self.offset}")
+
+    async def replay_pending(self, application: Application) -> int:
+        """Ставит в очередь апдейты, обработка которых прервалась при прошлом запуске."""
+        from telegram import Update
+
+        pending, self._pending_updates = self._pending_updates, []
+        for update_id, payload in pending:
+            await application.update_queue.put(Update.de_json(json.loads(payload), application.bot))
+        if pending:
+            self.replayed += len(pending)
+            logger.warning(f"Replaying {len(pending)} updates interrupted by the previous shutdown")
+        return len(pending)
+
+    def is_duplicate(self, update_id: int, chat_id: Optional[int] = None, message_id: Optional[int] = None) -> bool:
+        """Проверяет и сразу отмечает апдейт как обрабатываемый: из двух одинаковых параллельных пройдет один."""
+        key = update_key(update_id)
+        if key in self._seen or key in self._in_flight_keys:
+            self.duplicate_updates += 1
+            return True
+        msg_key = message_key(chat_id, message_id) if message_id is not None and chat_id is not None else None
+        if msg_key is not None and (msg_key in self._seen or msg_key in self._in_flight_keys):
+            self.duplicate_messages += 1
+            return True
+
+        self.accepted += 1
+        keys = [key] if msg_key is None else [key, msg_key]
+        self._in_flight[update_id] = keys
+        for in_flight_key in keys:
+            self._in_flight_keys[in_flight_key] = update_id
+        return False
+
+    def complete(self, update_id: int):
+        """Обработка апдейта завершена (в том числе с ошибкой): ключи можно сохранять, offset - продвигать."""
+        keys = self._in_flight.pop(update_id, None)
+        if keys is None:
+            return
+        for key in keys:
+            self._in_flight_keys.pop(key, None)
+            self._remember(key)
+            self._pending.append(key)
+        self._forget_journal(update_id)
+        self.completed += 1
+        if self._max_completed is None or update_id > self._max_completed:
+            self._max_completed = update_id
+        # Offset не перескакивает через апдейт, который еще обрабатывается
+        safe = self._max_completed
+        if self._in_flight:
+            safe = min(safe, min(self._in_flight) - 1)
+        if self.offset is None or safe > self.offset:
+            self.offset = safe
+
+    def _forget_journal(self, update_id: int):
+        """Апдейт больше не нужен в журнале: еще не записанный просто не пишется."""
+        self._unjournaled.pop(update_id, None)
+        if update_id in self._journaled:
+            self._journaled.discard(update_id)
+            self._done_update_ids.append(update_id)
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Callback TypeHandler в группе -1: повторный апдейт не доходит до остальных обработчиков."""
+        from telegram.ext import ApplicationHandlerStop
+
+        # Только новые сообщения: у отредактированного тот же message_id, но это не повтор
+        message = update.message
+        chat_id = message.chat_id if message else None
+        message_id = message.message_id if message else None
+        if self.is_duplicate(update.update_id, chat_id, message_id):
+            logger.info(f"Dropping duplicate update {update.update_id} (chat {chat_id}, message {message_id})")
+            if update.update_id not in self._in_flight:
+                # Повтор из журнала, сообщение которого уже обработано под другим update_id
+                self._forget_journal(update.update_id)
+            raise ApplicationHandlerStop()
+        if update.update_id not in self._journaled:
+            self._unjournaled[update.update_id] = json.dumps(update.to_dict(), ensure_ascii=False)
+
+    async def complete_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Callback TypeHandler в последней группе."""
+        self.complete(update.update_id)
+
+    async def flush(self, context: Optional[ContextTypes.DEFAULT_TYPE] = None):
+        """
+        Job: сохраняет ключи обработанных апдейтов и offset, пишет в журнал еще обрабатываемые апдейты
+        и удаляет из него обработанные; раз в час удаляет устаревшие ключи и записи журнала.
+        """
+        keys, self._pending = self._pending, []
+        done, self._done_update_ids = self._done_update_ids, []
+        journal, self._unjournaled = list(self._unjournaled.items()), {}
+        # Завершившийся во время записи апдейт попадет в done следующего сброса
+        self._journaled.update(update_id for update_id, _ in journal)
+        offset = self.offset if self.offset != self._flushed_offset else None
+        if keys or done or journal or offset is not None:
+            saved = None
+            try:
+                async for db in get_db_session():
+                    saved = await save_processed_keys(db, keys, offset, offset_key=POLLING_OFFSET_KEY,
+                                                      done_update_ids=done, journal=journal)
+            finally:
+                if not saved:
+                    # Сохраним при следующем сбросе; при конфликте (False) ключи уже записал другой процесс
+                    if saved is None:
+                        self._pending = keys + self._pending
+                    self._done_update_ids = done + self._done_update_ids
+                    for update_id, payload in journal:
+                        if update_id in self._in_flight:
+                            self._journaled.discard(update_id)
+                            self._unjournaled[update_id] = payload
+            if saved and offset is not None:
+                self._flushed_offset = offset
+            self.flushed_keys += len(keys)
+
+        if time.monotonic() - self._last_prune >= PRUNE_INTERVAL_SECONDS:
+            self._last_prune = time.monotonic()
+            async for db in get_db_session():
+                pruned = await prune_processed_keys(db, datetime.now().astimezone() - self.ttl)
+                pruned_journal = await prune_pending_updates(db, datetime.now().astimezone() - self.ttl)
+            if pruned or pruned_journal:
+                logger.info(f"Pruned {pruned} expired processed update keys and {pruned_journal} journal entries. "
+                            f"Stats: {self.stats()}")
+
+    def stats(self) -> Dict:
+        return {
+            "accepted": self.accepted,
+            "completed": self.completed,
+            "in_flight": len(self._in_flight),
+            "replayed": self.replayed,
+            "duplicate_updates": self.duplicate_updates,
+            "duplicate_messages": self.duplicate_messages,
+            "keys_in_memory": len(self._seen),
+            "pending_keys": len(self._pending),
+            "journaled": len(self._journaled),
+            "flushed_keys": self.flushed_keys,
+            "offset": self.offset,
+        }
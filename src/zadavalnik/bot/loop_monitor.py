@@ -0,0 +1,273 @@
+"""
+Здоровье цикла событий: синхронная работа в обработчиках (base64, разбор JSON, большие строки)
+задерживает всех пользователей сразу.
+
+- LoopMonitor измеряет задержку (lag) цикла: корутина просыпается каждые LOOP_MONITOR_INTERVAL_SECONDS,
+  опоздание попадает в гистограмму. Сторожевой поток замечает цикл, который не отвечает дольше
+  LOOP_STALL_THRESHOLD_MS, и логирует стек потока цикла - то есть код, который его занял.
+- SamplingProfiler по команде /profile N снимает стек потока цикла каждые LOOP_PROFILE_INTERVAL_MS
+  на время обработки следующих N апдейтов и возвращает самые горячие функции.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import selectors
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from zadavalnik.config import get_settings
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограммы задержки, мс
+LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+STACK_LIMIT = 25 # Кадров стека в логе зависания
+# Кадры самого цикла событий есть в каждом сэмпле и в отчете только мешают
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+_SELECTORS_FILE = os.path.splitext(selectors.__file__)[0]
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _is_idle(frame) -> bool:
+    """Цикл ждет событий в select/epoll - это простой, а не работа."""
+    return os.path.splitext(frame.f_code.co_filename)[0] == _SELECTORS_FILE
+
+
+def _is_loop_internal(frame) -> bool:
+    return frame.f_code.co_filename.startswith(_ASYNCIO_DIR) or frame.f_code.co_name == "<module>"
+
+
+class LagHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.total = 0
+        self.max_ms = 0.0
+
+    def record(self, lag_ms: float):
+        for index, bound in enumerate(LAG_BUCKETS_MS):
+            if lag_ms <= bound:
+                break
+        else:
+            index = len(LAG_BUCKETS_MS)
+        self.counts[index] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, lag_ms)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попал перцентиль (None - больше последней границы)."""
+        if not self.total:
+            return 0.0
+        threshold = self.total * fraction
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return LAG_BUCKETS_MS[index] if index < len(LAG_BUCKETS_MS) else None
+        return None
+
+    def snapshot(self) -> Dict:
+        labels = [f"<={bound}ms" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": self.total,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+
+class SamplingProfiler:
+    """Статистический профайлер одного потока: снимает его стек из фонового потока."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.idle_samples = 0
+        self.self_counts: Counter = Counter() # Функция наверху стека - здесь тратится время
+        self.total_counts: Counter = Counter() # Функция где-либо в стеке
+        self.started_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="loop-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            if _is_idle(frame):
+                self.idle_samples += 1
+                continue
+            self.samples += 1
+            self.self_counts[_frame_key(frame)] += 1
+            seen = set()
+            for stack_frame, _ in traceback.walk_stack(frame):
+                if _is_loop_internal(stack_frame):
+                    continue
+                key = _frame_key(stack_frame)
+                if key not in seen: # Рекурсия не считается дважды
+                    seen.add(key)
+                    self.total_counts[key] += 1
+
+    def report(self, top: int = 15) -> str:
+        duration = time.monotonic() - self.started_at
+        if not self.samples:
+            return f"Профиль пуст: за {duration:.1f} с цикл событий ни разу не был занят работой."
+
+        def lines(counter: Counter) -> List[str]:
+            return [f"{count * 100 / self.samples:5.1f}%  {key}" for key, count in counter.most_common(top)]
+
+        return "\n".join([
+            f"Профиль цикла событий за {duration:.1f} с: занят в {self.samples} сэмплах, "
+            f"простаивал в {self.idle_samples}. Проценты - от занятых сэмплов.",
+            "",
+            "Собственное время (верх стека):",
+            *lines(self.self_counts),
+            "",
+            "Включая вызванные функции:",
+            *lines(self.total_counts),
+        ])
+
+
+class LoopMonitor:
+    """Гистограмма задержки цикла событий, лог зависаний со стеком и профилирование по команде."""
+
+    def __init__(self, interval: Optional[float] = None, stall_threshold_ms: Optional[float] = None,
+                 report_interval: Optional[float] = None, profile_interval_ms: Optional[float] = None,
+                 profile_max_seconds: Optional[float] = None):
+        settings = get_settings()
+        self.interval = interval or settings.LOOP_MONITOR_INTERVAL_SECONDS
+        self.stall_threshold = (stall_threshold_ms or settings.LOOP_STALL_THRESHOLD_MS) / 1000
+        self.report_interval = report_interval or settings.LOOP_MONITOR_REPORT_SECONDS
+        self.profile_interval = (profile_interval_ms or settings.LOOP_PROFILE_INTERVAL_MS) / 1000
+        self.profile_max_seconds = profile_max_seconds or settings.LOOP_PROFILE_MAX_SECONDS
+        self.histogram = LagHistogram()
+        self.stalls = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._profiler: Optional[SamplingProfiler] = None
+        self._profile_remaining = 0
+        self._profile_after_update_id = 0
+        self._profile_done: Optional[Callable[[str], Any]] = None
+
+    def start(self):
+        """Запуск из работающего цикла событий."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+        self.cancel_profile()
+
+    async def _measure(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.histogram.record(max(0.0, now - expected) * 1000)
+            if now - last_report >= self.report_interval:
+                last_report = now
+                logger.info(f"Event loop lag: {self.histogram.snapshot()}, stalls: {self.stalls}")
+
+    def _watch(self):
+        """Сторожевой поток: если цикл не отвечает, логирует стек того, что его заняло (один раз на зависание)."""
+        reported_heartbeat = None
+        while not self._stop.wait(self.stall_threshold / 2):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.stall_threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame else "<no frame>"
+            logger.warning(f"Event loop blocked for {stalled_for * 1000:.0f} ms, loop thread stack:\n{stack}")
+
+    # Профилирование по команде
+
+    @property
+    def profiling(self) -> bool:
+        return self._profiler is not None
+
+    def start_profile(self, updates: int, after_update_id: int, on_done: Callable[[str], Any]) -> bool:
+        """Профилирует следующие updates апдейтов (с id больше after_update_id); отчет получает on_done."""
+        if self._profiler is not None:
+            return False
+        self._profile_remaining = updates
+        self._profile_after_update_id = after_update_id
+        self._profile_done = on_done
+        self._profiler = SamplingProfiler(self._loop_thread_id or threading.get_ident(), self.profile_interval)
+        self._profiler.start()
+        loop = self._loop or asyncio.get_running_loop()
+        # Если апдейтов нет, профиль завершается по времени
+        loop.call_later(self.profile_max_seconds, self._finish_profile, self._profiler)
+        logger.info(f"Profiling the next {updates} updates")
+        return True
+
+    async def count_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Callback TypeHandler в последней группе: апдейт обработан всеми обработчиками."""
+        if self._profiler is None or update.update_id <= self._profile_after_update_id:
+            return
+        self._profile_remaining -= 1
+        if self._profile_remaining <= 0:
+            self._finish_profile(self._profiler)
+
+    def _finish_profile(self, profiler: SamplingProfiler):
+        if self._profiler is not profiler:
+            return # Этот профиль уже завершен
+        self._profiler = None
+        profiler.stop()
+        report = profiler.report()
+        logger.info(f"Profile finished:\n{report}")
+        on_done, self._profile_done = self._profile_done, None
+        if on_done is not None:
+            on_done(report)
+
+    def cancel_profile(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+            self._profile_done = None
+
+    def stats(self) -> Dict:
+        return {**self.histogram.snapshot(), "stalls": self.stalls, "profiling": self.profiling}
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, List, Optional
+
+from zadavalnik.config import get_settings
+
+if TYPE_CHECKING:
+    from telegram import Bot
+
+logger = logging.getLogger(__name__)
+
+MERGE_SEPARATOR = "\n\n"
+MAX_MESSAGE_LENGTH = 4096 # telegram.constants.MessageLimit.MAX_TEXT_LENGTH
+LATENCY_WINDOW = 1000 # Сколько последних отправок учитывать в перцентилях латентности
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        """Flood control от Telegram: не отправлять ничего seconds секунд."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def acquire(self, reserve: float = 0.0):
+        """Ждет токен. reserve - сколько токенов оставить другим (для фоновых отправок)."""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 + reserve - self.tokens) / self.rate)
+
+
+class OutgoingMessage:
+    __slots__ = ("text", "kwargs", "action", "background", "future", "enqueued_at")
+
+    def __init__(self, text: Optional[str], kwargs: Dict[str, Any], action: Optional[str], background: bool):
+        self.text = text
+        self.kwargs = kwargs
+        self.action = action
+        self.background = background
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+    def mergeable(self) -> bool:
+        return self.action is None and not self.kwargs
+
+
+def _not_sent(error: Exception) -> bool:
+    """Ошибка PTB возникла до отправки запроса: не удалось соединиться или занят пул соединений."""
+    import httpx
+
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def _mark_exception_retrieved(future: asyncio.Future):
+    # Ошибку отправки уже залогировал Outbox; без этого asyncio ругается на неполученные исключения
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений с учетом лимитов Telegram:
+    - общий token bucket на бота и отдельный на каждый чат (в группах лимит строже);
+    - сообщения одного чата уходят строго по порядку, подряд идущие тексты склеиваются
+      в одно сообщение (до 4096 символов), если успели накопиться в очереди;
+    - RetryAfter выдерживается и отправка повторяется; при сетевых ошибках сообщение отправляется
+      повторно, только если запрос точно не дошел до Telegram (ошибка соединения, занят пул):
+      после таймаута записи или чтения сообщение обычно уже доставлено, и повтор задублировал бы
+      вопрос. Статус "печатает..." повторяется при любой сетевой ошибке.
+
+    send() не ждет отправки и возвращает Future с отправленным сообщением (или ошибкой).
+    Фоновые отправки (напоминания) не расходуют последние OUTBOX_BACKGROUND_RESERVE токенов
+    общего лимита, чтобы не задерживать ответы в тестах.
+    """
+
+    def __init__(self, bot: Bot):
+        settings = get_settings()
+        self.bot = bot
+        self.global_bucket = TokenBucket(settings.OUTBOX_GLOBAL_RATE, settings.OUTBOX_GLOBAL_BURST)
+        self.chat_rate = settings.OUTBOX_CHAT_RATE
+        self.chat_burst = settings.OUTBOX_CHAT_BURST
+        self.group_chat_rate = settings.OUTBOX_GROUP_CHAT_RATE
+        self.merge_window = settings.OUTBOX_MERGE_WINDOW_SECONDS
+        self.max_retries = settings.OUTBOX_MAX_RETRIES
+        # Резерв меньше емкости бакета, иначе фоновые сообщения не уйдут никогда
+        self.background_reserve = min(settings.OUTBOX_BACKGROUND_RESERVE, settings.OUTBOX_GLOBAL_BURST - 1)
+        self._queues: Dict[int, Deque[OutgoingMessage]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    def _enqueue(self, chat_id: int, item: OutgoingMessage) -> asyncio.Future:
+        item.future.add_done_callback(_mark_exception_retrieved)
+        self._queues.setdefault(chat_id, deque()).append(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain_chat(chat_id))
+        return item.future
+
+    def send(self, chat_id: int, text: str, background: bool = False, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь чата. kwargs передаются в Bot.send_message (такие не склеиваются)."""
+        return self._enqueue(chat_id, OutgoingMessage(text, kwargs, None, background))
+
+    def send_chat_action(self, chat_id: int, action: str = "typing") -> asyncio.Future:
+        """Статус "печатает..." идет через ту же очередь, чтобы не опередить и не сбросить его сообщением."""
+        return self._enqueue(chat_id, OutgoingMessage(None, {}, action, False))
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Полные бакеты неактивных чатов ничего не ограничивают - их можно забыть
+                for idle_chat_id in [cid for cid, b in self._chat_buckets.items() if cid not in self._workers and b.is_full()]:
+                    del self._chat_buckets[idle_chat_id]
+            rate = self.group_chat_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _take_batch(self, queue: Deque[OutgoingMessage]) -> List[OutgoingMessage]:
+        """Первое сообщение очереди и идущие за ним тексты, которые помещаются в одно сообщение."""
+        batch = [queue.popleft()]
+        if not batch[0].mergeable():
+            return batch
+        length = len(batch[0].text)
+        while queue and queue[0].mergeable() and queue[0].background == batch[0].background:
+            next_length = length + len(MERGE_SEPARATOR) + len(queue[0].text)
+            if next_length > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(queue.popleft())
+            length = next_length
+        return batch
+
+    async def _drain_chat(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                if self.merge_window and queue[0].mergeable():
+                    await asyncio.sleep(self.merge_window) # Даем обработчику дописать следующие сообщения хода
+                # Сообщения, пришедшие пока ждем лимитов, тоже попадут в склейку
+                if queue[0].action is None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire(self.background_reserve if queue[0].background else 0.0)
+                await self._deliver(chat_id, self._take_batch(queue))
+        finally:
+            del self._workers[chat_id]
+            if queue:
+                # Воркер отменен (остановка бота) - оставшиеся сообщения не будут отправлены
+                for item in queue:
+                    item.future.cancel()
+            del self._queues[chat_id]
+
+    async def _deliver(self, chat_id: int, batch: List[OutgoingMessage]):
+        # telegram импортируется лениво, как и в обработчиках
+        from telegram.error import NetworkError, RetryAfter, TimedOut
+
+        first = batch[0]
+        for attempt in range(self.max_retries + 1):
+            try:
+                if first.action:
+                    result = await self.bot.send_chat_action(chat_id=chat_id, action=first.action)
+                else:
+                    text = MERGE_SEPARATOR.join(item.text for item in batch)
+                    result = await self.bot.send_message(chat_id=chat_id, text=text, **first.kwargs)
+                break
+            except RetryAfter as e:
+                self.retries += 1
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                self.global_bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TimedOut, NetworkError) as e:
+                if not first.action and not _not_sent(e):
+                    logger.warning(f"Message to chat {chat_id} may have been delivered despite {e!r}, not retrying")
+                    self._fail(chat_id, batch, e)
+                    return
+                if attempt == self.max_retries:
+                    self._fail(chat_id, batch, e)
+                    return
+                self.retries += 1
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                self._fail(chat_id, batch, e)
+                return
+        else:
+            self._fail(chat_id, batch, RuntimeError("flood control retries exhausted"))
+            return
+
+        now = time.monotonic()
+        if first.action is None:
+            self.sent += 1
+            self.merged += len(batch) - 1
+            for item in batch:
+                self._latencies.append(now - item.enqueued_at)
+            if self.sent % 200 == 0:
+                logger.info(f"Outbox stats: {self.stats()}")
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def _fail(self, chat_id: int, batch: List[OutgoingMessage], error: Exception):
+        self.failed += 1
+        logger.warning(f"Failed to send {len(batch)} queued message(s) to chat {chat_id}: {error}")
+        for item in batch:
+            if not item.future.done():
+                item.future.set_exception(error)
+
+    async def close(self, timeout: float = 5.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеры."""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Outbox closed with {len(pending)} chat queue(s) not fully sent")
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(fraction: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))], 3)
+
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "active_chats": len(self._workers),
+            "sent": self.sent,
+            "merged": self.merged,
+            "retries": self.retries,
+            "failed": self.failed,
+            "latency_p50_s": percentile(0.5),
+            "latency_p95_s": percentile(0.95),
+        }
@@ -0,0 +1,57 @@
+import logging
+
+import httpx
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+
+class PooledHTTPXRequest(HTTPXRequest):
+    """
+    HTTPXRequest с настраиваемыми keep-alive и HTTP/2.
+
+    В PTB 20.0 конструктор принимает только размер пула и таймауты, а keep-alive
+    всегда равен размеру пула; поэтому лимиты подменяются в _client_kwargs,
+    из которых PTB пересоздает клиент в initialize(). Это внутренний атрибут PTB
+    (версия закреплена в pyproject.toml): если его нет, остается клиент PTB по умолчанию.
+    """
+
+    def __init__(self, connection_pool_size: int, max_keepalive_connections: int,
+                 keepalive_expiry: float, http2: bool = False, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        client_kwargs = getattr(self, "_client_kwargs", None)
+        if not isinstance(client_kwargs, dict) or not hasattr(self, "_build_client"):
+            logger.warning("HTTPXRequest internals changed; keep-alive and HTTP/2 settings are ignored")
+            return
+        client_kwargs["limits"] = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=min(max_keepalive_connections, connection_pool_size),
+            keepalive_expiry=keepalive_expiry,
+        )
+        client_kwargs["http2"] = http2
+        self._client = self._build_client()
+
+
+def build_telegram_requests(settings):
+    """Возвращает (request, get_updates_request): отдельные пулы для обработчиков и long polling."""
+    request = PooledHTTPXRequest(
+        connection_pool_size=settings.TELEGRAM_HTTP_POOL_SIZE,
+        max_keepalive_connections=settings.TELEGRAM_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.TELEGRAM_HTTP_KEEPALIVE_EXPIRY,
+        http2=settings.TELEGRAM_HTTP2,
+        connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+        write_timeout=settings.TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=settings.TELEGRAM_POOL_TIMEOUT,
+    )
+    get_updates_request = PooledHTTPXRequest(
+        connection_pool_size=settings.TELEGRAM_GET_UPDATES_POOL_SIZE,
+        max_keepalive_connections=settings.TELEGRAM_GET_UPDATES_POOL_SIZE,
+        keepalive_expiry=settings.TELEGRAM_HTTP_KEEPALIVE_EXPIRY,
+        http2=settings.TELEGRAM_HTTP2,
+        connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=settings.TELEGRAM_GET_UPDATES_READ_TIMEOUT,
+        write_timeout=settings.TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=settings.TELEGRAM_POOL_TIMEOUT,
+    )
+    return request, get_updates_request
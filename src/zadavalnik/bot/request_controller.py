@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from zadavalnik.bot.admission import AdmissionController, Priority
+from zadavalnik.bot.chat_lock import released
+from zadavalnik.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Грубая оценка для статистики: ~4 символа на токен, изображение ~1000 токенов
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS_ESTIMATE = 1000
+
+
+def estimate_prompt_tokens(messages: List[Dict]) -> int:
+    """Приблизительное число токенов в запросе (без вызова токенизатора)."""
+    total_chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            total_chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total_chars += len(part.get("text", ""))
+                else:
+                    images += 1
+    return total_chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS_ESTIMATE
+
+
+class ChatLLMState:
+    """Состояние LLM-запросов одного чата (хранится в context.chat_data)."""
+
+    def __init__(self):
+        self.generation = 0  # Увеличивается при сбросе теста: ответы старых поколений отбрасываются
+        self.task: Optional[asyncio.Task] = None
+        self.task_tokens = 0
+        self.task_sent = False  # Запрос прошел допуск и отправлен: отмена уже не экономит токены
+        self.collecting = False
+        self.pending_answers: List[str] = []
+        self.in_flight_answers: List[str] = []
+
+
+class LLMRequestController:
+    """
+    Управляет вызовами OpenAIClient из обработчиков в рамках одного чата:
+    - cancel() отменяет текущий запрос при сбросе теста (/newtest и т.п.);
+    - collect_answer() отправляет ответ сразу, а ответ, пришедший во время хода, склеивает
+      с ним в один новый ход;
+    - run() выполняет запрос и возвращает None, если он был отменен или устарел.
+    Все запросы проходят через общий AdmissionController (admission): при перегрузке ходы
+    идущих тестов выполняются раньше новых тестов, а новые ждут в очереди или отклоняются.
+    На время ожидания блокировка чата (chat_lock) отпускается: другие апдейты чата
+    могут присоединить ответ или отменить запрос.
+    """
+
+    STATE_KEY = 'llm_state'
+
+    def __init__(self, coalesce_window: Optional[float] = None, admission: Optional[AdmissionController] = None):
+        settings = get_settings()
+        self.admission = admission or AdmissionController()
+        self.coalesce_window = coalesce_window if coalesce_window is not None else settings.LLM_COALESCE_WINDOW_SECONDS
+        self.cancelled_calls = 0
+        self.saved_tokens_estimate = 0  # Отменены до отправки (в очереди допуска)
+        self.wasted_tokens_estimate = 0  # Отменены после отправки: провайдер все равно их посчитает
+        self.coalesced_answers = 0
+        self.dropped_stale = 0
+
+    def _state(self, chat_data: Dict) -> ChatLLMState:
+        state = chat_data.get(self.STATE_KEY)
+        if state is None:
+            state = chat_data[self.STATE_KEY] = ChatLLMState()
+        return state
+
+    def _cancel_task(self, state: ChatLLMState) -> bool:
+        if state.task is None or state.task.done():
+            return False
+        state.task.cancel()
+        state.task = None  # Задача завершится не сразу: повторная отмена не должна считаться еще раз
+        self.cancelled_calls += 1
+        if state.task_sent:
+            self.wasted_tokens_estimate += state.task_tokens
+        else:
+            self.saved_tokens_estimate += state.task_tokens
+        return True
+
+    def cancel(self, chat_data: Optional[Dict]) -> bool:
+        """Отменяет текущий запрос чата и делает устаревшими все ожидающие ответы."""
+        if chat_data is None or self.STATE_KEY not in chat_data:
+            return False
+        state = self._state(chat_data)
+        state.generation += 1
+        state.pending_answers = []
+        state.in_flight_answers = []
+        cancelled = self._cancel_task(state)
+        if cancelled:
+            logger.info(f"Cancelled superseded LLM call. Stats: {self.stats()}")
+        return cancelled
+
+    async def collect_answer(self, chat_data: Dict, text: str) -> Optional[str]:
+        """
+        Регистрирует ответ пользователя. Возвращает склеенный текст хода, если этот вызов
+        отвечает за отправку хода в LLM, или None, если ответ присоединен к другому ходу.
+        """
+        state = self._state(chat_data)
+        state.pending_answers.append(text)
+        if state.collecting:
+            self.coalesced_answers += 1
+            return None
+
+        if self._cancel_task(state):
+            # Ход по предыдущим ответам еще в полете - отменяем его и отправляем все ответы одним ходом
+            self.coalesced_answers += 1
+            state.pending_answers = state.in_flight_answers + state.pending_answers
+            logger.info(f"Re-issuing LLM turn with {len(state.pending_answers)} coalesced answers")
+
+        if self.coalesce_window > 0:
+            generation = state.generation
+            state.collecting = True
+            try:
+                async with released():
+                    await asyncio.sleep(self.coalesce_window)
+            finally:
+                state.collecting = False
+            if state.generation != generation or not state.pending_answers:
+                return None
+
+        answers, state.pending_answers = state.pending_answers, []
+        state.in_flight_answers = answers
+        return "\n".join(answers)
+
+    async def run(self, chat_data: Dict, call: Callable[[], Awaitable[Any]], estimated_tokens: int = 0,
+                  priority: Priority = Priority.START, on_queued: Optional[Callable[[int], Any]] = None) -> Optional[Any]:
+        """
+        Выполняет LLM-запрос; None - запрос отменен или его результат устарел.
+        Ожидание в очереди допуска тоже отменяется при сбросе теста. AdmissionRejected пробрасывается.
+        """
+        state = self._state(chat_data)
+        self._cancel_task(state)  # В чате одновременно выполняется не больше одного запроса
+        generation = state.generation
+
+        async def admitted_call():
+            async with self.admission.slot(priority, on_queued):
+                if state.task is task:
+                    state.task_sent = True
+                return await call()
+
+        task = asyncio.ensure_future(admitted_call())
+        state.task = task
+        state.task_tokens = estimated_tokens
+        state.task_sent = False
+        try:
+            async with released():
+                await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()  # Отменили сам обработчик (например, при остановке бота)
+            raise
+        finally:
+            if state.task is task:
+                state.task = None
+                state.in_flight_answers = []
+
+        if task.cancelled():
+            return None
+        if state.generation != generation:
+            self.dropped_stale += 1
+            logger.info("Dropped stale LLM response for a reset test session")
+            return None
+        return task.result()
+
+    def stats(self) -> Dict:
+        return {
+            "cancelled_calls": self.cancelled_calls,
+            "saved_tokens_estimate": self.saved_tokens_estimate,
+            "wasted_tokens_estimate": self.wasted_tokens_estimate,
+            "coalesced_answers": self.coalesced_answers,
+            "dropped_stale": self.dropped_stale,
+            "admission": self.admission.stats(),
+        }
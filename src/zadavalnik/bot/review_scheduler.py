@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from telegram.error import Forbidden, BadRequest
+
+from zadavalnik.config import get_settings
+from zadavalnik.bot.outbox import Outbox
+from zadavalnik.database.db import (
+    get_db_session,
+    get_review_schedule,
+    save_review_schedule,
+    load_pending_reviews,
+    mark_reviews_reminded
+)
+from zadavalnik.database.models import ReviewSchedule
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+MIN_EASE_FACTOR = 1.3
+# Темы тестов по материалам: сами материалы не сохраняются, поэтому тест по ним не перезапустить
+DOCUMENT_TOPIC_PREFIX = "Документ: "
+IMAGE_FALLBACK_TOPIC = "Тест по изображению"
+
+
+def is_material_topic(topic: str) -> bool:
+    return topic.startswith(DOCUMENT_TOPIC_PREFIX) or topic == IMAGE_FALLBACK_TOPIC
+
+
+def review_reminder_text(schedule_id: int, topic: str) -> str:
+    if is_material_topic(topic):
+        return (f"Пора повторить тему «{topic}»! Отправьте /newtest и пришлите материал снова, "
+                "чтобы закрепить его.")
+    return f"Пора повторить тему «{topic}»! Нажмите /review_{schedule_id}, чтобы пройти тест по ней снова."
+
+
+def compute_next_review(repetitions: int, interval_days: float, ease_factor: float,
+                        score: float) -> Tuple[int, float, float]:
+    """Упрощенный SM-2: по доле правильных ответов (0..1) считает новые repetitions, интервал и ease."""
+    quality = round(max(0.0, min(1.0, score)) * 5)
+    if quality < 3:
+        # Тему не усвоили - повторяем завтра и начинаем цепочку заново
+        repetitions = 0
+        interval_days = 1.0
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval_days = 1.0
+        elif repetitions == 2:
+            interval_days = 6.0
+        else:
+            interval_days = round(interval_days * ease_factor, 2)
+    ease_factor = max(MIN_EASE_FACTOR, ease_factor + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return repetitions, interval_days, ease_factor
+
+
+class ReviewScheduler:
+    """
+    Очередь напоминаний о повторении.
+
+    В памяти хранится min-heap (due_ts, schedule_id, user_id, topic) только для
+    еще не напомненных повторений. Тик достает из вершины кучи лишь созревшие
+    записи, поэтому его стоимость зависит от числа отправляемых напоминаний,
+    а не от размера таблицы.
+
+    Для каждой записи запоминается next_review_at из БД: напоминание отмечается
+    только для этого срока, и перенос темы во время отправки его не теряет.
+    """
+
+    def __init__(self, batch_size: Optional[int] = None):
+        settings = get_settings()
+        self.batch_size = batch_size or settings.REVIEW_BATCH_SIZE
+        self.retry_delay = settings.REVIEW_TICK_SECONDS
+        self._heap: List[Tuple[float, int, int, str]] = []
+        self._due: Dict[int, float] = {} # schedule_id -> актуальный due_ts (для ленивого удаления из кучи)
+        self._review_at: Dict[int, datetime] = {} # schedule_id -> next_review_at в БД
+        self._tick_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    async def load(self):
+        """Восстанавливает кучу из БД при старте бота."""
+        async for db in get_db_session():
+            rows = await load_pending_reviews(db)
+        self._heap = []
+        self._due = {}
+        self._review_at = {}
+        for schedule_id, user_id, topic, next_review_at in rows:
+            due_ts = next_review_at.timestamp()
+            self._heap.append((due_ts, schedule_id, user_id, topic))
+            self._due[schedule_id] = due_ts
+            self._review_at[schedule_id] = next_review_at
+        heapq.heapify(self._heap)
+        logger.info(f"Review scheduler loaded {len(self._due)} pending reviews.")
+
+    def push(self, schedule_id: int, user_id: int, topic: str, due_ts: float, review_at: datetime):
+        """Добавляет или переносит повторение. Старая запись в куче станет устаревшей и будет пропущена."""
+        self._due[schedule_id] = due_ts
+        self._review_at[schedule_id] = review_at
+        heapq.heappush(self._heap, (due_ts, schedule_id, user_id, topic))
+
+    async def record_test_result(self, user_id: int, topic: str, correct: int, total: int):
+        """Обновляет расписание темы по итогам теста и ставит следующее повторение в очередь."""
+        if not topic or total <= 0:
+            return
+        score = correct / total
+        async for db in get_db_session():
+            schedule = await get_review_schedule(db, user_id, topic)
+            if schedule is None:
+                schedule = ReviewSchedule(user_id=user_id, topic=topic, repetitions=0,
+                                          interval_days=1.0, ease_factor=2.5)
+            schedule.repetitions, schedule.interval_days, schedule.ease_factor = compute_next_review(
+                schedule.repetitions, schedule.interval_days, schedule.ease_factor, score
+            )
+            schedule.last_score = score
+            schedule.next_review_at = datetime.now() + timedelta(days=schedule.interval_days)
+            schedule.reminder_sent = False
+            schedule = await save_review_schedule(db, schedule)
+        self.push(schedule.id, user_id, topic, schedule.next_review_at.timestamp(), schedule.next_review_at)
+        logger.info(f"Next review of '{topic}' for user {user_id} in {schedule.interval_days} days (score {score:.2f})")
+
+    def _pop_due_batch(self, now: float) -> List[Tuple[int, int, str, datetime]]:
+        """Созревшие (schedule_id, user_id, topic, next_review_at)."""
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            due_ts, schedule_id, user_id, topic = heapq.heappop(self._heap)
+            if self._due.get(schedule_id) != due_ts:
+                continue # Запись устарела: повторение перенесено или уже отправлено
+            del self._due[schedule_id]
+            batch.append((schedule_id, user_id, topic, self._review_at.pop(schedule_id)))
+        return batch
+
+    async def tick(self, context: "ContextTypes.DEFAULT_TYPE"):
+        """Callback для JobQueue: отправляет очередную пачку созревших напоминаний."""
+        if self._tick_lock.locked():
+            return # Предыдущая пачка еще отправляется
+        async with self._tick_lock:
+            batch = self._pop_due_batch(time.time())
+            if not batch:
+                return
+
+            # Темп отправки задает Outbox: фоновые напоминания не отнимают лимит у ответов в тестах
+            outbox = context.application.bot_data.get('outbox')
+            if outbox is None:
+                outbox = context.application.bot_data['outbox'] = Outbox(context.bot)
+            results = await asyncio.gather(
+                *(
+                    outbox.send(user_id, review_reminder_text(schedule_id, topic), background=True)
+                    for schedule_id, user_id, topic, _ in batch
+                ),
+                return_exceptions=True
+            )
+
+            reminded = []
+            for (schedule_id, user_id, topic, review_at), result in zip(batch, results):
+                if isinstance(result, (Forbidden, BadRequest)):
+                    # Пользователь заблокировал бота или чат недоступен - больше не напоминаем
+                    logger.info(f"Cannot send review reminder to user {user_id}: {result}")
+                    reminded.append((schedule_id, review_at))
+                elif isinstance(result, BaseException):
+                    logger.error(f"Failed to send review reminder to user {user_id}: {result}")
+                    if schedule_id not in self._due: # Не перенесено заново, пока шла отправка
+                        self.push(schedule_id, user_id, topic, time.time() + self.retry_delay, review_at)
+                else:
+                    reminded.append((schedule_id, review_at))
+
+            async for db in get_db_session():
+                await mark_reviews_reminded(db, reminded)
+            logger.info(f"Sent {len(reminded)} review reminders, {len(self)} pending.")
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from zadavalnik.ai import prompts
+from zadavalnik.config import get_settings
+from zadavalnik.database.db import get_db_session, mark_attempts_aborted
+from zadavalnik.bot.states import UserState
+from zadavalnik.bot.request_controller import LLMRequestController
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+HISTORY_KEY = 'gpt_chat_history'
+# Меньшие истории сжимаются прямо в цикле событий, большие (с изображениями, документами) - в пуле потоков
+THREAD_COMPRESS_THRESHOLD = 64 * 1024
+
+
+class CompressedHistory:
+    """
+    История диалога с ИИ в сжатом виде (zlib от компактного JSON).
+    Общий системный промпт не копируется в каждую сессию: хранится только признак его наличия.
+    """
+
+    __slots__ = ("blob", "raw_bytes", "messages", "has_system")
+
+    def __init__(self, blob: bytes, raw_bytes: int, messages: int, has_system: bool):
+        self.blob = blob
+        self.raw_bytes = raw_bytes
+        self.messages = messages
+        self.has_system = has_system
+
+    @classmethod
+    def pack(cls, history: List[Dict], level: int = 6) -> "CompressedHistory":
+        has_system = bool(history) and history[0] == prompts.SYSTEM_MESSAGE
+        payload = json.dumps(history[1:] if has_system else history, ensure_ascii=False, separators=(",", ":"))
+        raw = payload.encode("utf-8")
+        return cls(zlib.compress(raw, level), len(raw), len(history), has_system)
+
+    def unpack(self) -> List[Dict]:
+        history = json.loads(zlib.decompress(self.blob))
+        if self.has_system:
+            history.insert(0, prompts.SYSTEM_MESSAGE)
+        return history
+
+    def __len__(self) -> int:
+        return len(self.blob)
+
+
+class SessionStore:
+    """
+    Хранилище сессий тестов с ограничением по памяти:
+    - история диалога лежит в user_data в сжатом виде (CompressedHistory) и распаковывается на время хода;
+    - после завершения теста история (с исходными изображениями и документами) удаляется;
+    - sweep() (job JobQueue) удаляет user_data и chat_data личного чата (его id совпадает с user_id)
+      сессий, простаивающих дольше SESSION_IDLE_TTL_SECONDS, а при превышении SESSION_MEMORY_BUDGET_MB -
+      самые давно неактивные сессии. Сессия с запросом к ИИ в полете или с апдейтом в обработке
+      не вытесняется: обработчик допишет результат в уже удаленный словарь.
+    """
+
+    def __init__(self, memory_budget_bytes: Optional[int] = None, idle_ttl: Optional[float] = None,
+                 compression_level: Optional[int] = None, clock: Callable[[], float] = time.monotonic):
+        settings = get_settings()
+        self.memory_budget_bytes = memory_budget_bytes or settings.SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+        self.idle_ttl = idle_ttl or settings.SESSION_IDLE_TTL_SECONDS
+        self.compression_level = compression_level if compression_level is not None else settings.SESSION_COMPRESSION_LEVEL
+        self.clock = clock
+        self._last_seen: "OrderedDict[int, float]" = OrderedDict() # user_id -> время последнего апдейта, от старых к новым
+        self.evicted_idle = 0
+        self.evicted_budget = 0
+        self.released_histories = 0
+
+    def touch(self, user_id: int):
+        self._last_seen[user_id] = self.clock()
+        self._last_seen.move_to_end(user_id)
+
+    async def touch_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Callback TypeHandler: отмечает активность пользователя на любом апдейте."""
+        if update.effective_user:
+            self.touch(update.effective_user.id)
+
+    async def save_history(self, user_data: Dict, history: List[Dict]):
+        level = self.compression_level
+        if sum(len(str(message.get("content", ""))) for message in history) > THREAD_COMPRESS_THRESHOLD:
+            user_data[HISTORY_KEY] = await asyncio.to_thread(CompressedHistory.pack, history, level)
+        else:
+            user_data[HISTORY_KEY] = CompressedHistory.pack(history, level)
+
+    async def load_history(self, user_data: Dict) -> List[Dict]:
+        stored = user_data.get(HISTORY_KEY)
+        if stored is None:
+            return []
+        if isinstance(stored, list):
+            return stored # Сессия, начатая до появления сжатия
+        if stored.raw_bytes > THREAD_COMPRESS_THRESHOLD:
+            return await asyncio.to_thread(stored.unpack)
+        return stored.unpack()
+
+    def release(self, user_data: Dict):
+        """Тест завершен: история и результаты вопросов (уже сохраненные в БД) больше не нужны."""
+        if user_data.pop(HISTORY_KEY, None) is not None:
+            self.released_histories += 1
+        user_data.pop('question_results', None)
+        user_data.pop('last_question_text', None)
+        user_data.pop('test_plan', None)
+
+    @staticmethod
+    def session_bytes(user_data: Dict) -> int:
+        stored = user_data.get(HISTORY_KEY)
+        if stored is None:
+            return 0
+        if isinstance(stored, CompressedHistory):
+            return len(stored)
+        return sum(len(str(message.get("content", ""))) for message in stored)
+
+    @staticmethod
+    def _is_busy(application: Application, user_id: int) -> bool:
+        chat_locks = getattr(application, 'chat_locks', None)
+        if chat_locks is not None and chat_locks.is_busy(user_id):
+            return True
+        llm_state = (application.chat_data.get(user_id) or {}).get(LLMRequestController.STATE_KEY)
+        return llm_state is not None and llm_state.task is not None and not llm_state.task.done()
+
+    def _evict(self, application: Application, user_id: int, aborted_attempts: List[int]) -> bool:
+        """Удаляет user_data и chat_data личного чата; False - сессия занята и оставлена."""
+        if self._is_busy(application, user_id):
+            return False
+        user_data = application.user_data.get(user_id) or {}
+        if user_data.get('current_state') == UserState.IN_TEST and user_data.get('active_test_attempt_id'):
+            aborted_attempts.append(user_data['active_test_attempt_id'])
+        application.drop_user_data(user_id)
+        application.drop_chat_data(user_id) # llm_state, альбомы (media_groups) и т.п.
+        self._last_seen.pop(user_id, None)
+        return True
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: вытеснение простаивающих сессий и соблюдение бюджета памяти."""
+        application = context.application
+        now = self.clock()
+        aborted_attempts: List[int] = []
+
+        private_chats = [chat_id for chat_id in application.chat_data if chat_id > 0] # У групп id отрицательные
+        for user_id in [*application.user_data, *private_chats]:
+            if user_id not in self._last_seen:
+                self.touch(user_id) # Пользователь известен, но апдейтов с ним еще не видели (например, после рестарта)
+        for user_id, last_seen in list(self._last_seen.items()):
+            if now - last_seen < self.idle_ttl:
+                break # Дальше только более свежие сессии
+            if self._evict(application, user_id, aborted_attempts):
+                self.evicted_idle += 1
+
+        total_bytes = sum(self.session_bytes(user_data) for user_data in application.user_data.values())
+        if total_bytes > self.memory_budget_bytes:
+            for user_id in list(self._last_seen):
+                if total_bytes <= self.memory_budget_bytes:
+                    break
+                size = self.session_bytes(application.user_data.get(user_id) or {})
+                if not size or not self._evict(application, user_id, aborted_attempts):
+                    continue
+                self.evicted_budget += 1
+                total_bytes -= size
+            logger.warning(f"Session memory budget exceeded, evicted least recently used sessions. Stats: {self.stats(application)}")
+
+        if aborted_attempts:
+            async for db in get_db_session():
+                await mark_attempts_aborted(db, aborted_attempts)
+        logger.info(f"Session store: {self.stats(application)}")
+
+    def session_stats(self, application: Application, limit: int = 5) -> List[Dict]:
+        """Самые большие сессии: user_id, сжатый и исходный размер истории, число сообщений, простой."""
+        now = self.clock()
+        sessions = []
+        for user_id, user_data in application.user_data.items():
+            stored = user_data.get(HISTORY_KEY)
+            sessions.append({
+                "user_id": user_id,
+                "bytes": self.session_bytes(user_data),
+                "raw_bytes": stored.raw_bytes if isinstance(stored, CompressedHistory) else self.session_bytes(user_data),
+                "messages": len(stored) if isinstance(stored, list) else (stored.messages if stored else 0),
+                "idle_s": round(now - self._last_seen.get(user_id, now)),
+            })
+        sessions.sort(key=lambda session: -session["bytes"])
+        return sessions[:limit]
+
+    def stats(self, application: Application) -> Dict:
+        total_bytes = 0
+        raw_bytes = 0
+        with_history = 0
+        for user_data in application.user_data.values():
+            stored = user_data.get(HISTORY_KEY)
+            if stored is None:
+                continue
+            with_history += 1
+            size = self.session_bytes(user_data)
+            total_bytes += size
+            raw_bytes += stored.raw_bytes if isinstance(stored, CompressedHistory) else size
+        return {
+            "sessions": len(application.user_data),
+            "chats": len(application.chat_data),
+            "sessions_with_history": with_history,
+            "history_bytes": total_bytes,
+            "history_raw_bytes": raw_bytes,
+            "budget_bytes": self.memory_budget_bytes,
+            "evicted_idle": self.evicted_idle,
+            "evicted_budget": self.evicted_budget,
+            "released_histories": self.released_histories,
+            "largest": self.session_stats(application),
+        }
@@ -0,0 +1,12 @@
+# Легковесная точка доступа к настройкам: pydantic_settings импортируется и .env читается
+# только при первом обращении, а не при импорте модулей бота.
+
+def load_settings(**overrides):
+    """Явно загружает настройки из окружения и .env (вызывается при старте приложения)."""
+    from zadavalnik.config import settings as settings_module
+    return settings_module.load_settings(**overrides)
+
+def get_settings():
+    """Возвращает загруженные настройки, загружая их при первом обращении."""
+    from zadavalnik.config import settings as settings_module
+    return settings_module.get_settings()
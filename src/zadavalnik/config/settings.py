@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -14,8 +16,115 @@ class Settings(BaseSettings):
     # OPENAI_MODEL: str = "grok-3-mini-beta"  # Хорошо, но дороговато
 
     OPENAI_API_URL: str = "https://bothub.chat/api/v2/openai/v1"
+    OPENAI_STRUCTURED_OUTPUTS: bool = True # Ходы теста по JSON Schema; если модель не поддерживает - json_object
     MAX_TESTS_PER_DAY: int = 5 # Максимальное количество тестов в день на пользователя
 
+    # Интервальное повторение
+    REVIEW_TICK_SECONDS: int = 30 # Как часто проверять очередь повторений
+    REVIEW_BATCH_SIZE: int = 100 # Максимум напоминаний за один тик
+
+    # HTTP-пул клиента OpenAI
+    OPENAI_HTTP_MAX_CONNECTIONS: int = 100 # Одновременных запросов к LLM
+    OPENAI_HTTP_MAX_KEEPALIVE: int = 20 # Сколько простаивающих соединений держать открытыми
+    OPENAI_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    OPENAI_HTTP2: bool = False # Требует пакет h2 (pip install zadavalnik[http2])
+    OPENAI_CONNECT_TIMEOUT: float = 5.0
+    OPENAI_READ_TIMEOUT: float = 120.0 # Генерация теста может идти долго
+    OPENAI_WRITE_TIMEOUT: float = 30.0 # Запросы с изображениями бывают большими
+    OPENAI_POOL_TIMEOUT: float = 10.0 # Ожидание свободного соединения из пула
+
+    # HTTP-пул исходящих запросов к Telegram (sendMessage, getFile, sendChatAction...)
+    TELEGRAM_HTTP_POOL_SIZE: int = 64
+    TELEGRAM_HTTP_MAX_KEEPALIVE: int = 32
+    TELEGRAM_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    TELEGRAM_HTTP2: bool = False
+    TELEGRAM_CONNECT_TIMEOUT: float = 5.0
+    TELEGRAM_READ_TIMEOUT: float = 10.0
+    TELEGRAM_WRITE_TIMEOUT: float = 20.0
+    TELEGRAM_POOL_TIMEOUT: float = 5.0
+    # Отдельный пул для getUpdates, чтобы long polling не занимал соединения обработчиков
+    TELEGRAM_GET_UPDATES_POOL_SIZE: int = 1
+    TELEGRAM_GET_UPDATES_READ_TIMEOUT: float = 30.0
+    TELEGRAM_CONCURRENT_UPDATES: int = 64 # Сколько апдейтов обрабатывать параллельно (апдейты одного чата - по очереди)
+    TELEGRAM_WAITING_UPDATES: int = 1024 # Сколько апдейтов может ждать очереди своего чата, не занимая слоты обработки
+
+    # Альбомы (media group): фото одного альбома приходят отдельными апдейтами
+    MEDIA_GROUP_WINDOW_SECONDS: float = 1.5 # Сколько ждать остальные фото альбома
+    MEDIA_GROUP_MAX_IMAGES: int = 10 # Максимум изображений в одном запросе к ИИ (в альбоме Telegram до 10)
+
+    # Ответ, пришедший, пока ход еще в полете, склеивается с ним в один запрос к ИИ.
+    # Окно > 0 дополнительно задерживает каждый ход, чтобы дождаться следующих сообщений
+    LLM_COALESCE_WINDOW_SECONDS: float = 0.0
+
+    # Допуск запросов к ИИ при перегрузке: ходы идущих тестов важнее новых тестов
+    LLM_MAX_IN_FLIGHT: int = 32 # Одновременных операций с ИИ (создание теста или ход теста)
+    LLM_ANSWER_RESERVED_SLOTS: int = 8 # Слоты, которые занимают только ходы идущих тестов
+    LLM_START_QUEUE_SIZE: int = 50 # Новые тесты сверх этой очереди отклоняются сразу
+
+    # Запись запросов к LLM (без персональных данных) в JSONL для сравнения моделей
+    LLM_CAPTURE_PATH: Optional[str] = None # Например, "captures/llm_calls.jsonl"; None - запись выключена
+    LLM_CAPTURE_SAMPLE_RATE: float = 1.0
+    # Полная история запроса в DEBUG-логе (с изображениями - мегабайты JSON в цикле событий); только для отладки
+    LLM_LOG_PAYLOADS: bool = False
+
+    # Большие документы: конспект по разделам (map-reduce) вместо отправки всего текста одним запросом
+    DOCUMENT_DIGEST_THRESHOLD_WORDS: int = 6000 # Документы длиннее обрабатываются по разделам
+    DOCUMENT_SECTION_MIN_WORDS: int = 800
+    DOCUMENT_SECTION_MAX_WORDS: int = 2500
+    DOCUMENT_DIGEST_CONCURRENCY: int = 4 # Одновременных запросов к ИИ на один документ
+    DOCUMENT_FACT_SHEET_MAX_WORDS: int = 6000 # Конспект больше этого сжимается еще раз
+
+    # Классы: один план теста на всех учеников
+    CLASSROOM_QUESTIONS: int = 5 # Вопросов в тесте класса
+
+    # Очередь исходящих сообщений (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в чат, 20/мин в группу)
+    OUTBOX_GLOBAL_RATE: float = 25.0 # Сообщений в секунду на бота
+    OUTBOX_GLOBAL_BURST: float = 30.0
+    OUTBOX_CHAT_RATE: float = 1.0 # Сообщений в секунду в один личный чат
+    OUTBOX_CHAT_BURST: float = 3.0
+    OUTBOX_GROUP_CHAT_RATE: float = 20 / 60
+    OUTBOX_MERGE_WINDOW_SECONDS: float = 0.15 # Сколько ждать следующие сообщения хода, чтобы отправить их одним
+    OUTBOX_MAX_RETRIES: int = 3
+    OUTBOX_BACKGROUND_RESERVE: float = 10.0 # Токенов общего лимита, которые фоновые рассылки оставляют ответам
+
+    # Сессии тестов в памяти (история диалога с ИИ хранится в user_data в сжатом виде)
+    SESSION_MEMORY_BUDGET_MB: int = 256 # При превышении вытесняются самые давно неактивные сессии
+    SESSION_IDLE_TTL_SECONDS: int = 6 * 3600 # Сессия без апдейтов дольше этого времени удаляется
+    SESSION_SWEEP_SECONDS: int = 60 # Как часто проверять простой и бюджет памяти
+    SESSION_COMPRESSION_LEVEL: int = 6 # Уровень zlib (1 - быстрее, 9 - компактнее)
+
+    # Здоровье цикла событий: гистограмма задержки, стек при зависании, профилирование по /profile N
+    LOOP_MONITOR_ENABLED: bool = True
+    LOOP_MONITOR_INTERVAL_SECONDS: float = 0.25 # Как часто измерять задержку цикла
+    LOOP_STALL_THRESHOLD_MS: float = 500.0 # Цикл, занятый дольше, логируется со стеком
+    LOOP_MONITOR_REPORT_SECONDS: float = 300.0 # Как часто писать гистограмму в лог
+    LOOP_PROFILE_INTERVAL_MS: float = 5.0 # Период сэмплов профайлера
+    LOOP_PROFILE_MAX_SECONDS: float = 300.0 # Профиль завершается по времени, даже если апдейтов мало
+
+    # Защита от повторной доставки апдейтов (после падения, повторы Telegram)
+    IDEMPOTENCY_MEMORY_KEYS: int = 50000 # Сколько последних апдейтов и сообщений помнить в памяти
+    IDEMPOTENCY_FLUSH_SECONDS: float = 2.0 # Как часто сохранять обработанные апдейты и offset в БД
+    IDEMPOTENCY_TTL_HOURS: int = 48 # Сколько хранить записи в БД (Telegram хранит неполученные апдейты 24 ч)
+
+    # Трассировка обработки апдейтов (python -m zadavalnik.trace_report)
+    TRACE_PATH: Optional[str] = None # Например, "traces/traces.jsonl"; None - трассировка выключена
+    TRACE_SAMPLE_RATE: float = 0.05 # Доля обычных трасс, которые сохраняются
+    TRACE_SLOW_MS: float = 3000.0 # Трассы медленнее этого порога (и с ошибкой) сохраняются всегда
+    TRACE_MAX_BYTES: int = 10 * 1024 * 1024 # Размер файла до ротации
+    TRACE_BACKUP_COUNT: int = 5
+
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding='utf-8', extra='ignore')
 
-settings = Settings()
\ No newline at end of file
+_settings: Optional[Settings] = None
+
+def load_settings(**overrides) -> Settings:
+    """Читает настройки из окружения и .env. Повторный вызов перечитывает их."""
+    global _settings
+    _settings = Settings(**overrides)
+    return _settings
+
+def get_settings() -> Settings:
+    """Возвращает загруженные настройки; при первом обращении загружает их."""
+    if _settings is None:
+        return load_settings()
+    return _settings
@@ -1,28 +1,73 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from __future__ import annotations
+
+from sqlalchemy.orm import selectinload, sessionmaker
 from sqlalchemy.future import select
-from sqlalchemy import func, update as sqlalchemy_update # для func.count и update
+from sqlalchemy import bindparam, func, insert, delete, inspect, update as sqlalchemy_update # для func.count и update
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
+import json
+import secrets
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from zadavalnik.config.settings import settings
-from zadavalnik.database.models import Base, TelegramUser, TestAttempt, TestStatus
-from telegram import User as TelegramUserObject # Тип пользователя из python-telegram-bot
-
-async_engine = create_async_engine(settings.DATABASE_URL, echo=False)
-AsyncSessionLocal = sessionmaker(
-    bind=async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False
+from zadavalnik.config import get_settings
+from zadavalnik.tracing import traced
+from zadavalnik.database.models import (
+    Base, BotMeta, TelegramUser, TestAttempt, TestStatus, QuestionResult, ReviewSchedule, DocumentChunkFacts,
+    TestPlan, Classroom, ClassroomMember, IngestedFile, ProcessedUpdate, PendingUpdate,
+    schema_fingerprint
 )
 
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+    from telegram import User as TelegramUserObject # Тип пользователя из python-telegram-bot
+
+SCHEMA_VERSION_KEY = "schema_version"
+
+# Движок и фабрика сессий создаются при первом обращении, а не при импорте модуля
+_async_engine: Optional[AsyncEngine] = None
+_async_session_factory: Optional[sessionmaker] = None
+
+def get_engine() -> AsyncEngine:
+    """Возвращает движок БД, создавая его (и фабрику сессий) при первом вызове."""
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+        _async_engine = create_async_engine(get_settings().DATABASE_URL, echo=False)
+        _async_session_factory = sessionmaker(
+            bind=_async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False
+        )
+    return _async_engine
+
+def _read_schema_version(sync_conn) -> Optional[str]:
+    if not inspect(sync_conn).has_table(BotMeta.__tablename__):
+        return None
+    return sync_conn.execute(
+        select(BotMeta.value).where(BotMeta.key == SCHEMA_VERSION_KEY)
+    ).scalar_one_or_none()
+
+def _write_schema_version(sync_conn, version: str):
+    sync_conn.execute(delete(BotMeta).where(BotMeta.key == SCHEMA_VERSION_KEY))
+    sync_conn.execute(insert(BotMeta).values(key=SCHEMA_VERSION_KEY, value=version))
+
 async def init_db():
-    async with async_engine.begin() as conn:
+    """Создает таблицы, только если схема моделей изменилась с прошлого запуска."""
+    current_version = schema_fingerprint()
+    async with get_engine().begin() as conn:
+        stored_version = await conn.run_sync(_read_schema_version)
+        if stored_version == current_version:
+            print(f"Logging database schema {current_version} is up to date.")
+            return
         # await conn.run_sync(Base.metadata.drop_all) # Для разработки
         await conn.run_sync(Base.metadata.create_all)
-    print("Logging database initialized.")
+        await conn.run_sync(_write_schema_version, current_version)
+    print(f"Logging database initialized (schema {stored_version} -> {current_version}).")
 
 async def get_db_session() -> AsyncSession:
-    async with AsyncSessionLocal() as session:
+    get_engine()
+    async with _async_session_factory() as session:
         yield session
 
+@traced("db.get_or_create_telegram_user_in_db")
 async def get_or_create_telegram_user_in_db(db: AsyncSession, tg_user: TelegramUserObject) -> TelegramUser:
     """Получает или создает/обновляет запись о пользователе Telegram в БД."""
     user = await db.get(TelegramUser, tg_user.id)
@@ -47,6 +92,7 @@ async def get_or_create_telegram_user_in_db(db: AsyncSession, tg_user: TelegramU
     await db.refresh(user)
     return user
 
+@traced("db.log_test_attempt_start")
 async def log_test_attempt_start(db: AsyncSession, user_id: int, topic: str) -> TestAttempt:
     """Логирует начало попытки теста."""
     attempt = TestAttempt(user_id=user_id, topic=topic, status=TestStatus.STARTED)
@@ -55,6 +101,7 @@ async def log_test_attempt_start(db: AsyncSession, user_id: int, topic: str) ->
     await db.refresh(attempt)
     return attempt
 
+@traced("db.update_test_attempt_status")
 async def update_test_attempt_status(db: AsyncSession, attempt_id: int, status: TestStatus, end_time: bool = False):
     """Обновляет статус и, опционально, время окончания попытки теста."""
     values_to_update = {"status": status}
@@ -69,6 +116,7 @@ async def update_test_attempt_status(db: AsyncSession, attempt_id: int, status:
     await db.execute(stmt)
     await db.commit()
 
+@traced("db.count_user_daily_tests")
 async def count_user_daily_tests(db: AsyncSession, user_id: int) -> int:
     """Считает количество тестов (не RATE_LIMITED) пользователя за сегодня."""
     today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
@@ -81,8 +129,339 @@ async def count_user_daily_tests(db: AsyncSession, user_id: int) -> int:
     )
     return result.scalar_one()
 
+@traced("db.log_rate_limit_attempt")
 async def log_rate_limit_attempt(db: AsyncSession, user_id: int):
     """Логирует попытку начать тест сверх лимита."""
     attempt = TestAttempt(user_id=user_id, status=TestStatus.RATE_LIMITED)
     db.add(attempt)
-    await db.commit()
\ No newline at end of file
+    await db.commit()
+
+@traced("db.save_question_results")
+async def save_question_results(db: AsyncSession, attempt_id: int, user_id: int, results: List[Dict]):
+    """Сохраняет результаты всех вопросов теста одной пакетной вставкой."""
+    if not results:
+        return
+    rows = [
+        {
+            "attempt_id": attempt_id,
+            "user_id": user_id,
+            "question_number": result.get("question_number"),
+            "question_text": result.get("question_text"),
+            "user_answer": result.get("user_answer"),
+            "is_correct": result.get("is_correct"),
+        }
+        for result in results
+    ]
+    await db.execute(insert(QuestionResult), rows) # executemany, а не INSERT на каждый вопрос
+    await db.commit()
+
+@traced("db.get_review_schedule")
+async def get_review_schedule(db: AsyncSession, user_id: int, topic: str) -> Optional[ReviewSchedule]:
+    """Возвращает расписание повторения темы для пользователя, если оно есть."""
+    result = await db.execute(
+        select(ReviewSchedule)
+        .where(ReviewSchedule.user_id == user_id)
+        .where(ReviewSchedule.topic == topic)
+    )
+    return result.scalar_one_or_none()
+
+@traced("db.save_review_schedule")
+async def save_review_schedule(db: AsyncSession, schedule: ReviewSchedule) -> ReviewSchedule:
+    """Создает или обновляет запись расписания повторения."""
+    db.add(schedule)
+    await db.commit()
+    await db.refresh(schedule)
+    return schedule
+
+@traced("db.load_pending_reviews")
+async def load_pending_reviews(db: AsyncSession) -> List[tuple]:
+    """Возвращает (id, user_id, topic, next_review_at) всех повторений, о которых еще не напомнили."""
+    result = await db.execute(
+        select(ReviewSchedule.id, ReviewSchedule.user_id, ReviewSchedule.topic, ReviewSchedule.next_review_at)
+        .where(ReviewSchedule.reminder_sent == False) # noqa: E712 - нужно SQL-выражение
+    )
+    return list(result.all())
+
+@traced("db.get_review_schedule_by_id")
+async def get_review_schedule_by_id(db: AsyncSession, schedule_id: int) -> Optional[ReviewSchedule]:
+    return await db.get(ReviewSchedule, schedule_id)
+
+@traced("db.mark_reviews_reminded")
+async def mark_reviews_reminded(db: AsyncSession, reviews: List[tuple]):
+    """
+    Отмечает пачку повторений (id, next_review_at) как напомненные одним executemany UPDATE.
+    Строка, перенесенная на другое время, пока шла отправка, не отмечается: о ней еще нужно напомнить.
+    """
+    if not reviews:
+        return
+    table = ReviewSchedule.__table__
+    stmt = (
+        sqlalchemy_update(table)
+        .where(table.c.id == bindparam("b_id"))
+        .where(table.c.next_review_at == bindparam("b_next_review_at"))
+        .values(reminder_sent=True)
+    )
+    await db.execute(stmt, [{"b_id": schedule_id, "b_next_review_at": next_review_at}
+                            for schedule_id, next_review_at in reviews])
+    await db.commit()
+
+@traced("db.mark_attempts_aborted")
+async def mark_attempts_aborted(db: AsyncSession, attempt_ids: List[int]):
+    """Отмечает незавершенные попытки (например, вытесненных по простою сессий) как ABORTED."""
+    if not attempt_ids:
+        return
+    stmt = (
+        sqlalchemy_update(TestAttempt)
+        .where(TestAttempt.id.in_(attempt_ids))
+        .where(TestAttempt.status == TestStatus.STARTED)
+        .values(status=TestStatus.ABORTED, end_time=datetime.now().astimezone())
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+@traced("db.get_cached_chunk_facts")
+async def get_cached_chunk_facts(db: AsyncSession, chunk_hashes: List[str]) -> Dict[str, str]:
+    """Возвращает {chunk_hash: facts} для разделов, которые уже обрабатывались."""
+    if not chunk_hashes:
+        return {}
+    result = await db.execute(
+        select(DocumentChunkFacts.chunk_hash, DocumentChunkFacts.facts)
+        .where(DocumentChunkFacts.chunk_hash.in_(chunk_hashes))
+    )
+    return dict(result.all())
+
+@traced("db.save_chunk_facts")
+async def save_chunk_facts(db: AsyncSession, rows: List[Dict]):
+    """Сохраняет факты новых разделов одной пакетной вставкой; уже сохраненные параллельно пропускаются."""
+    if not rows:
+        return
+    existing = await get_cached_chunk_facts(db, [row["chunk_hash"] for row in rows])
+    rows = [row for row in rows if row["chunk_hash"] not in existing]
+    if not rows:
+        return
+    try:
+        await db.execute(insert(DocumentChunkFacts), rows)
+        await db.commit()
+    except IntegrityError:
+        # Тот же документ одновременно обработал другой пользователь - кэш уже заполнен
+        await db.rollback()
+
+@traced("db.get_test_plan")
+async def get_test_plan(db: AsyncSession, plan_id: int, source: Optional[str] = None) -> Optional[TestPlan]:
+    stmt = select(TestPlan).where(TestPlan.id == plan_id)
+    if source is not None:
+        stmt = stmt.where(TestPlan.source == source)
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+@traced("db.find_test_plan_by_topic")
+async def find_test_plan_by_topic(db: AsyncSession, topic: str, source: str) -> Optional[TestPlan]:
+    """Самый свежий план с такой темой (без учета регистра)."""
+    # lower() в SQLite не работает с кириллицей, поэтому темы сравниваются в Python (планов курса немного)
+    key = " ".join(topic.split()).casefold()
+    result = await db.execute(
+        select(TestPlan.id, TestPlan.topic).where(TestPlan.source == source).order_by(TestPlan.id.desc())
+    )
+    for plan_id, plan_topic in result.all():
+        if " ".join(plan_topic.split()).casefold() == key:
+            return await get_test_plan(db, plan_id)
+    return None
+
+@traced("db.list_test_plans")
+async def list_test_plans(db: AsyncSession, source: str, limit: int = 50) -> List[tuple]:
+    """Строки (id, topic) планов из источника source, по алфавиту тем."""
+    result = await db.execute(
+        select(TestPlan.id, TestPlan.topic)
+        .where(TestPlan.source == source)
+        .order_by(TestPlan.topic, TestPlan.id)
+        .limit(limit)
+    )
+    return list(result.all())
+
+@traced("db.get_ingested_hashes")
+async def get_ingested_hashes(db: AsyncSession, content_hashes: List[str]) -> Dict[str, int]:
+    """{content_hash: plan_id} для уже загруженных файлов."""
+    if not content_hashes:
+        return {}
+    result = await db.execute(
+        select(IngestedFile.content_hash, IngestedFile.plan_id)
+        .where(IngestedFile.content_hash.in_(content_hashes))
+    )
+    return dict(result.all())
+
+RETIRED_INGEST_SOURCE = "ingest_retired" # План файла, замененный планом по новой версии файла
+
+@traced("db.save_ingested_plan")
+async def save_ingested_plan(db: AsyncSession, content_hash: str, path: str, topic: str, questions: List[Dict],
+                             model: Optional[str] = None) -> TestPlan:
+    """План теста и отметка о загруженном файле сохраняются одной транзакцией: прерванная загрузка не оставит половину."""
+    plan = TestPlan(topic=topic, questions=json.dumps(questions, ensure_ascii=False), source="ingest", model=model)
+    db.add(plan)
+    await db.flush()
+    # Прежние планы файла (правленый текст или --force) пропадают из /topics, но не удаляются:
+    # на них могут ссылаться классы
+    result = await db.execute(
+        select(IngestedFile).where((IngestedFile.path == path) | (IngestedFile.content_hash == content_hash))
+    )
+    for previous in result.scalars().all():
+        await db.execute(
+            sqlalchemy_update(TestPlan).where(TestPlan.id == previous.plan_id).values(source=RETIRED_INGEST_SOURCE)
+        )
+        if previous.content_hash != content_hash:
+            await db.delete(previous)
+    # merge: при повторной загрузке (--force) отметка указывает на новый план
+    await db.merge(IngestedFile(content_hash=content_hash, path=path, plan_id=plan.id))
+    await db.commit()
+    await db.refresh(plan)
+    return plan
+
+@traced("db.get_bot_meta")
+async def get_bot_meta(db: AsyncSession, key: str) -> Optional[str]:
+    result = await db.execute(select(BotMeta.value).where(BotMeta.key == key))
+    return result.scalar_one_or_none()
+
+@traced("db.set_bot_meta")
+async def set_bot_meta(db: AsyncSession, key: str, value: str):
+    await db.merge(BotMeta(key=key, value=value))
+    await db.commit()
+
+@traced("db.load_processed_keys")
+async def load_processed_keys(db: AsyncSession, since: datetime, limit: int) -> List[str]:
+    """Ключи обработанных апдейтов и сообщений не старше since, от старых к новым (не больше limit последних)."""
+    result = await db.execute(
+        select(ProcessedUpdate.key)
+        .where(ProcessedUpdate.created_at >= since)
+        .order_by(ProcessedUpdate.created_at.desc())
+        .limit(limit)
+    )
+    return list(reversed(result.scalars().all()))
+
+@traced("db.load_pending_updates")
+async def load_pending_updates(db: AsyncSession, since: datetime) -> List[tuple]:
+    """(update_id, payload) апдейтов не старше since, обработка которых не завершилась, по порядку."""
+    result = await db.execute(
+        select(PendingUpdate.update_id, PendingUpdate.payload)
+        .where(PendingUpdate.created_at >= since)
+        .order_by(PendingUpdate.update_id)
+    )
+    return list(result.all())
+
+@traced("db.save_processed_keys")
+async def save_processed_keys(db: AsyncSession, keys: List[str], offset: Optional[int] = None,
+                              offset_key: str = "polling_offset", done_update_ids: Optional[List[int]] = None,
+                              journal: Optional[List[tuple]] = None) -> bool:
+    """
+    Сохраняет ключи пачкой и в той же транзакции offset polling'а и журнал: новые необработанные
+    апдейты journal (update_id, payload) и удаление обработанных done_update_ids; уже сохраненные
+    ключи пропускаются. False - конфликт с параллельной записью, ничего не сохранено.
+    """
+    existing = set()
+    if keys:
+        result = await db.execute(select(ProcessedUpdate.key).where(ProcessedUpdate.key.in_(keys)))
+        existing = set(result.scalars().all())
+    now = datetime.now().astimezone()
+    rows = [{"key": key, "created_at": now} for key in keys if key not in existing]
+    try:
+        if rows:
+            await db.execute(insert(ProcessedUpdate), rows)
+        if offset is not None:
+            await db.merge(BotMeta(key=offset_key, value=str(offset)))
+        for update_id, payload in journal or []:
+            await db.merge(PendingUpdate(update_id=update_id, payload=payload, created_at=now))
+        if done_update_ids:
+            await db.execute(delete(PendingUpdate).where(PendingUpdate.update_id.in_(done_update_ids)))
+        await db.commit()
+    except IntegrityError:
+        # Ключ успел записать другой процесс - сами ключи повторять не нужно
+        await db.rollback()
+        return False
+    return True
+
+@traced("db.prune_processed_keys")
+async def prune_processed_keys(db: AsyncSession, before: datetime) -> int:
+    result = await db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.created_at < before))
+    await db.commit()
+    return result.rowcount or 0
+
+@traced("db.prune_pending_updates")
+async def prune_pending_updates(db: AsyncSession, before: datetime) -> int:
+    """Удаляет из журнала апдейты, завершение которых так и не было сохранено."""
+    result = await db.execute(delete(PendingUpdate).where(PendingUpdate.created_at < before))
+    await db.commit()
+    return result.rowcount or 0
+
+CLASSROOM_CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789" # Без похожих символов (0/O, 1/I/L)
+CLASSROOM_CODE_LENGTH = 6
+
+@traced("db.create_test_plan")
+async def create_test_plan(db: AsyncSession, topic: str, questions: List[Dict], source: str,
+                           model: Optional[str] = None) -> TestPlan:
+    """Сохраняет план теста (вопросы с эталонными ответами)."""
+    plan = TestPlan(topic=topic, questions=json.dumps(questions, ensure_ascii=False), source=source, model=model)
+    db.add(plan)
+    await db.commit()
+    await db.refresh(plan)
+    return plan
+
+@traced("db.create_classroom")
+async def create_classroom(db: AsyncSession, teacher_id: int, plan_id: int) -> Classroom:
+    """Создает класс с уникальным кодом приглашения."""
+    for _ in range(10):
+        code = "".join(secrets.choice(CLASSROOM_CODE_ALPHABET) for _ in range(CLASSROOM_CODE_LENGTH))
+        existing = await db.execute(select(Classroom.id).where(Classroom.code == code))
+        if existing.scalar_one_or_none() is None:
+            break
+    classroom = Classroom(code=code, teacher_id=teacher_id, plan_id=plan_id)
+    db.add(classroom)
+    await db.commit()
+    await db.refresh(classroom)
+    return classroom
+
+@traced("db.get_classroom_by_code")
+async def get_classroom_by_code(db: AsyncSession, code: str) -> Optional[Classroom]:
+    """Класс по коду (вместе с планом теста)."""
+    result = await db.execute(
+        select(Classroom)
+        .options(selectinload(Classroom.plan))
+        .where(Classroom.code == code.strip().upper())
+    )
+    return result.scalar_one_or_none()
+
+@traced("db.get_classroom_member")
+async def get_classroom_member(db: AsyncSession, classroom_id: int, user_id: int) -> Optional[ClassroomMember]:
+    result = await db.execute(
+        select(ClassroomMember)
+        .where(ClassroomMember.classroom_id == classroom_id)
+        .where(ClassroomMember.user_id == user_id)
+    )
+    return result.scalar_one_or_none()
+
+@traced("db.add_classroom_member")
+async def add_classroom_member(db: AsyncSession, classroom_id: int, user_id: int, attempt_id: int) -> bool:
+    """Добавляет ученика в класс; False, если он уже присоединился (например, двойное нажатие)."""
+    db.add(ClassroomMember(classroom_id=classroom_id, user_id=user_id, attempt_id=attempt_id))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+@traced("db.get_classroom_results")
+async def get_classroom_results(db: AsyncSession, classroom_id: int) -> List[tuple]:
+    """
+    Строки (user_id, username, first_name, attempt_status, question_number, is_correct) по всем ученикам класса.
+    У учеников без ответов question_number и is_correct равны None.
+    """
+    result = await db.execute(
+        select(
+            ClassroomMember.user_id, TelegramUser.username, TelegramUser.first_name, TestAttempt.status,
+            QuestionResult.question_number, QuestionResult.is_correct
+        )
+        .join(TestAttempt, TestAttempt.id == ClassroomMember.attempt_id)
+        .outerjoin(TelegramUser, TelegramUser.id == ClassroomMember.user_id)
+        .outerjoin(QuestionResult, QuestionResult.attempt_id == ClassroomMember.attempt_id)
+        .where(ClassroomMember.classroom_id == classroom_id)
+        .order_by(ClassroomMember.joined_at, QuestionResult.question_number)
+    )
+    return list(result.all())
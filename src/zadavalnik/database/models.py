@@ -1,7 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum as SQLAlchemyEnum, ForeignKey
+from sqlalchemy import (
+    Column, Integer, String, Text, Boolean, Float, DateTime, Enum as SQLAlchemyEnum, ForeignKey,
+    Index, UniqueConstraint
+)
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func # Для func.now()
 import enum
+import hashlib
 
 Base = declarative_base()
 
@@ -41,6 +45,159 @@ class TestAttempt(Base):
     status = Column(SQLAlchemyEnum(TestStatus), nullable=False)
 
     user = relationship("TelegramUser", back_populates="test_attempts")
+    question_results = relationship("QuestionResult", back_populates="attempt")
 
     def __repr__(self):
-        return f"<TestAttempt(id={self.id}, user_id={self.user_id}, topic='{self.topic}', status={self.status})>"
\ No newline at end of file
+        return f"<TestAttempt(id={self.id}, user_id={self.user_id}, topic='{self.topic}', status={self.status})>"
+
+class QuestionResult(Base):
+    """Результат ответа пользователя на отдельный вопрос теста."""
+    __tablename__ = "question_results"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    attempt_id = Column(Integer, ForeignKey("test_attempts.id"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("telegram_users.id"), nullable=False, index=True)
+
+    question_number = Column(Integer, nullable=True)
+    question_text = Column(Text, nullable=True) # Сообщение бота, содержавшее вопрос
+    user_answer = Column(Text, nullable=True)
+    is_correct = Column(Boolean, nullable=True) # None, если ИИ не смог оценить ответ
+    answered_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    attempt = relationship("TestAttempt", back_populates="question_results")
+
+    def __repr__(self):
+        return f"<QuestionResult(id={self.id}, attempt_id={self.attempt_id}, question_number={self.question_number}, is_correct={self.is_correct})>"
+
+class ReviewSchedule(Base):
+    """Расписание интервального повторения темы для пользователя (упрощенный SM-2)."""
+    __tablename__ = "review_schedules"
+    __table_args__ = (
+        UniqueConstraint("user_id", "topic", name="uq_review_user_topic"),
+        # Индекс для выборки ожидающих напоминаний при старте без полного сканирования таблицы
+        Index("ix_review_pending_due", "reminder_sent", "next_review_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("telegram_users.id"), nullable=False)
+    topic = Column(String, nullable=False)
+
+    repetitions = Column(Integer, nullable=False, default=0) # Число успешных повторений подряд
+    interval_days = Column(Float, nullable=False, default=1.0)
+    ease_factor = Column(Float, nullable=False, default=2.5)
+    last_score = Column(Float, nullable=True) # Доля правильных ответов в последнем тесте
+    next_review_at = Column(DateTime, nullable=False) # Локальное время без таймзоны
+    reminder_sent = Column(Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f"<ReviewSchedule(id={self.id}, user_id={self.user_id}, topic='{self.topic}', next_review_at={self.next_review_at})>"
+
+
+class TestPlan(Base):
+    """Заранее сгенерированный план теста: вопросы с эталонными ответами (общий для класса)."""
+    __tablename__ = "test_plans"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    topic = Column(String, nullable=False, index=True)
+    questions = Column(Text, nullable=False) # JSON-список {"question": ..., "answer": ...}
+    source = Column(String, nullable=True) # Откуда план: "classroom" и т.п.
+    model = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<TestPlan(id={self.id}, topic='{self.topic}', source='{self.source}')>"
+
+class Classroom(Base):
+    """Класс: один план теста, который проходят все присоединившиеся по коду ученики."""
+    __tablename__ = "classrooms"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code = Column(String(16), nullable=False, unique=True, index=True)
+    teacher_id = Column(Integer, ForeignKey("telegram_users.id"), nullable=False)
+    plan_id = Column(Integer, ForeignKey("test_plans.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    plan = relationship("TestPlan")
+
+    def __repr__(self):
+        return f"<Classroom(id={self.id}, code='{self.code}', plan_id={self.plan_id})>"
+
+class ClassroomMember(Base):
+    """Ученик класса и его попытка прохождения теста."""
+    __tablename__ = "classroom_members"
+    __table_args__ = (
+        UniqueConstraint("classroom_id", "user_id", name="uq_classroom_member"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    classroom_id = Column(Integer, ForeignKey("classrooms.id"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("telegram_users.id"), nullable=False)
+    attempt_id = Column(Integer, ForeignKey("test_attempts.id"), nullable=False)
+    joined_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<ClassroomMember(classroom_id={self.classroom_id}, user_id={self.user_id}, attempt_id={self.attempt_id})>"
+
+class DocumentChunkFacts(Base):
+    """Кэш фактов, извлеченных из раздела документа: ключ - хеш текста раздела, модели и промпта."""
+    __tablename__ = "document_chunk_facts"
+
+    chunk_hash = Column(String(64), primary_key=True)
+    facts = Column(Text, nullable=False) # JSON-список фактов
+    words = Column(Integer, nullable=True) # Размер раздела, для статистики
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<DocumentChunkFacts(chunk_hash='{self.chunk_hash[:12]}', words={self.words})>"
+
+
+class IngestedFile(Base):
+    """Файл учебного материала, по которому офлайн-загрузка (python -m zadavalnik.ingest) уже создала план теста."""
+    __tablename__ = "ingested_files"
+
+    content_hash = Column(String(64), primary_key=True) # Хеш текста и параметров генерации: правленый файл обрабатывается заново
+    path = Column(String, nullable=False)
+    plan_id = Column(Integer, ForeignKey("test_plans.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<IngestedFile(path='{self.path}', plan_id={self.plan_id})>"
+
+class ProcessedUpdate(Base):
+    """Уже обработанный апдейт ("u:<update_id>") или сообщение ("m:<chat_id>:<message_id>") - защита от повторной доставки."""
+    __tablename__ = "processed_updates"
+
+    key = Column(String(64), primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True) # Записи старше IDEMPOTENCY_TTL_HOURS удаляются
+
+    def __repr__(self):
+        return f"<ProcessedUpdate(key='{self.key}')>"
+
+class PendingUpdate(Base):
+    """Принятый, но еще не обработанный апдейт: после падения бота он обрабатывается заново."""
+    __tablename__ = "pending_updates"
+
+    update_id = Column(Integer, primary_key=True, autoincrement=False)
+    payload = Column(Text, nullable=False) # Update.to_dict() в JSON
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"<PendingUpdate(update_id={self.update_id})>"
+
+class BotMeta(Base):
+    """Служебные пары ключ-значение (версия схемы и т.п.)."""
+    __tablename__ = "bot_meta"
+
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+def schema_fingerprint() -> str:
+    """Короткий хеш структуры всех таблиц: меняется при добавлении таблиц, колонок или индексов."""
+    parts = []
+    for table in sorted(Base.metadata.tables.values(), key=lambda t: t.name):
+        for column in table.columns:
+            parts.append(f"{table.name}.{column.name}:{column.type!r}:{column.nullable}:{column.primary_key}")
+        for index in sorted(table.indexes, key=lambda i: i.name or ""):
+            parts.append(f"{table.name}#{index.name}:{','.join(c.name for c in index.columns)}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,150 @@
+# ingest.py - офлайн-загрузка учебных материалов курса: по каждому файлу заранее создается план теста
+#
+# Примеры:
+#   python -m zadavalnik.ingest materials/biology
+#   python -m zadavalnik.ingest materials/ --questions 7 --concurrency 8 --use-filenames
+#
+# Берутся файлы .txt и .md (рекурсивно). Большие документы сначала конспектируются по разделам,
+# как в боте (zadavalnik.ai.document_digest). Готовые планы сохраняются в БД (source="ingest"),
+# ученики выбирают их командой /topics или вводят название темы после /newtest - тест начинается
+# без запроса к ИИ.
+#
+# Загрузку можно прервать и запустить снова: уже обработанные файлы (по хешу содержимого)
+# пропускаются. Измененный файл получает новый план, а прежний план этого файла снимается
+# с /topics (source="ingest_retired"; классы, созданные по нему, продолжают работать).
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from zadavalnik.ai.document_digest import DocumentDigester
+from zadavalnik.ai.openai_client import OpenAIClient
+from zadavalnik.config import load_settings
+from zadavalnik.database.db import get_db_session, get_ingested_hashes, init_db, save_ingested_plan
+
+logger = logging.getLogger(__name__)
+
+MATERIAL_EXTENSIONS = (".txt", ".md")
+
+
+def find_materials(root: str) -> List[str]:
+    paths = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith(MATERIAL_EXTENSIONS) and not name.startswith("."):
+                paths.append(os.path.join(directory, name))
+    return sorted(paths)
+
+
+def content_hash(text: str, question_count: int, model: str) -> str:
+    """Ключ загруженного файла: текст (без учета пробелов), число вопросов и модель."""
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model}\0{question_count}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def _read_material(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        logger.warning(f"Skipping {path}: {e}")
+        return None
+
+
+class Ingestor:
+    def __init__(self, openai_client: OpenAIClient, question_count: int, digest_threshold_words: int,
+                 use_filenames: bool):
+        self.openai_client = openai_client
+        self.digester = DocumentDigester(openai_client)
+        self.question_count = question_count
+        self.digest_threshold_words = digest_threshold_words
+        self.use_filenames = use_filenames
+
+    async def ingest_file(self, path: str, relative_path: str, file_hash: str) -> bool:
+        text = _read_material(path) # Перечитывается здесь, чтобы не держать в памяти весь каталог
+        if not text:
+            return False
+        title_hint = os.path.splitext(os.path.basename(path))[0]
+        material = text
+        if len(text.split()) > self.digest_threshold_words:
+            material = await self.digester.digest(text)
+            if not material:
+                logger.warning(f"Failed to digest {relative_path}")
+                return False
+
+        plan = await self.openai_client.generate_material_plan(material, self.question_count, title_hint)
+        if not plan:
+            logger.warning(f"Failed to generate a test plan for {relative_path}")
+            return False
+        topic = title_hint[:60] if self.use_filenames else plan["topic"]
+        async for db in get_db_session():
+            test_plan = await save_ingested_plan(db, file_hash, relative_path, topic, plan["questions"],
+                                                 model=self.openai_client.model)
+        print(f"  + {relative_path} -> «{topic}» ({len(plan['questions'])} вопросов, /take_{test_plan.id})")
+        return True
+
+
+async def main(args) -> int:
+    settings = load_settings()
+    await init_db()
+    openai_client = OpenAIClient(api_key=settings.OPENAI_API_KEY, model_name=settings.OPENAI_MODEL)
+    question_count = args.questions or settings.CLASSROOM_QUESTIONS
+    ingestor = Ingestor(openai_client, question_count, settings.DOCUMENT_DIGEST_THRESHOLD_WORDS, args.use_filenames)
+
+    paths = find_materials(args.directory)
+    materials: Dict[str, Tuple[str, str, str]] = {} # хеш -> (путь, путь относительно каталога, хеш)
+    duplicates = 0
+    for path in paths:
+        text = _read_material(path)
+        if not text or not text.strip():
+            continue
+        file_hash = content_hash(text, question_count, openai_client.model)
+        if file_hash in materials:
+            duplicates += 1 # Тот же текст в другом файле - план уже будет
+            continue
+        materials[file_hash] = (path, os.path.relpath(path, args.directory), file_hash)
+
+    async for db in get_db_session():
+        done = await get_ingested_hashes(db, list(materials))
+    pending = [material for file_hash, material in materials.items() if args.force or file_hash not in done]
+    print(f"Found {len(paths)} files: {len(materials)} unique readable, {duplicates} duplicates, "
+          f"{len(materials) - len(pending)} already ingested, {len(pending)} to process (concurrency {args.concurrency})")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(material: Tuple[str, str, str]) -> bool:
+        async with semaphore:
+            try:
+                return await ingestor.ingest_file(*material)
+            except Exception:
+                logger.error(f"Failed to ingest {material[1]}", exc_info=True)
+                return False
+
+    try:
+        results = await asyncio.gather(*(process(material) for material in pending))
+    finally:
+        await openai_client.close()
+    created = sum(1 for ok in results if ok)
+    print(f"Done: {created} plans created, {len(results) - created} failed. "
+          f"Digest cache: {ingestor.digester.cache_hits} hits, {ingestor.digester.cache_misses} misses")
+    return 0 if created == len(results) else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Pre-generate test plans from a directory of course materials")
+    parser.add_argument("directory", help="каталог с файлами .txt и .md")
+    parser.add_argument("--questions", type=int, help="вопросов в тесте (иначе CLASSROOM_QUESTIONS)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="файлов одновременно (большие документы дополнительно параллелятся по разделам)")
+    parser.add_argument("--use-filenames", action="store_true", help="называть темы по именам файлов, а не по содержимому")
+    parser.add_argument("--force", action="store_true", help="создать планы заново и для уже загруженных файлов")
+    try:
+        sys.exit(asyncio.run(main(parser.parse_args())))
+    except KeyboardInterrupt:
+        print("Interrupted. Already created plans are saved; run again to continue.")
+        sys.exit(130)
@@ -0,0 +1,142 @@
+# replay.py - повтор записанных запросов к LLM на разных моделях/эндпоинтах
+#
+# Корпус пишется ботом при заданном LLM_CAPTURE_PATH. Примеры:
+#   python -m zadavalnik.replay captures/llm_calls.jsonl --target o4-mini --target gemini-2.0-flash-001
+#   python -m zadavalnik.replay captures/llm_calls.jsonl --target stub@http://127.0.0.1:8089/v1 --concurrency 32
+#
+# Для каждой модели выводятся перцентили латентности, токены, доля ответов, которые не удалось
+# разобрать как JSON, и доля ответов, обрезанных по лимиту (finish_reason == "length").
+# Каждый запрос повторяется с записанными max_tokens и response_format (ход теста - по JSON Schema);
+# у старых записей без них - json_object и --max-tokens.
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from zadavalnik.ai.capture import load_corpus
+from zadavalnik.ai.openai_client import build_http_client, parse_assistant_json
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "https://bothub.chat/api/v2/openai/v1"
+DEFAULT_MAX_TOKENS = 3000 # Для записей без max_tokens
+
+
+def _setting(name: str, default: Optional[str] = None) -> Optional[str]:
+    """Значение из настроек бота, а если они не загружаются (нет BOT_TOKEN и т.п.) - из окружения."""
+    try:
+        from zadavalnik.config import get_settings
+        return getattr(get_settings(), name)
+    except Exception:
+        return os.environ.get(name, default)
+
+
+def _parse_target(target: str, default_base_url: str) -> Tuple[str, str]:
+    model, _, base_url = target.partition("@")
+    return model, base_url or default_base_url
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def _replay_target(model: str, base_url: str, api_key: str, records: List[Dict], args) -> Dict:
+    from openai import AsyncOpenAI
+
+    http_client = build_http_client(
+        max_connections=args.concurrency, max_keepalive_connections=args.concurrency, keepalive_expiry=30.0,
+        http2=False, connect_timeout=10.0, read_timeout=args.timeout, write_timeout=30.0, pool_timeout=30.0
+    )
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    stats = {"latencies": [], "prompt_tokens": 0, "completion_tokens": 0,
+             "errors": 0, "parse_failures": 0, "truncated": 0, "calls": 0}
+
+    async def replay_one(record: Dict):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=record["messages"],
+                    response_format=record.get("response_format") or {"type": "json_object"},
+                    max_tokens=args.max_tokens or record.get("max_tokens") or DEFAULT_MAX_TOKENS,
+                )
+            except Exception as e:
+                stats["errors"] += 1
+                logger.warning(f"{model}: request failed: {e}")
+                return
+            stats["latencies"].append((time.perf_counter() - started) * 1000)
+        stats["calls"] += 1
+        if response.usage:
+            stats["prompt_tokens"] += response.usage.prompt_tokens or 0
+            stats["completion_tokens"] += response.usage.completion_tokens or 0
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            stats["truncated"] += 1
+        content = (choice.message.content or "").strip()
+        if not content or parse_assistant_json(content) is None:
+            stats["parse_failures"] += 1
+
+    try:
+        await asyncio.gather(*(replay_one(record) for record in records))
+    finally:
+        await client.close()
+    return stats
+
+
+def _print_report(results: List[Tuple[str, Dict]]):
+    header = (f"{'model':28} {'calls':>6} {'err':>4} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+              f"{'prompt tok':>10} {'compl tok':>10} {'json fail':>9} {'length':>7}")
+    print(header)
+    print("-" * len(header))
+    for model, stats in results:
+        calls = stats["calls"]
+        latencies = stats["latencies"]
+        json_fail = stats["parse_failures"] / calls * 100 if calls else 0.0
+        truncated = stats["truncated"] / calls * 100 if calls else 0.0
+        print(f"{model:28} {calls:>6} {stats['errors']:>4} {_percentile(latencies, 0.5):>8.0f} "
+              f"{_percentile(latencies, 0.9):>8.0f} {_percentile(latencies, 0.99):>8.0f} "
+              f"{stats['prompt_tokens']:>10} {stats['completion_tokens']:>10} {json_fail:>8.1f}% {truncated:>6.1f}%")
+
+
+async def main(args):
+    records = load_corpus(args.corpus, limit=args.limit)
+    if not records:
+        print(f"Corpus {args.corpus} is empty.")
+        return
+    default_base_url = args.base_url or _setting("OPENAI_API_URL", DEFAULT_API_URL)
+    api_key = args.api_key or _setting("OPENAI_API_KEY") or "replay"
+    targets = args.target or [_setting("OPENAI_MODEL", "o4-mini")]
+
+    print(f"Replaying {len(records)} recorded calls, concurrency {args.concurrency}")
+    results = []
+    for target in targets:
+        model, base_url = _parse_target(target, default_base_url)
+        print(f"  {model} @ {base_url} ...")
+        results.append((target, await _replay_target(model, base_url, api_key, records, args)))
+    print()
+    _print_report(results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    # Ошибки разбора JSON учитываются в отчете, подробные логи парсера здесь не нужны
+    logging.getLogger("zadavalnik.ai.openai_client").setLevel(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description="Replay a captured LLM corpus against one or more models")
+    parser.add_argument("corpus", help="JSONL-файл, записанный при LLM_CAPTURE_PATH")
+    parser.add_argument("--target", action="append",
+                        help="модель или модель@base_url; можно указать несколько раз")
+    parser.add_argument("--base-url", help="эндпоинт по умолчанию (иначе OPENAI_API_URL)")
+    parser.add_argument("--api-key", help="ключ API (иначе OPENAI_API_KEY)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, help="взять только первые N записей")
+    parser.add_argument("--max-tokens", type=int, help="переопределить записанный max_tokens для всех запросов")
+    parser.add_argument("--timeout", type=float, default=120.0, help="read timeout одного запроса, с")
+    asyncio.run(main(parser.parse_args()))
@@ -15,8 +15,8 @@ logging.basicConfig(
 )
 # logger = logging.getLogger(__name__)
 
-logging.getLogger("zadavalnik.ai.openai_client").setLevel(logging.DEBUG)
-logging.getLogger("zadavalnik.bot.handlers").setLevel(logging.DEBUG) # Для логов истории в хендлерах
+# DEBUG для zadavalnik.ai.openai_client здесь больше не включается: полная история запроса
+# пишется в лог только при LLM_LOG_PAYLOADS=true (и уровне DEBUG у этого логгера)
 
 
 if __name__ == "__main__":
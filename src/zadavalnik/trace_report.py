@@ -0,0 +1,113 @@
+# trace_report.py - отчет по трассам, записанным при заданном TRACE_PATH
+#
+# Примеры:
+#   python -m zadavalnik.trace_report traces/traces.jsonl
+#   python -m zadavalnik.trace_report traces/traces.jsonl --top 5 --handler handle_text_message
+#
+# Выводит самые медленные трассы с разбивкой по спанам и перцентили латентности по этапам
+# (обработчики, запросы к БД, скачивание файлов, запрос к LLM, разбор JSON).
+# Ротированные файлы (traces.jsonl.1, .2, ...) читаются вместе с основным.
+
+import argparse
+import glob
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def load_traces(path: str, handler: Optional[str] = None) -> List[Dict]:
+    traces = []
+    for file_path in [path] + sorted(glob.glob(f"{path}.*")):
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        trace = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if handler is None or trace.get("handler") == handler:
+                        traces.append(trace)
+        except FileNotFoundError:
+            continue
+    return traces
+
+
+def _format_duration(duration_ms: Optional[float]) -> str:
+    return "   running" if duration_ms is None else f"{duration_ms:>8.0f}ms"
+
+
+def _print_trace(trace: Dict):
+    header = f"{trace['duration_ms']:>8.0f}ms  {trace['handler']}"
+    for key in ("update_id", "user_id", "chat_id", "job"):
+        if trace.get(key) is not None:
+            header += f"  {key}={trace[key]}"
+    if trace.get("error"):
+        header += f"  ERROR={trace['error']}"
+    print(header)
+
+    children = defaultdict(list)
+    for s in trace.get("spans", []):
+        children[s.get("parent")].append(s)
+
+    def print_children(parent_id, depth):
+        for s in sorted(children.get(parent_id, []), key=lambda item: item["start_ms"]):
+            line = f"  {_format_duration(s.get('duration_ms'))}  {'  ' * depth}{s['name']} (+{s['start_ms']:.0f}ms)"
+            if s.get("attrs"):
+                line += "  " + " ".join(f"{k}={v}" for k, v in s["attrs"].items())
+            if s.get("error"):
+                line += f"  ERROR={s['error']}"
+            print(line)
+            print_children(s["id"], depth + 1)
+
+    print_children(None, 0)
+    print()
+
+
+def _print_stage_breakdown(traces: List[Dict]):
+    stages = defaultdict(list)
+    for trace in traces:
+        stages[f"handler:{trace['handler']}"].append(trace["duration_ms"])
+        for s in trace.get("spans", []):
+            if s.get("duration_ms") is not None:
+                stages[s["name"]].append(s["duration_ms"])
+
+    header = f"{'stage':40} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'total s':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:40} {len(durations):>6} {_percentile(durations, 0.5):>8.0f} {_percentile(durations, 0.95):>8.0f} "
+              f"{max(durations):>8.0f} {sum(durations) / 1000:>8.1f}")
+
+
+def main(args):
+    traces = load_traces(args.path, args.handler)
+    if not traces:
+        print(f"No traces found in {args.path}.")
+        return
+    errors = sum(1 for trace in traces if trace.get("error"))
+    print(f"{len(traces)} traces, {errors} with errors. Note: fast traces are sampled, slow ones are always kept.\n")
+
+    print(f"Slowest {args.top} traces:\n")
+    for trace in sorted(traces, key=lambda item: -item["duration_ms"])[:args.top]:
+        _print_trace(trace)
+
+    print("Per-stage latency:\n")
+    _print_stage_breakdown(traces)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the slowest traces and a per-stage latency breakdown")
+    parser.add_argument("path", help="JSONL-файл трасс (TRACE_PATH)")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых медленных трасс показать")
+    parser.add_argument("--handler", help="только трассы этого обработчика")
+    main(parser.parse_args())
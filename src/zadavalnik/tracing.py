@@ -0,0 +1,219 @@
+"""
+Легковесная трассировка обработки апдейтов: из чего складывается время ответа бота
+(скачивание файла из Telegram, SQLite, запрос к LLM, разбор JSON).
+
+- trace_handler - декоратор обработчика: открывает трассу с ключом update_id;
+- traced(name) - декоратор корутины, span(name) - контекстный менеджер для участка кода.
+
+Текущая трасса хранится в contextvars, поэтому спаны из задач, созданных внутри обработчика
+(asyncio.gather, ensure_future), попадают в ту же трассу. Пока трассировка не включена
+(configure не вызывался), декораторы и span() ничего не делают.
+
+Сэмплирование хвостовое: решение принимается по завершении трассы - медленные
+и упавшие трассы сохраняются всегда, остальные с вероятностью sample_rate.
+Трассы пишутся по строке JSON в локальный файл с ротацией (см. python -m zadavalnik.trace_report).
+"""
+import functools
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "duration", "attrs", "error")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, attrs: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    def set(self, **attrs):
+        """Добавляет атрибуты, известные только после выполнения участка (токены, размер и т.п.)."""
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    """Возвращается из span(), когда трассы нет: вызывающему коду не нужны проверки на None."""
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, name: str, update_id: Optional[int] = None, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.update_id = update_id
+        self.attrs = attrs or {}
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+        self.error: Optional[str] = None
+
+    def start_span(self, name: str, parent_id: Optional[int], attrs: Dict[str, Any]) -> Span:
+        new_span = Span(len(self.spans) + 1, parent_id, name, attrs)
+        self.spans.append(new_span)
+        return new_span
+
+    def to_dict(self, duration: float) -> Dict:
+        return {
+            "ts": self.ts,
+            "update_id": self.update_id,
+            "handler": self.name,
+            "duration_ms": round(duration * 1000, 2),
+            "error": self.error,
+            **self.attrs,
+            "spans": [
+                {
+                    "id": s.span_id,
+                    "parent": s.parent_id,
+                    "name": s.name,
+                    "start_ms": round((s.start - self.start) * 1000, 2),
+                    # None - участок еще выполнялся (например, отмененный запрос к ИИ в фоновой задаче)
+                    "duration_ms": round(s.duration * 1000, 2) if s.duration is not None else None,
+                    "error": s.error,
+                    **({"attrs": s.attrs} if s.attrs else {}),
+                }
+                for s in self.spans
+            ],
+        }
+
+
+class TraceExporter:
+    """Решает, сохранять ли завершенную трассу, и пишет ее в JSONL-файл с ротацией."""
+
+    def __init__(self, path: str, sample_rate: float, slow_ms: float, max_bytes: int, backup_count: int):
+        import os
+        from logging.handlers import RotatingFileHandler
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        # Отдельный логгер вне иерархии: трассы не попадают в обычный лог и наоборот
+        self._writer = logging.Logger("zadavalnik.tracing.export")
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._writer.addHandler(handler)
+        self.finished = 0
+        self.exported = 0
+
+    def finish(self, trace: Trace):
+        duration = time.perf_counter() - trace.start
+        self.finished += 1
+        keep = trace.error is not None or duration * 1000 >= self.slow_ms or random.random() < self.sample_rate
+        if not keep:
+            return
+        self.exported += 1
+        try:
+            self._writer.info(json.dumps(trace.to_dict(duration), ensure_ascii=False, default=str))
+        except Exception as e:
+            logger.error(f"Failed to export trace {trace.update_id}: {e}")
+
+    def close(self):
+        for handler in self._writer.handlers:
+            handler.close()
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("zadavalnik_trace", default=None)
+_current_span_id: ContextVar[Optional[int]] = ContextVar("zadavalnik_span_id", default=None)
+_exporter: Optional[TraceExporter] = None
+
+
+def configure(path: str, sample_rate: float = 0.05, slow_ms: float = 3000.0,
+              max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5) -> TraceExporter:
+    """Включает трассировку. До вызова декораторы и span() ничего не записывают."""
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = TraceExporter(path, sample_rate, slow_ms, max_bytes, backup_count)
+    logger.info(f"Tracing enabled: {path} (sample rate {sample_rate}, slow traces >= {slow_ms} ms are always kept)")
+    return _exporter
+
+
+def shutdown():
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Участок кода внутри текущей трассы; вне трассы - пустышка."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+    current = trace.start_span(name, _current_span_id.get(), attrs)
+    token = _current_span_id.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span_id.reset(token)
+
+
+def traced(name: Optional[str] = None):
+    """Декоратор корутины: каждый вызов внутри трассы становится спаном."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _trace_for_callback(name: str, args) -> Trace:
+    """Трасса для обработчика (update, context) или задачи JobQueue (context)."""
+    update = args[0] if args and hasattr(args[0], "update_id") else None
+    if update is None:
+        job = getattr(args[0], "job", None) if args else None
+        return Trace(name, attrs={"job": getattr(job, "name", None)})
+    attrs = {}
+    if update.effective_user:
+        attrs["user_id"] = update.effective_user.id
+    if update.effective_chat:
+        attrs["chat_id"] = update.effective_chat.id
+    return Trace(name, update_id=update.update_id, attrs=attrs)
+
+
+def trace_handler(func):
+    """Декоратор обработчика python-telegram-bot: одна трасса на вызов."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        exporter = _exporter
+        if exporter is None or _current_trace.get() is not None:
+            return await func(*args, **kwargs)
+        trace = _trace_for_callback(func.__name__, args)
+        token = _current_trace.set(trace)
+        try:
+            return await func(*args, **kwargs)
+        except BaseException as e:
+            trace.error = type(e).__name__
+            raise
+        finally:
+            _current_trace.reset(token)
+            exporter.finish(trace)
+    return wrapper
@@ -0,0 +1,155 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import ApplicationHandlerStop
+
+from zadavalnik.bot.idempotency import UpdateDeduplicator
+from zadavalnik.config import load_settings
+from zadavalnik.database import db as db_module
+
+
+def make_update(update_id: int, chat_id: int = 1, message_id: int = 1, edited: bool = False) -> Update:
+    message = Message(message_id=message_id, date=datetime.now(timezone.utc), chat=Chat(id=chat_id, type="private"),
+                      from_user=User(id=chat_id, first_name="test", is_bot=False), text="ответ")
+    if edited:
+        return Update(update_id=update_id, edited_message=message)
+    return Update(update_id=update_id, message=message)
+
+
+@pytest.fixture
+def run_with_db():
+    """Запускает сценарий на чистой БД в памяти (движок создается в цикле событий сценария)."""
+    load_settings(BOT_TOKEN="test", TEST_USER_TGID=0, OPENAI_API_KEY="test",
+                  DATABASE_URL="sqlite+aiosqlite:///:memory:")
+
+    def run(scenario):
+        async def main():
+            db_module._async_engine = db_module._async_session_factory = None
+            await db_module.init_db()
+            try:
+                return await scenario()
+            finally:
+                await db_module.get_engine().dispose()
+                db_module._async_engine = db_module._async_session_factory = None
+        return asyncio.run(main())
+    return run
+
+
+async def accepted(deduplicator: UpdateDeduplicator, update: Update) -> bool:
+    try:
+        await deduplicator.check(update, None)
+    except ApplicationHandlerStop:
+        return False
+    return True
+
+
+async def handle(deduplicator: UpdateDeduplicator, update: Update) -> bool:
+    """Проверка в группе -1 и, если апдейт прошел, завершение обработки."""
+    if not await accepted(deduplicator, update):
+        return False
+    await deduplicator.complete_update(update, None)
+    return True
+
+
+def test_same_update_id_is_dropped(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        first = await accepted(deduplicator, make_update(10))
+        while_in_flight = await accepted(deduplicator, make_update(10))
+        await deduplicator.complete_update(make_update(10), None)
+        after_complete = await accepted(deduplicator, make_update(10))
+        return first, while_in_flight, after_complete, deduplicator.duplicate_updates
+
+    assert run_with_db(scenario) == (True, False, False, 2)
+
+
+def test_same_message_under_new_update_id_is_dropped(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        first = await handle(deduplicator, make_update(10, chat_id=5, message_id=7))
+        redelivered = await handle(deduplicator, make_update(11, chat_id=5, message_id=7))
+        other_chat = await handle(deduplicator, make_update(12, chat_id=6, message_id=7))
+        return first, redelivered, other_chat, deduplicator.duplicate_messages
+
+    assert run_with_db(scenario) == (True, False, True, 1)
+
+
+def test_edited_message_is_not_dropped(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        original = await handle(deduplicator, make_update(10, chat_id=5, message_id=7))
+        edited = await handle(deduplicator, make_update(11, chat_id=5, message_id=7, edited=True))
+        return original, edited
+
+    assert run_with_db(scenario) == (True, True)
+
+
+def test_offset_does_not_pass_in_flight_update(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        for update_id in (1, 2, 3):
+            assert await accepted(deduplicator, make_update(update_id, message_id=update_id))
+        deduplicator.complete(1)
+        after_first = deduplicator.offset
+        deduplicator.complete(3) # 2 еще обрабатывается
+        out_of_order = deduplicator.offset
+        deduplicator.complete(2)
+        return after_first, out_of_order, deduplicator.offset
+
+    assert run_with_db(scenario) == (1, 1, 3)
+
+
+def test_processed_updates_are_dropped_after_restart(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        for update_id in (1, 2):
+            assert await handle(deduplicator, make_update(update_id, message_id=update_id))
+        await deduplicator.flush()
+
+        restarted = UpdateDeduplicator()
+        offset = await restarted.load()
+        same_update = await accepted(restarted, make_update(2, message_id=2))
+        same_message = await accepted(restarted, make_update(20, message_id=1))
+        new_message = await accepted(restarted, make_update(3, message_id=3))
+        return offset, same_update, same_message, new_message
+
+    assert run_with_db(scenario) == (2, False, False, True)
+
+
+def test_update_interrupted_before_complete_is_replayed(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        assert await handle(deduplicator, make_update(1, message_id=1))
+        assert await accepted(deduplicator, make_update(2, message_id=2)) # Обработчик не завершился
+        await deduplicator.flush()
+        offset_before_crash = deduplicator.offset
+
+        restarted = UpdateDeduplicator()
+        await restarted.load()
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+        count = await restarted.replay_pending(application)
+        replayed = application.update_queue.get_nowait()
+        handled = await handle(restarted, replayed)
+        await restarted.flush()
+
+        again = UpdateDeduplicator()
+        await again.load()
+        return (offset_before_crash, count, replayed.update_id, replayed.message.message_id, handled,
+                await again.replay_pending(application))
+
+    assert run_with_db(scenario) == (1, 1, 2, 2, True, 0)
+
+
+def test_completed_update_is_not_journaled(run_with_db):
+    async def scenario():
+        deduplicator = UpdateDeduplicator()
+        assert await handle(deduplicator, make_update(1))
+        await deduplicator.flush()
+        restarted = UpdateDeduplicator()
+        await restarted.load()
+        return await restarted.replay_pending(SimpleNamespace(update_queue=asyncio.Queue(), bot=None))
+
+    assert run_with_db(scenario) == 0